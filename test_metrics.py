@@ -0,0 +1,65 @@
+import numpy as np
+from utils.metrics import corpus_bleu, cider_d, encode_captions, ngram_codes
+
+# the expected scores are computed by hand from the definitions of BLEU and CIDEr-D
+
+HYPOTHESIS = "the cat sat on the mat".split()
+REFERENCE = "the cat is on the mat".split()
+
+
+def test_bleu_precisions():
+    # 5/6 unigrams, 3/5 bigrams, 1/4 trigrams and 0/3 4-grams match, same lengths
+    scores = corpus_bleu([[REFERENCE]], [HYPOTHESIS])
+    assert np.isclose(scores["bleu_1"], 5 / 6)
+    assert np.isclose(scores["bleu_2"], (5 / 6 * 3 / 5) ** (1 / 2))
+    assert np.isclose(scores["bleu_3"], 0.5)  # (5/6 * 3/5 * 1/4) ** (1/3)
+    assert scores["bleu_4"] == 0.0
+
+
+def test_bleu_clipping_and_brevity_penalty():
+    # "the" is counted once at most, as in the reference
+    scores = corpus_bleu([["the cat".split()]], ["the the the".split()], max_n=1)
+    assert np.isclose(scores["bleu_1"], 1 / 3)
+    # a hypothesis of 2 words for a reference of 6: penalty exp(1 - 6 / 2)
+    scores = corpus_bleu([[REFERENCE]], ["the cat".split()], max_n=2)
+    assert np.isclose(scores["bleu_2"], np.exp(-2))
+    # the closest reference length is used (6, not 3)
+    scores = corpus_bleu([[REFERENCE, "a b c".split()]], [HYPOTHESIS], max_n=1)
+    assert np.isclose(scores["bleu_1"], 5 / 6)
+
+
+def test_cider_d():
+    # each image has its own words (idf = log 2): the unigram and bigram similarities
+    # are 1, there are no trigrams or 4-grams, so each score is 10 * (1 + 1) / 4
+    references = [["a b".split()], ["c d".split()]]
+    score, scores = cider_d(references, ["a b".split(), "c d".split()])
+    assert np.isclose(score, 5.0) and np.allclose(scores, [5.0, 5.0])
+    # the words found in the references of every image have an idf of 0
+    score, _ = cider_d([["a b".split()], ["a b".split()]], ["a b".split()] * 2)
+    assert score == 0.0
+
+
+def test_ngram_codes_overflow():
+    # base ** 3 is above 2 ** 63: the n-grams are compared as rows of word ids, an
+    # int64 code would wrap around and give (a, a, b) and (b, a, b) the same code
+    ids, offsets = encode_captions(["a a b".split(), "b a b".split(), "a a b".split()], {})
+    captions, codes = ngram_codes(ids, offsets, 3, base=2**32)
+    _, inverse = np.unique(codes, return_inverse=True)
+    assert captions.tolist() == [0, 1, 2]
+    assert inverse[0] == inverse[2] != inverse[1]
+
+    # the scores with a vocabulary of 70000 words (base ** 4 above 2 ** 63) match the ones
+    # computed by hand: a long caption generated exactly adds its n-grams to the matches
+    words = [f"w{i}" for i in range(70000)]
+    scores = corpus_bleu([[REFERENCE], [words]], [HYPOTHESIS, words])
+    matches, totals = np.array([5, 3, 1, 0]), np.array([6, 5, 4, 3])
+    matches, totals = matches + 70001 - np.arange(1, 5), totals + 70001 - np.arange(1, 5)
+    expected = np.exp(np.cumsum(np.log(matches / totals)) / np.arange(1, 5))
+    assert np.allclose([scores[f"bleu_{n}"] for n in range(1, 5)], expected)
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: ok")
@@ -0,0 +1,49 @@
+import pytest, torch
+from utils.model import ImageCaptioningModel
+from utils.decode import greedy_decode
+from utils.export import export_model, load_exported, load_model
+from utils.vocabulary import Vocabulary
+
+# the training mode of a model must survive a save and a reload, so that a model trained
+# on prefixes is still refused by the incremental decoders
+
+VOCABULARY = Vocabulary(["<pad>", "<unk>", "startseq", "endseq", "a", "b"])
+
+
+def _saved_model(tmp_path, mode: str = None) -> str:
+    model = ImageCaptioningModel((299, 299), len(VOCABULARY), 8, "cpu")
+    if mode is not None:
+        model.training_mode = mode
+    path = str(tmp_path / "model.pth")
+    torch.save(model.state_dict(), path)
+    return path
+
+
+def test_prefix_model_refused_after_reload(tmp_path):
+    path = _saved_model(tmp_path, "prefixes")
+    model, vocabulary, max_length = load_model(path, VOCABULARY, 5, embedding_dim=8)
+    assert model.training_mode == "prefixes"
+    with pytest.raises(ValueError):
+        greedy_decode(model, torch.zeros(2, 2048), max_length, 2, 3)
+    with pytest.raises(ValueError):
+        export_model(model, vocabulary, max_length, str(tmp_path / "model.pt"))
+
+
+def test_teacher_forced_model_exported_with_its_mode(tmp_path):
+    path = _saved_model(tmp_path, "teacher_forcing")
+    model, vocabulary, max_length = load_model(path, VOCABULARY, 5, embedding_dim=8)
+    export_model(model, vocabulary, max_length, str(tmp_path / "model.pt"))
+    exported = load_exported(str(tmp_path / "model.pt"))
+    assert exported.training_mode == "teacher_forcing"
+    exported.caption(torch.zeros(2, 2048))
+
+
+def test_legacy_state_dict_warns(tmp_path):
+    path = _saved_model(tmp_path)
+    state_dict = torch.load(path)
+    del state_dict["_training_mode"]  # saved before the mode was recorded
+    torch.save(state_dict, path)
+    model, _, max_length = load_model(path, VOCABULARY, 5, embedding_dim=8)
+    assert model.training_mode == "unknown"
+    with pytest.warns(UserWarning, match="training mode"):
+        greedy_decode(model, torch.zeros(2, 2048), max_length, 2, 3)
@@ -0,0 +1,452 @@
+import os, sys, json, time, queue, hashlib, argparse, itertools, threading, numpy as np
+import torch
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from utils.extract import load_and_preprocess
+from utils.export import load_model, decode
+from utils.vocabulary import Vocabulary
+from utils.instrument import timed
+
+"""
+Offline captioning of large image collections, for batch jobs:
+    python -m utils.batch_caption --input images/ --model model_2_int8.pt --output captions/
+    python -m utils.batch_caption --manifest paths.txt --model model_2.pth
+        --vocab data/vocabulary.json --max-length 35 --output captions/ --format parquet
+The images are streamed through bounded stages (decoding and preprocessing in worker
+threads, feature extraction, batched caption decoding in its own thread), so the memory
+used does not depend on the number of images. The captions are written in shards of
+shard_size images (part-00000.jsonl, ...); a shard is written to a temporary file and
+renamed when it is complete, so after a crash the job resumes from the first missing
+shard when it is started again with the same arguments. The names of the images of each
+shard are recorded (first, last and a hash of all of them) in _job.json, and a job whose
+input changed since is refused instead of being resumed at the wrong image.
+"""
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".webp", ".tif", ".tiff")
+_JOB_FILE = "_job.json"
+
+################################################################################################
+
+"""
+These generators list the images of a job lazily, in a deterministic order (which the
+resumption relies on), as (name, path) couples.
+iter_directory walks a folder recursively (the names are the paths relative to it),
+iter_manifest reads a file with one image path per line, or one JSON object with a
+"path" (and an optional "name") per line; the relative paths are relative to the
+folder of the manifest.
+"""
+
+
+def iter_directory(folderpath: str):
+    for root, dirnames, filenames in os.walk(folderpath):
+        dirnames.sort()  # os.walk visits the subfolders in this order
+        for filename in sorted(filenames):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(root, filename)
+                yield os.path.relpath(path, folderpath), path
+
+
+def iter_manifest(filepath: str):
+    folderpath = os.path.dirname(os.path.abspath(filepath))
+    with open(filepath, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                entry = json.loads(line)
+                name, path = entry.get("name", entry["path"]), entry["path"]
+            else:
+                name = path = line
+            yield name, os.path.join(folderpath, path)
+
+
+################################################################################################
+
+"""
+This function captions a stream of images and writes the captions in shards, in
+output_folder. Each output row has the "image" name and its "caption", or an "error"
+if the image could not be read (the job goes on with the other images).
+The decoding and preprocessing run in `workers` threads, at most `prefetch` batches
+ahead of the feature extractor, and at most `prefetch` batches of features wait for the
+caption decoder, which runs in its own thread, so the extractor and the decoder work at
+the same time. Only the names of the current shard and a few batches are in memory.
+The completed shards found in output_folder are skipped (the images are listed again,
+but not read), after checking that the listed names are the ones of the shards.
+Args:
+    images: iterable; the (name, path) couples of the images, e.g. iter_directory(...)
+    model: ImageCaptioningModel or ExportedCaptioningModel; the captioning model
+    vocabulary: Vocabulary or dict; the vocabulary (or word_to_int) of the model
+    max_length: int; the maximum number of generated tokens
+    output_folder: str; the folder of the shards
+    extractor: callable=None; the feature extractor (InceptionV3Extractor by default)
+    output_format: str="jsonl"; "jsonl" or "parquet" (needs pyarrow)
+    shard_size: int=10000; the number of images of each shard
+    batch_size: int=64; the number of images extracted and decoded together
+    beam_width: int=1; greedy decoding if 1, beam search otherwise
+    workers: int=None; the number of threads reading the images (all the cores by default)
+    prefetch: int=2; the number of batches waiting between two stages
+    progress: bool=True; whether to print a line after each shard
+    source: str=None; the input of the job (e.g. the absolute path of its folder),
+        which must be the same to resume it
+Returns:
+    a summary dict (images, errors, shards written and skipped, images per second)
+"""
+
+
+def caption_images(
+    images,
+    model,
+    vocabulary,
+    max_length: int,
+    output_folder: str,
+    extractor=None,
+    output_format: str = "jsonl",
+    shard_size: int = 10000,
+    batch_size: int = 64,
+    beam_width: int = 1,
+    workers: int = None,
+    prefetch: int = 2,
+    progress: bool = True,
+    source: str = None,
+) -> dict:
+    if output_format not in ("jsonl", "parquet"):
+        raise ValueError("Unsupported format. Please use 'jsonl' or 'parquet'.")
+    if not isinstance(vocabulary, Vocabulary):
+        vocabulary = Vocabulary.from_dict(vocabulary)
+    if extractor is None:
+        from utils.extract import InceptionV3Extractor
+
+        extractor = InceptionV3Extractor()
+    elif isinstance(extractor, type):
+        extractor = extractor()
+
+    os.makedirs(output_folder, exist_ok=True)
+    settings = {"format": output_format, "shard_size": shard_size, "source": source}
+    job = _open_job(output_folder, settings)
+    done = 0  # the shards are completed in order, the first missing one is resumed
+    while done < len(job["shards"]) and os.path.exists(
+        _shard_path(output_folder, done, output_format)
+    ):
+        done += 1
+    del job["shards"][done:]  # recorded, but not renamed before the crash
+    images = iter(images)
+    for index in range(done):  # skipping them
+        if _shard_record(list(itertools.islice(images, shard_size))) != job["shards"][index]:
+            raise ValueError(
+                f"The images of shard {index} of {output_folder} are not the ones listed "
+                "now, the input changed since the job started: use another output folder."
+            )
+
+    decoder = _CaptionDecoder(
+        model, vocabulary, max_length, beam_width, maxsize=prefetch
+    ).start()
+    summary = {"images": 0, "errors": 0, "shards": 0, "skipped_shards": done}
+    begin = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+            for index in itertools.count(done):
+                shard = list(itertools.islice(images, shard_size))
+                if not shard:
+                    break
+                shard_begin = time.perf_counter()
+                writer = _ShardWriter(_shard_path(output_folder, index, output_format))
+                for names, batch, errors in _iter_batches(
+                    shard, executor, extractor.target_size, batch_size, prefetch
+                ):
+                    with timed("batch_caption.extract"):
+                        features = extractor(batch) if len(batch) else None
+                    decoder.put((writer, names, features, errors))
+                # recorded before the shard is renamed, so that a shard file always has a record
+                job["shards"].append(_shard_record(shard))
+                _save_job(output_folder, job)
+                decoder.put((writer, None, None, None))  # the shard is complete
+                decoder.join()  # waiting for the rename before reporting the shard
+
+                summary["images"] += len(shard)
+                summary["errors"] += writer.errors
+                summary["shards"] += 1
+                if progress:
+                    seconds = time.perf_counter() - shard_begin
+                    print(
+                        f"shard {index}: {len(shard)} images, {writer.errors} errors, "
+                        f"{len(shard) / max(seconds, 1e-9):.1f} images/s",
+                        file=sys.stderr,
+                    )
+    finally:
+        decoder.close()
+
+    summary["seconds"] = time.perf_counter() - begin
+    summary["images_per_second"] = summary["images"] / max(summary["seconds"], 1e-9)
+    return summary
+
+
+def _shard_path(output_folder: str, index: int, output_format: str) -> str:
+    return os.path.join(output_folder, f"part-{index:05d}.{output_format}")
+
+
+def _open_job(output_folder: str, settings: dict) -> dict:
+    # the shards of an output folder can only be resumed with the same settings
+    path = os.path.join(output_folder, _JOB_FILE)
+    if not os.path.exists(path):
+        job = dict(settings, shards=[])
+        _save_job(output_folder, job)
+        return job
+    with open(path, "r") as f:
+        job = json.load(f)
+    previous = {key: job.get(key) for key in settings}
+    if previous != settings or "shards" not in job:
+        raise ValueError(
+            f"{output_folder} holds the shards of a job with other settings "
+            f"({previous}), use another output folder."
+        )
+    return job
+
+
+def _save_job(output_folder: str, job: dict) -> None:
+    path = os.path.join(output_folder, _JOB_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump(job, f)
+    os.replace(path + ".tmp", path)
+
+
+def _shard_record(shard: list) -> dict:
+    # identifies the images of a shard by their names, in order
+    names = [name for name, _ in shard]
+    digest = hashlib.sha256("\n".join(names).encode("utf-8")).hexdigest()
+    return {
+        "images": len(names),
+        "first": names[0] if names else None,
+        "last": names[-1] if names else None,
+        "sha256": digest,
+    }
+
+
+################################################################################################
+
+"""
+This generator reads and preprocesses the images of a shard in the threads of the
+executor, and yields them in batches, in order: (names, images, errors), where images
+stacks the images that could be read and errors maps the index of each unreadable image
+in names to its error message. At most prefetch + 1 batches are read at the same time.
+"""
+
+
+def _iter_batches(shard: list, executor, target_size: tuple, batch_size: int, prefetch: int):
+    starts = iter(range(0, len(shard), batch_size))
+    pending = deque()
+
+    def submit_next_batch() -> None:
+        start = next(starts, None)
+        if start is not None:
+            items = shard[start : start + batch_size]
+            futures = [executor.submit(_read, path, target_size) for _, path in items]
+            pending.append(([name for name, _ in items], futures))
+
+    for _ in range(prefetch + 1):
+        submit_next_batch()
+
+    while pending:
+        names, futures = pending.popleft()
+        images, errors = [], {}
+        for i, future in enumerate(futures):
+            image, error = future.result()
+            if error is None:
+                images.append(image)
+            else:
+                errors[i] = error
+        submit_next_batch()
+        yield names, np.stack(images) if images else np.zeros((0,)), errors
+
+
+def _read(path: str, target_size: tuple):
+    try:
+        return load_and_preprocess(path, target_size), None
+    except Exception as error:  # corrupt or unsupported file
+        return None, f"{type(error).__name__}: {error}"
+
+
+################################################################################################
+
+"""
+This class writes the rows of one shard to a temporary file as they come (one flush per
+batch for JSONL, one row group per batch for Parquet), and renames it when the shard
+is complete, so that an existing shard file is always a complete shard.
+"""
+
+
+class _ShardWriter:
+    def __init__(self, path: str):
+        self.path, self.tmp_path = path, path + ".tmp"
+        self.parquet = path.endswith(".parquet")
+        self.errors = 0
+        if self.parquet:
+            import pyarrow as pa, pyarrow.parquet as pq
+
+            self.schema = pa.schema(
+                [("image", pa.string()), ("caption", pa.string()), ("error", pa.string())]
+            )
+            self.file = pq.ParquetWriter(self.tmp_path, self.schema)
+        else:
+            self.file = open(self.tmp_path, "w", encoding="utf-8")
+
+    def write(self, rows: list) -> None:
+        self.errors += sum("error" in row for row in rows)
+        if self.parquet:
+            import pyarrow as pa
+
+            columns = {key: [row.get(key) for row in rows] for key in self.schema.names}
+            self.file.write_table(pa.table(columns, schema=self.schema))
+        else:
+            self.file.write("".join(json.dumps(row) + "\n" for row in rows))
+            self.file.flush()
+
+    def commit(self) -> None:
+        if self.parquet:
+            self.file.close()
+        else:
+            os.fsync(self.file.fileno())
+            self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+
+################################################################################################
+
+"""
+This class decodes the captions of the extracted features in its own thread, and
+writes them with the _ShardWriter of their shard. The items are put in a bounded queue:
+(writer, names, features, errors), or (writer, None, None, None) to commit the shard.
+An exception of the thread is raised again in the caller by put or join.
+"""
+
+
+class _CaptionDecoder:
+    def __init__(
+        self, model, vocabulary: Vocabulary, max_length: int, beam_width: int, maxsize: int
+    ):
+        self.model, self.vocabulary = model, vocabulary
+        self.max_length, self.beam_width = max_length, beam_width
+        self.queue = queue.Queue(maxsize=max(1, maxsize))
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> "_CaptionDecoder":
+        self.thread.start()
+        return self
+
+    def put(self, item: tuple) -> None:
+        self._raise()
+        self.queue.put(item)
+
+    def join(self) -> None:
+        self.queue.join()
+        self._raise()
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+
+    def _raise(self) -> None:
+        if self.error is not None:
+            raise RuntimeError("the caption decoder failed") from self.error
+
+    def _run(self) -> None:
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None:  # after an error, the items are only drained
+                    self._process(*item)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def _process(self, writer: _ShardWriter, names: list, features, errors: dict) -> None:
+        if names is None:
+            writer.commit()
+            return
+        captions = iter(self._decode(features) if features is not None else [])
+        rows = []
+        for i, name in enumerate(names):
+            if i in errors:
+                rows.append({"image": name, "error": errors[i]})
+            else:
+                rows.append({"image": name, "caption": next(captions)})
+        writer.write(rows)
+
+    @torch.no_grad()
+    def _decode(self, features) -> list:
+        with timed("batch_caption.decode"):
+            features = torch.as_tensor(np.asarray(features), dtype=torch.float32)
+            tokens, lengths = decode(
+                self.model, features, self.vocabulary, self.max_length, self.beam_width
+            )
+            tokens, lengths = tokens.tolist(), lengths.tolist()
+        return [
+            self.vocabulary.decode(caption[:length])
+            for caption, length in zip(tokens, lengths)
+        ]
+
+
+################################################################################################
+
+"""
+Command line entry point (see the examples at the top of the module). The model is
+either an artifact of utils.export (which holds its vocabulary and max_length) or a
+state dict of ImageCaptioningModel with --vocab and --max-length.
+"""
+
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description="Caption a large set of images.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input", help="folder of images (walked recursively)")
+    source.add_argument("--manifest", help="file of image paths, one per line")
+    parser.add_argument("--model", required=True, help="state dict or exported artifact")
+    parser.add_argument("--vocab", default=None, help="saved Vocabulary or word_to_int JSON")
+    parser.add_argument("--max-length", type=int, default=None)
+    parser.add_argument("--embedding-dim", type=int, default=200)
+    parser.add_argument("--adaptive-cutoffs", type=int, nargs="+", default=None)
+    parser.add_argument("--output", required=True, help="folder of the output shards")
+    parser.add_argument("--format", choices=["jsonl", "parquet"], default="jsonl")
+    parser.add_argument("--shard-size", type=int, default=10000)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--beam-width", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--prefetch", type=int, default=2)
+    parser.add_argument("--device", default=None)
+    args = parser.parse_args(argv)
+    if args.vocab is not None and args.max_length is None:
+        parser.error("--max-length is required with --vocab")
+
+    model, vocabulary, max_length = load_model(
+        args.model,
+        args.vocab,
+        args.max_length,
+        args.embedding_dim,
+        args.adaptive_cutoffs,
+        args.device,
+    )
+    images = iter_directory(args.input) if args.input else iter_manifest(args.manifest)
+    source = os.path.abspath(args.input or args.manifest)
+    summary = caption_images(
+        images,
+        model,
+        vocabulary,
+        max_length,
+        args.output,
+        output_format=args.format,
+        shard_size=args.shard_size,
+        batch_size=args.batch_size,
+        beam_width=args.beam_width,
+        workers=args.workers,
+        prefetch=args.prefetch,
+        source=source,
+    )
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
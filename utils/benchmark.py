@@ -0,0 +1,452 @@
+import os, sys, json, time, argparse, platform, resource, subprocess, numpy as np
+
+"""
+Benchmark suite of the data, training and inference hot paths, on a synthetic dataset
+generated locally (random JPEG images and Zipf-distributed captions), so that the
+results only depend on the code and the machine.
+Each benchmark runs in its own subprocess, so that its peak RSS is measured alone, and
+its timed function is run `repeat` times (the best and median wall times are kept).
+    python -m utils.benchmark --output benchmark.json
+    python -m utils.benchmark --save-baseline benchmark_baseline.json
+    python -m utils.benchmark --baseline benchmark_baseline.json --tolerance 0.2
+The last command exits with status 1 if a benchmark is slower (or uses more memory)
+than in the baseline by more than the tolerance. A benchmark that fails always gives
+the exit status 1, with or without a baseline.
+"""
+
+BENCHMARKS = {}
+
+
+def benchmark(function):
+    # registering a benchmark: function(context) returns (number of items, timed function)
+    BENCHMARKS[function.__name__] = function
+    return function
+
+
+################################################################################################
+
+"""
+This function generates the synthetic dataset once (it is reused if it already exists):
+an images folder of JPEG images of random sizes, and a captions.txt file in the format
+of the Flickr8k dataset (image,caption) with captions_per_image captions per image.
+Args:
+    folderpath: str; the folder of the dataset
+    n_images: int=200; the number of images
+    captions_per_image: int=5; the number of captions of each image
+    vocabulary_size: int=2000; the number of distinct words in the captions
+    seed: int=0; the seed of the random generator
+"""
+
+
+def make_synthetic_dataset(
+    folderpath: str,
+    n_images: int = 200,
+    captions_per_image: int = 5,
+    vocabulary_size: int = 2000,
+    seed: int = 0,
+) -> tuple:
+    images_folder = os.path.join(folderpath, "images")
+    captions_file = os.path.join(folderpath, "captions.txt")
+    if os.path.exists(captions_file):
+        return images_folder, captions_file
+
+    from PIL import Image
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(images_folder, exist_ok=True)
+    for i in range(n_images):
+        width, height = rng.integers(300, 500, size=2)
+        # smooth random images compress like photos, unlike pure noise
+        small = rng.integers(0, 256, size=(height // 16 + 1, width // 16 + 1, 3))
+        image = Image.fromarray(small.astype(np.uint8)).resize((width, height))
+        image.save(os.path.join(images_folder, f"{i:06d}.jpg"), quality=90)
+
+    # the word frequencies follow a Zipf law, like in natural captions
+    words = np.array([f"word{i}" for i in range(vocabulary_size)])
+    frequencies = 1.0 / np.arange(1, vocabulary_size + 1)
+    frequencies /= frequencies.sum()
+    lines = ["image,caption"]
+    for i in range(n_images):
+        for _ in range(captions_per_image):
+            caption = rng.choice(words, size=rng.integers(8, 16), p=frequencies)
+            lines.append(f"{i:06d}.jpg,A {' '.join(caption)} .")
+    tmp_path = captions_file + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, captions_file)  # the captions file marks a complete dataset
+    return images_folder, captions_file
+
+
+################################################################################################
+
+"""
+The benchmarks. The context holds the paths of the synthetic dataset ("images",
+"captions") and a scratch folder ("scratch"); the setup (outside of the timed function)
+prepares the inputs, and the timed function only runs the measured code path.
+"""
+
+
+@benchmark
+def load_data(context: dict):
+    from utils.load import load_data
+
+    def run():
+        load_data(context["images"], context["captions"], lazy=False)
+
+    return context["n_images"], run
+
+
+@benchmark
+def pad_images(context: dict):
+    from utils.preprocessing import pad_images
+
+    output_folder = os.path.join(context["scratch"], "padded")
+
+    def run():
+        pad_images(context["images"], output_folder, (500, 500))
+
+    return context["n_images"], run
+
+
+@benchmark
+def resize_image_dictionary(context: dict):
+    from utils.load import load_data
+    from utils.preprocessing import resize_image_dictionary
+
+    image_arrays, _ = load_data(context["images"], context["captions"], lazy=False)
+
+    def run():
+        resize_image_dictionary(image_arrays, (299, 299))
+
+    return len(image_arrays), run
+
+
+@benchmark
+def get_vocabulary(context: dict):
+    from utils.load import load_data
+    from utils.preprocessing import get_vocabulary
+
+    _, captions = load_data(context["images"], context["captions"])
+
+    def run():
+        get_vocabulary(captions)
+
+    return sum(len(c) for c in captions.values()), run
+
+
+@benchmark
+def feature_cache_load(context: dict):
+    from utils.features import FeatureCache
+    from utils.extract import cached_features
+
+    images = {
+        name: os.path.join(context["images"], name)
+        for name in sorted(os.listdir(context["images"]))
+    }
+    cache = FeatureCache(os.path.join(context["scratch"], "feature_cache"))
+    cached_features(images, _SyntheticExtractor, cache, progress=False)  # warming up
+
+    def run():
+        cached_features(images, _SyntheticExtractor, cache, progress=False)
+
+    return len(images), run
+
+
+@benchmark
+def prefix_dataset(context: dict):
+    from utils.dataset import CaptionPrefixDataset
+
+    captions, vocabulary, features, max_length = _training_inputs(context)
+
+    def run():
+        CaptionPrefixDataset(captions, vocabulary, features, max_length)
+
+    return sum(len(c) for c in captions.values()), run
+
+
+@benchmark
+def train_epoch(context: dict):
+    from utils.dataset import CaptionPrefixDataset
+    from utils.trainer import Trainer
+
+    captions, vocabulary, features, max_length = _training_inputs(context)
+    dataset = CaptionPrefixDataset(captions, vocabulary, features, max_length)
+    trainer = Trainer(
+        _model(len(vocabulary)), dataset, batch_size=128, num_workers=0, log_every=10**9
+    )
+
+    def run():
+        trainer.fit(trainer.epoch + 1)  # one more epoch at each call
+
+    return len(dataset), run
+
+
+@benchmark
+def decode_latency(context: dict):
+    import torch
+    from utils.decode import greedy_decode
+
+    captions, vocabulary, features, max_length = _training_inputs(context)
+    model = _model(len(vocabulary)).eval()
+    vectors = torch.as_tensor(np.stack(list(features.values())[:50]))
+
+    def run():
+        # one caption at a time, as in an interactive request
+        for i in range(len(vectors)):
+            greedy_decode(
+                model,
+                vectors[i : i + 1],
+                max_length,
+                vocabulary.start_id,
+                vocabulary.end_id,
+            )
+
+    return len(vectors), run
+
+
+# the modules of a serving or batch-inference process, and the heavy dependencies that
+# they must not import (the data, plotting and training libraries are imported lazily)
+INFERENCE_MODULES = [
+    "utils.vocabulary",
+    "utils.model",
+    "utils.decode",
+    "utils.export",
+    "utils.serve",
+]
+HEAVY_MODULES = [
+    "kagglehub",
+    "matplotlib",
+    "cv2",
+    "pandas",
+    "sklearn",
+    "PIL",
+    "tensorflow",
+    "keras",
+]
+
+
+@benchmark
+def import_inference(context: dict):
+    # the cold start of the inference path, in a fresh interpreter (torch included)
+    script = "import sys, json\n"
+    script += "".join(f"import {module}\n" for module in INFERENCE_MODULES)
+    script += f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    paths = [root] + os.environ.get("PYTHONPATH", "").split(os.pathsep)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, paths)))
+
+    def run():
+        completed = subprocess.run(
+            [sys.executable, "-c", script], capture_output=True, text=True, env=env
+        )
+        if completed.returncode != 0:
+            raise RuntimeError(completed.stderr.strip().splitlines()[-1])
+        heavy = json.loads(completed.stdout.strip().splitlines()[-1])
+        if heavy:
+            raise RuntimeError(f"the inference path imports {', '.join(heavy)}")
+
+    return 1, run
+
+
+class _SyntheticExtractor:
+    # a feature extractor with the interface of InceptionV3Extractor, without a model
+    identity = "benchmark.synthetic/2048"
+    target_size = (299, 299)
+    dim = 2048
+
+    def __call__(self, batch: np.ndarray) -> np.ndarray:
+        # the mean color of each image, repeated up to the feature dimension
+        vectors = np.tile(batch.mean(axis=(1, 2)), (1, self.dim // 3 + 1))
+        return vectors[:, : self.dim]
+
+
+def _training_inputs(context: dict):
+    from utils.load import load_data
+    from utils.vocabulary import Vocabulary
+
+    _, captions = load_data(
+        context["images"], context["captions"], normalize=True, add_start_end=True
+    )
+    vocabulary = Vocabulary.build(captions, min_count=1)
+    rng = np.random.default_rng(0)
+    features = {name: rng.standard_normal(2048).astype(np.float32) for name in captions}
+    max_length = max(len(c.split()) for cs in captions.values() for c in cs)
+    return captions, vocabulary, features, max_length
+
+
+def _model(vocabulary_size: int):
+    import torch
+    from utils.model import ImageCaptioningModel
+
+    torch.manual_seed(0)
+    return ImageCaptioningModel((299, 299), vocabulary_size, 200, "cpu")
+
+
+################################################################################################
+
+"""
+This function runs one benchmark in the current process and returns its measures:
+the best and median wall times, the throughput (items per second, from the best time),
+the time per item and the peak resident memory of the process.
+"""
+
+
+def run_benchmark(name: str, context: dict, repeat: int = 3) -> dict:
+    n_items, run = BENCHMARKS[name](context)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss *= 1 if sys.platform == "darwin" else 1024
+    best = min(times)
+    return {
+        "items": n_items,
+        "seconds": best,
+        "median_seconds": float(np.median(times)),
+        "items_per_second": n_items / max(best, 1e-9),
+        "ms_per_item": 1000 * best / max(n_items, 1),
+        "peak_rss_mb": peak_rss / 2**20,
+    }
+
+
+def _run_in_subprocess(name: str, context: dict, repeat: int) -> dict:
+    command = [sys.executable, "-m", "utils.benchmark", "--child", name]
+    command += ["--context", json.dumps(context), "--repeat", str(repeat)]
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        error = completed.stderr.strip().splitlines()
+        return {"error": error[-1] if error else f"exit status {completed.returncode}"}
+    # the result is the last line, the benchmarked code may print before it
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+################################################################################################
+
+"""
+This function compares results to a baseline and returns the regressions: the benchmarks
+whose best time or peak RSS grew by more than the tolerance (0.2 = 20%), and the
+benchmarks that failed (metric "error", with a ratio of None).
+"""
+
+
+def compare(results: dict, baseline: dict, tolerance: float = 0.2) -> list:
+    regressions = []
+    for name, result in results["results"].items():
+        if "error" in result:
+            regressions.append({"benchmark": name, "metric": "error", "ratio": None})
+            continue
+        reference = baseline["results"].get(name)
+        if not reference or "error" in reference:
+            continue
+        for metric in ("seconds", "peak_rss_mb"):
+            ratio = result[metric] / max(reference[metric], 1e-9)
+            if ratio > 1 + tolerance:
+                regressions.append(
+                    {"benchmark": name, "metric": metric, "ratio": ratio}
+                )
+    return regressions
+
+
+def print_table(results: dict, baseline: dict = None) -> None:
+    print(
+        f"{'benchmark':<26}{'seconds':>10}{'items/s':>12}{'ms/item':>10}{'RSS MB':>9}",
+        end="",
+    )
+    print(f"{'vs baseline':>13}" if baseline else "")
+    for name, result in results["results"].items():
+        if "error" in result:
+            print(f"{name:<26}  error: {result['error']}")
+            continue
+        line = f"{name:<26}{result['seconds']:>10.3f}"
+        line += f"{result['items_per_second']:>12.1f}{result['ms_per_item']:>10.2f}"
+        line += f"{result['peak_rss_mb']:>9.0f}"
+        reference = (baseline or {}).get("results", {}).get(name)
+        if reference and "error" not in reference:
+            line += f"{result['seconds'] / max(reference['seconds'], 1e-9):>12.2f}x"
+        print(line)
+
+
+################################################################################################
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the hot paths of the project."
+    )
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), default=None)
+    parser.add_argument("--images", type=int, default=200, help="synthetic images")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workdir", default="data/benchmark")
+    parser.add_argument("--output", default=None, help="JSON file of the results")
+    parser.add_argument("--baseline", default=None, help="JSON results to compare with")
+    parser.add_argument(
+        "--save-baseline", default=None, help="save the results as baseline"
+    )
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--context", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:  # running one benchmark for the parent process
+        result = run_benchmark(args.child, json.loads(args.context), args.repeat)
+        print(json.dumps(result))
+        return 0
+
+    dataset_folder = os.path.join(args.workdir, f"synthetic_{args.images}")
+    images, captions = make_synthetic_dataset(dataset_folder, args.images)
+    context = {
+        "images": os.path.abspath(images),
+        "captions": os.path.abspath(captions),
+        "scratch": os.path.abspath(os.path.join(args.workdir, "scratch")),
+        "n_images": args.images,
+    }
+    os.makedirs(context["scratch"], exist_ok=True)
+
+    results = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "images": args.images,
+            "repeat": args.repeat,
+        },
+        "results": {},
+    }
+    for name in args.only or BENCHMARKS:
+        print(f"running {name}...", flush=True)
+        results["results"][name] = _run_in_subprocess(name, context, args.repeat)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+    print_table(results, baseline)
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                json.dump(results, f, indent=2)
+
+    # a failed benchmark (including the import_inference check) fails the run
+    errors = [name for name, result in results["results"].items() if "error" in result]
+    for name in errors:
+        print(f"ERROR {name}: {results['results'][name]['error']}")
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            if regression["metric"] != "error":
+                print(
+                    f"REGRESSION {regression['benchmark']}: {regression['metric']} "
+                    f"x{regression['ratio']:.2f}"
+                )
+        return 1 if regressions else 0
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
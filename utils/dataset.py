@@ -0,0 +1,161 @@
+import numpy as np, torch
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import Dataset
+from utils.features import FeatureStore
+from utils.vocabulary import Vocabulary
+from utils.instrument import instrumented
+
+"""
+This dataset yields the (image features, caption prefix, next word) training samples
+of the model without materializing them.
+Only the token ids of all captions (one flat array plus an offsets table) and one
+feature vector per image are kept in memory. The samples are built on access:
+for a caption w_0 ... w_(L-1), sample i (1 <= i < L) is the image features, the
+prefix w_0 ... w_(i-1) left-padded with 0 to max_length (like utils.sequence.pad_sequences),
+and the index of w_i, to be used with nn.CrossEntropyLoss.
+Args:
+    captions: dict; (image name: list of captions) couples
+    word_to_int: dict or Vocabulary; the mapping from the words to their indices
+    features: dict or FeatureStore; (image name: feature vector) couples
+    max_length: int; the length of the padded prefixes
+"""
+
+
+class CaptionPrefixDataset(Dataset):
+    def __init__(self, captions: dict, word_to_int: dict, features, max_length: int):
+        self.max_length = max_length
+        self.features, self.tokens, self.offsets, self.caption_rows = _encode_captions(
+            captions, word_to_int, features
+        )
+
+        # each token except the first of its caption is the target of one sample
+        first_tokens = np.zeros(len(self.tokens), dtype=bool)
+        first_tokens[self.offsets[:-1][np.diff(self.offsets) > 0]] = True
+        self.targets = np.flatnonzero(~first_tokens)
+
+    def __len__(self) -> int:
+        return len(self.targets)
+
+    def __getitem__(self, idx: int):
+        position = self.targets[idx]  # position of the target in self.tokens
+        caption = np.searchsorted(self.offsets, position, side="right") - 1
+        start = max(self.offsets[caption], position - self.max_length)
+
+        prefix = np.zeros(self.max_length, dtype=np.int64)
+        prefix[self.max_length - (position - start) :] = self.tokens[start:position]
+        features = np.array(self.features[self.caption_rows[caption]], dtype=np.float32)
+
+        return (
+            torch.from_numpy(features),
+            torch.from_numpy(prefix),
+            int(self.tokens[position]),
+        )
+
+
+################################################################################################
+
+"""
+This dataset yields one sample per caption for teacher-forced training with
+ImageCaptioningModel.forward_sequence: the image features, the input tokens
+w_0 ... w_(L-2), the target tokens w_1 ... w_(L-1) and the length L - 1.
+Use it with collate_captions, which pads the batch to its longest caption.
+Args:
+    captions: dict; (image name: list of captions) couples
+    word_to_int: dict or Vocabulary; the mapping from the words to their indices
+    features: dict or FeatureStore; (image name: feature vector) couples
+    max_length: int=None; the maximum number of tokens kept per caption
+"""
+
+
+class CaptionSequenceDataset(Dataset):
+    def __init__(
+        self, captions: dict, word_to_int: dict, features, max_length: int = None
+    ):
+        self.max_length = max_length
+        self.features, self.tokens, self.offsets, self.caption_rows = _encode_captions(
+            captions, word_to_int, features
+        )
+        # a caption needs at least two tokens to give one (input, target) pair
+        self.captions = np.flatnonzero(np.diff(self.offsets) >= 2)
+
+    def __len__(self) -> int:
+        return len(self.captions)
+
+    def __getitem__(self, idx: int):
+        caption = self.captions[idx]
+        start, end = self.offsets[caption], self.offsets[caption + 1]
+        if self.max_length is not None:
+            end = min(end, start + self.max_length)
+        tokens = torch.from_numpy(self.tokens[start:end].astype(np.int64))
+        features = np.array(self.features[self.caption_rows[caption]], dtype=np.float32)
+
+        return torch.from_numpy(features), tokens[:-1], tokens[1:], len(tokens) - 1
+
+
+################################################################################################
+
+"""
+This function is the collate_fn of CaptionSequenceDataset: it stacks the features
+and right-pads the input and target sequences with 0 to the longest caption of the batch.
+Returns:
+    features (batch, 2048), inputs (batch, length), targets (batch, length), lengths (batch,)
+"""
+
+
+def collate_captions(samples: list):
+    features, inputs, targets, lengths = zip(*samples)
+    return (
+        torch.stack(features),
+        pad_sequence(inputs, batch_first=True, padding_value=0),
+        pad_sequence(targets, batch_first=True, padding_value=0),
+        torch.tensor(lengths, dtype=torch.long),
+    )
+
+
+################################################################################################
+
+"""
+This function encodes all the captions into a flat array of token ids.
+With a Vocabulary, the captions are tokenized by Vocabulary.encode_batch (with the
+start and end tokens); with a dict, they are split on spaces and the unknown words dropped.
+Returns:
+    the feature matrix (one row per image), the token ids, the offsets of the captions
+    in the token ids (number of captions + 1), and the feature row of each caption
+"""
+
+
+@instrumented("dataset.encode_captions")
+def _encode_captions(captions: dict, word_to_int: dict, features):
+    image_names = list(captions.keys())
+
+    # keeping one row per image of the feature matrix
+    if isinstance(features, FeatureStore):
+        feature_matrix = features.matrix  # memory-mapped, nothing is copied
+        image_rows = features.rows(image_names)
+    else:
+        feature_matrix = np.stack([features[name] for name in image_names])
+        feature_matrix = feature_matrix.astype(np.float32, copy=False)
+        image_rows = np.arange(len(image_names))
+
+    if isinstance(word_to_int, Vocabulary):
+        tokens, offsets, caption_images = word_to_int.encode_batch(captions)
+        return feature_matrix, tokens, offsets, np.asarray(image_rows)[caption_images]
+
+    tokens, offsets, caption_rows = [], [0], []
+    for image_name, row in zip(image_names, image_rows):
+        for caption in captions[image_name]:
+            tokens.extend(
+                word_to_int[word] for word in caption.split(" ") if word in word_to_int
+            )
+            offsets.append(len(tokens))
+            caption_rows.append(row)
+
+    return (
+        feature_matrix,
+        np.array(tokens, dtype=np.int32),
+        np.array(offsets, dtype=np.int64),
+        np.array(caption_rows, dtype=np.int64),
+    )
+
+
+################################################################################################
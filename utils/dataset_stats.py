@@ -0,0 +1,220 @@
+import os, json, numpy as np
+from collections import Counter
+from utils.parallel import parallel_map
+from utils.vocabulary import tokenize
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif")
+
+"""
+This class computes streaming statistics (count, min, max, mean and percentiles)
+of integer or rounded values, by keeping a histogram of the values instead of the
+values themselves: its memory depends on the number of distinct values only.
+Args:
+    decimals: int=None; the values are rounded to this number of decimals if given
+"""
+
+
+class Histogram:
+    def __init__(self, decimals: int = None):
+        self.decimals = decimals
+        self.counts = Counter()
+
+    def add(self, value) -> None:
+        if self.decimals is not None:
+            value = round(float(value), self.decimals)
+        self.counts[value] += 1
+
+    def summary(self, percentiles: tuple = (5, 25, 50, 75, 95)) -> dict:
+        if not self.counts:
+            return {"count": 0}
+        values = np.array(sorted(self.counts), dtype=np.float64)
+        counts = np.array([self.counts[v] for v in sorted(self.counts)], dtype=np.int64)
+        cumulated = np.cumsum(counts)
+        total = int(cumulated[-1])
+        summary = {
+            "count": total,
+            "min": float(values[0]),
+            "max": float(values[-1]),
+            "mean": float((values * counts).sum() / total),
+        }
+        for p in percentiles:
+            # the smallest value with at least p% of the values below or equal to it
+            rank = max(1, int(np.ceil(p / 100 * total)))
+            summary[f"p{p}"] = float(values[np.searchsorted(cumulated, rank)])
+        return summary
+
+
+################################################################################################
+
+"""
+This function reads the size of an image from its header only (PIL does not decode
+the pixels until they are needed). It returns None if the file cannot be read.
+"""
+
+
+def read_image_size(image_path: str):
+    from PIL import Image
+
+    try:
+        with Image.open(image_path) as img:
+            return img.size
+    except Exception:  # corrupt or unsupported file
+        return None
+
+
+################################################################################################
+
+"""
+This function profiles a dataset in one pass and caches the result in a small JSON file:
+- the image sizes and aspect ratios, read from the headers in parallel (no pixel decode)
+- the caption lengths (characters and tokens) and the number of captions per image
+- the corrupt images, the images without captions and the captioned images that are missing
+- the list of valid images and, for a captions .txt file, the byte offsets of the captions
+  of each image, so that the explorer functions can sample from the cache in constant time
+The cache is reused as long as the image folder and the captions file do not change.
+Args:
+    image_folder: str; the path to the folder containing all images
+    captions_file: str=None; the path to the captions file (.txt or .json)
+    summary_path: str=None; the path of the cache (<image_folder>_summary.json by default)
+    workers: int=None; the number of threads reading the headers
+    recompute: bool=False; whether to ignore the cache
+"""
+
+
+def profile_dataset(
+    image_folder: str,
+    captions_file: str = None,
+    summary_path: str = None,
+    workers: int = None,
+    recompute: bool = False,
+) -> dict:
+    if summary_path is None:
+        summary_path = os.path.normpath(image_folder) + "_summary.json"
+    source = {
+        "image_folder": os.path.abspath(image_folder),
+        "image_folder_mtime": os.path.getmtime(image_folder),
+        "captions_file": os.path.abspath(captions_file) if captions_file else None,
+        "captions_mtime": os.path.getmtime(captions_file) if captions_file else None,
+    }
+    if not recompute and os.path.exists(summary_path):
+        with open(summary_path, "r", encoding="utf-8") as f:
+            summary = json.load(f)
+        cached = summary.get("source", {})
+        # a summary with the caption statistics also answers the calls without them
+        same_images = all(cached.get(k) == source[k] for k in source if "image" in k)
+        same_captions = captions_file is None or all(
+            cached.get(k) == source[k] for k in source if "captions" in k
+        )
+        if same_images and same_captions:
+            return summary
+
+    # reading the image headers in parallel
+    filenames = sorted(
+        f for f in os.listdir(image_folder) if f.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    sizes = parallel_map(
+        read_image_size, [os.path.join(image_folder, f) for f in filenames], workers
+    )
+    widths, heights, aspect_ratios = Histogram(), Histogram(), Histogram(decimals=2)
+    size_counts, valid, corrupt = Counter(), [], []
+    for filename, size in zip(filenames, sizes):
+        if size is None:
+            corrupt.append(filename)
+            continue
+        valid.append(filename)
+        widths.add(size[0])
+        heights.add(size[1])
+        aspect_ratios.add(size[0] / size[1])
+        size_counts[f"{size[0]}x{size[1]}"] += 1
+
+    summary = {
+        "source": source,
+        "images": {
+            "count": len(valid),
+            "width": widths.summary(),
+            "height": heights.summary(),
+            "aspect_ratio": aspect_ratios.summary(),
+            "sizes": dict(size_counts),
+        },
+        "filenames": valid,
+        "corrupt": corrupt,
+    }
+
+    if captions_file:
+        summary.update(_profile_captions(captions_file, set(valid), set(corrupt)))
+
+    tmp_path = summary_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(summary, f)
+    os.replace(tmp_path, summary_path)
+    return summary
+
+
+def _profile_captions(captions_file: str, valid: set, corrupt: set) -> dict:
+    characters, tokens, per_image = Histogram(), Histogram(), Counter()
+    caption_offsets = {}
+
+    def add_caption(image_name: str, caption: str) -> None:
+        characters.add(len(caption))
+        tokens.add(len(tokenize(caption)))
+        per_image[image_name] += 1
+
+    if captions_file.endswith(".json"):
+        with open(captions_file, "r", encoding="utf-8") as file:
+            for image_name, captions in json.load(file).items():
+                for caption in captions:
+                    add_caption(image_name, caption)
+    else:
+        # streaming the file in binary mode to record the offset of each line
+        with open(captions_file, "rb") as file:
+            offset = 0
+            for line in file:
+                text = line.decode("utf-8").strip()
+                if text and "," in text and text != "image,caption":  # skipping the header
+                    image_name, caption = text.split(",", 1)
+                    add_caption(image_name, caption)
+                    caption_offsets.setdefault(image_name, []).append(offset)
+                offset += len(line)
+
+    captions_per_image = Histogram()
+    for count in per_image.values():
+        captions_per_image.add(count)
+    known = valid | corrupt
+    return {
+        "captions": {
+            "count": sum(per_image.values()),
+            "characters": characters.summary(),
+            "tokens": tokens.summary(),
+            "per_image": captions_per_image.summary(),
+        },
+        "missing": sorted(name for name in per_image if name not in known),
+        "uncaptioned": sorted(name for name in valid if name not in per_image),
+        "caption_offsets": caption_offsets,
+    }
+
+
+################################################################################################
+
+"""
+This function reads the captions of some images from a captions .txt file, using the
+byte offsets recorded by profile_dataset (only the wanted lines are read).
+Args:
+    captions_file: str; the path to the captions .txt file
+    summary: dict; the result of profile_dataset
+    image_names: list; the wanted images
+"""
+
+
+def read_captions(captions_file: str, summary: dict, image_names: list) -> dict:
+    captions = {}
+    with open(captions_file, "rb") as file:
+        for image_name in image_names:
+            captions[image_name] = []
+            for offset in summary.get("caption_offsets", {}).get(image_name, []):
+                file.seek(offset)
+                line = file.readline().decode("utf-8").strip()
+                captions[image_name].append(line.split(",", 1)[1])
+    return captions
+
+
+################################################################################################
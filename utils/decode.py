@@ -0,0 +1,349 @@
+import warnings, torch, torch.nn.functional as F
+
+# the batched decoders only check whether all the captions are finished every
+# _CHECK_EVERY steps: the check reads a flag on the host, which waits for the device
+_CHECK_EVERY = 8
+
+"""
+This function generates the caption of one image greedily with the incremental
+decoder of ImageCaptioningModel (init_state / step): the image projection is
+computed once and the LSTM state is carried from one token to the next.
+Args:
+    model: ImageCaptioningModel; the trained model
+    features: torch.Tensor; the feature vector of the image, shape (2048,) or (1, 2048)
+    max_length: int; the maximum number of generated tokens
+    start_id: int; the index of the start token (e.g. word_to_int["startseq"])
+    end_id: int=None; the index of the end token, generation stops after it
+Returns:
+    the list of generated token indices (without the start token, with the end token)
+"""
+
+
+@torch.no_grad()
+def generate(model, features, max_length: int, start_id: int, end_id: int = None) -> list:
+    tokens, lengths = greedy_decode(
+        model, torch.as_tensor(features).reshape(1, -1), max_length, start_id, end_id
+    )
+    return tokens[0, : lengths[0]].tolist()
+
+
+################################################################################################
+
+"""
+This function converts a list of token indices into a caption string,
+dropping the start and end tokens.
+Args:
+    token_ids: list; the token indices
+    int_to_word: dict; the mapping from the indices to the words
+    special_words: tuple=("startseq", "endseq"); the words that are removed
+"""
+
+
+def tokens_to_caption(
+    token_ids: list, int_to_word: dict, special_words: tuple = ("startseq", "endseq")
+) -> str:
+    words = []
+    for token_id in token_ids:
+        word = int_to_word[int(token_id)]
+        if word == special_words[-1]:  # stopping at the end token
+            break
+        if word not in special_words:
+            words.append(word)
+    return " ".join(words)
+
+
+################################################################################################
+
+"""
+This function checks that a model can be decoded incrementally (greedy_decode,
+beam_search, sample_decode, utils.export). The incremental decoder starts from a zero
+LSTM state and feeds one token at a time, which is what the model sees when it is
+trained with teacher forcing (CaptionSequenceDataset). A model trained on left-padded
+prefixes (CaptionPrefixDataset) always runs the padding steps first, so its captions
+would be decoded from states it never saw during training: it is refused. The mode of
+a model loaded from an older state dict is unknown: a warning is given, and setting
+model.training_mode = "teacher_forcing" marks a model known to be trained that way.
+"""
+
+
+def check_incremental_decoding(model) -> None:
+    mode = getattr(model, "training_mode", "untrained")
+    if mode == "prefixes":
+        raise ValueError(
+            "This model was trained on left-padded prefixes (CaptionPrefixDataset), "
+            "it cannot be decoded incrementally. Train it with teacher forcing "
+            "(CaptionSequenceDataset) instead."
+        )
+    if mode == "unknown":
+        warnings.warn(
+            "The training mode of this model is unknown (a state dict saved without it): "
+            "if it was trained on left-padded prefixes (CaptionPrefixDataset), its "
+            "captions are wrong. Retrain it with teacher forcing, or set "
+            'model.training_mode = "teacher_forcing" if it was trained that way.',
+            stacklevel=3,
+        )
+
+
+################################################################################################
+
+"""
+This function decodes the captions of a batch of images greedily, all at once:
+one batched step of the model per generated token, with the finished captions
+tracked by a boolean mask (no host synchronization per image or per token). Whether
+all the captions are finished is only checked every _CHECK_EVERY steps, and the extra
+padding columns are trimmed at the end.
+Args:
+    model: ImageCaptioningModel; the trained model
+    features: torch.Tensor; the feature vectors, shape (batch, 2048)
+    max_length: int; the maximum number of generated tokens
+    start_id: int; the index of the start token
+    end_id: int=None; the index of the end token
+    pad_id: int=0; the index written after the end of the finished captions
+Returns:
+    the generated tokens (batch, length) and the length of each caption (batch,),
+    which counts the end token
+"""
+
+
+@torch.no_grad()
+def greedy_decode(
+    model, features, max_length: int, start_id: int, end_id: int = None, pad_id: int = 0
+):
+    check_incremental_decoding(model)
+    model.eval()
+    features = torch.as_tensor(features, dtype=torch.float32, device=model.device)
+    batch_size = features.size(0)
+    state = model.init_state(features)
+    tokens = torch.full((batch_size,), start_id, dtype=torch.long, device=model.device)
+    finished = torch.zeros(batch_size, dtype=torch.bool, device=model.device)
+    lengths = torch.zeros(batch_size, dtype=torch.long, device=model.device)
+
+    outputs = []
+    for step in range(max_length):
+        tokens, state = model.predict_step(state, tokens)
+        tokens = tokens.masked_fill(finished, pad_id)
+        outputs.append(tokens)
+        lengths += (~finished).long()
+        if end_id is not None:
+            finished |= tokens == end_id
+            if step % _CHECK_EVERY == _CHECK_EVERY - 1 and finished.all():
+                break
+
+    return _trim(torch.stack(outputs, dim=1), lengths), lengths
+
+
+################################################################################################
+
+"""
+This function decodes the captions of a batch of images with beam search.
+The beams of all the images are decoded together, as batch * beam_width rows,
+and the finished beams are tracked with a boolean mask: they are only extended
+with pad_id at no cost, and they keep competing with the live beams.
+The beams are ranked with the GNMT length penalty: score / ((5 + length) / 6) ** alpha.
+Args:
+    model: ImageCaptioningModel; the trained model
+    features: torch.Tensor; the feature vectors, shape (batch, 2048)
+    max_length: int; the maximum number of generated tokens
+    start_id: int; the index of the start token
+    end_id: int=None; the index of the end token
+    beam_width: int=3; the number of beams kept per image
+    length_penalty: float=0.0; the alpha of the length penalty (0 means no penalty)
+    pad_id: int=0; the index written after the end of the finished captions
+Returns:
+    the tokens of the best beam of each image (batch, length) and their lengths (batch,)
+"""
+
+
+@torch.no_grad()
+def beam_search(
+    model,
+    features,
+    max_length: int,
+    start_id: int,
+    end_id: int = None,
+    beam_width: int = 3,
+    length_penalty: float = 0.0,
+    pad_id: int = 0,
+):
+    check_incremental_decoding(model)
+    model.eval()
+    features = torch.as_tensor(features, dtype=torch.float32, device=model.device)
+    batch_size, device = features.size(0), model.device
+
+    def penalty(lengths):
+        return ((5.0 + lengths.float()) / 6.0) ** length_penalty
+
+    # decoding the beam_width beams of every image as a batch of batch * beam_width rows
+    x1, h, c = model.init_state(features)
+    state = (
+        x1.repeat_interleave(beam_width, dim=0),
+        h.repeat_interleave(beam_width, dim=1),
+        c.repeat_interleave(beam_width, dim=1),
+    )
+    tokens = torch.full((batch_size * beam_width,), start_id, dtype=torch.long, device=device)
+
+    # only the first beam is alive at the start, so that the beams are not duplicates
+    scores = torch.full((batch_size, beam_width), float("-inf"), device=device)
+    scores[:, 0] = 0.0
+    finished = torch.zeros(batch_size, beam_width, dtype=torch.bool, device=device)
+    lengths = torch.zeros(batch_size, beam_width, dtype=torch.long, device=device)
+    history = torch.zeros(batch_size, beam_width, 0, dtype=torch.long, device=device)
+    batch_offsets = torch.arange(batch_size, device=device).unsqueeze(1) * beam_width
+
+    for step in range(max_length):
+        logits, state = model.step(state, tokens)
+        log_probs = F.log_softmax(logits.float(), dim=-1).view(batch_size, beam_width, -1)
+        vocabulary_size = log_probs.size(-1)
+
+        # a finished beam can only be continued with pad_id, without changing its score
+        finished_log_probs = torch.full_like(log_probs[0, 0], float("-inf"))
+        finished_log_probs[pad_id] = 0.0
+        log_probs = torch.where(finished.unsqueeze(-1), finished_log_probs, log_probs)
+
+        candidates = scores.unsqueeze(-1) + log_probs  # (batch, beam, vocabulary)
+        new_lengths = (lengths + (~finished).long()).unsqueeze(-1)
+        ranking = candidates / penalty(new_lengths)
+
+        _, top_indices = ranking.view(batch_size, -1).topk(beam_width, dim=-1)
+        beam_indices = top_indices // vocabulary_size
+        token_indices = top_indices % vocabulary_size
+
+        scores = candidates.view(batch_size, -1).gather(1, top_indices)
+        lengths = new_lengths.squeeze(-1).gather(1, beam_indices)
+        finished = finished.gather(1, beam_indices)
+        if end_id is not None:
+            finished = finished | (token_indices == end_id)
+        history = torch.cat(
+            (
+                history.gather(1, beam_indices.unsqueeze(-1).expand_as(history)),
+                token_indices.unsqueeze(-1),
+            ),
+            dim=-1,
+        )
+
+        # reordering the LSTM states of the rows to follow their beams
+        rows = (batch_offsets + beam_indices).view(-1)
+        x1, h, c = state
+        state = (x1.index_select(0, rows), h.index_select(1, rows), c.index_select(1, rows))
+        tokens = token_indices.view(-1)
+
+        check = step % _CHECK_EVERY == _CHECK_EVERY - 1
+        if end_id is not None and check and finished.all():
+            break
+
+    best = (scores / penalty(lengths)).argmax(dim=-1)
+    batch_indices = torch.arange(batch_size, device=device)
+    lengths = lengths[batch_indices, best]
+    return _trim(history[batch_indices, best], lengths), lengths
+
+
+def _trim(tokens, lengths):
+    # removing the padding columns decoded after the last caption was finished
+    return tokens[:, : int(lengths.max())] if len(lengths) else tokens
+
+
+################################################################################################
+
+"""
+This function samples the captions of a batch of images, with optional top-k and
+top-p (nucleus) filtering of the distribution of each token.
+Args:
+    model: ImageCaptioningModel; the trained model
+    features: torch.Tensor; the feature vectors, shape (batch, 2048)
+    max_length: int; the maximum number of generated tokens
+    start_id: int; the index of the start token
+    end_id: int=None; the index of the end token
+    temperature: float=1.0; the temperature applied to the logits
+    top_k: int=None; only sampling among the k most likely tokens
+    top_p: float=None; only sampling among the most likely tokens whose probabilities
+        add up to top_p
+    generator: torch.Generator=None; the random generator (for reproducibility)
+    pad_id: int=0; the index written after the end of the finished captions
+Returns:
+    the generated tokens (batch, length) and the length of each caption (batch,)
+"""
+
+
+@torch.no_grad()
+def sample_decode(
+    model,
+    features,
+    max_length: int,
+    start_id: int,
+    end_id: int = None,
+    temperature: float = 1.0,
+    top_k: int = None,
+    top_p: float = None,
+    generator: torch.Generator = None,
+    pad_id: int = 0,
+):
+    check_incremental_decoding(model)
+    model.eval()
+    features = torch.as_tensor(features, dtype=torch.float32, device=model.device)
+    batch_size = features.size(0)
+    state = model.init_state(features)
+    tokens = torch.full((batch_size,), start_id, dtype=torch.long, device=model.device)
+    finished = torch.zeros(batch_size, dtype=torch.bool, device=model.device)
+    lengths = torch.zeros(batch_size, dtype=torch.long, device=model.device)
+
+    outputs = []
+    for step in range(max_length):
+        logits, state = model.step(state, tokens)
+        logits = filter_logits(logits.float() / temperature, top_k, top_p)
+        probabilities = F.softmax(logits, dim=-1)
+        tokens = torch.multinomial(probabilities, 1, generator=generator).squeeze(1)
+        tokens = tokens.masked_fill(finished, pad_id)
+        outputs.append(tokens)
+        lengths += (~finished).long()
+        if end_id is not None:
+            finished |= tokens == end_id
+            if step % _CHECK_EVERY == _CHECK_EVERY - 1 and finished.all():
+                break
+
+    return _trim(torch.stack(outputs, dim=1), lengths), lengths
+
+
+################################################################################################
+
+"""
+This function sets to -inf the logits that are outside of the top-k tokens or of
+the top-p nucleus (the most likely token is always kept).
+"""
+
+
+def filter_logits(logits, top_k: int = None, top_p: float = None):
+    if top_k is not None and top_k < logits.size(-1):
+        kth_values = logits.topk(top_k, dim=-1).values[..., -1:]
+        logits = logits.masked_fill(logits < kth_values, float("-inf"))
+
+    if top_p is not None and top_p < 1.0:
+        sorted_logits, sorted_indices = logits.sort(dim=-1, descending=True)
+        cumulated = F.softmax(sorted_logits, dim=-1).cumsum(dim=-1)
+        # removing a token if the tokens before it already reach top_p
+        sorted_removed = cumulated - F.softmax(sorted_logits, dim=-1) >= top_p
+        removed = sorted_removed.scatter(-1, sorted_indices, sorted_removed)
+        logits = logits.masked_fill(removed, float("-inf"))
+
+    return logits
+
+
+################################################################################################
+
+"""
+This function converts the outputs of the batched decoders into caption strings.
+Args:
+    tokens: torch.Tensor; the generated tokens (batch, length)
+    lengths: torch.Tensor; the length of each caption (batch,)
+    int_to_word: dict; the mapping from the indices to the words
+"""
+
+
+def batch_to_captions(tokens, lengths, int_to_word: dict) -> list:
+    tokens, lengths = tokens.tolist(), lengths.tolist()  # one host transfer for the batch
+    return [
+        tokens_to_caption(caption[:length], int_to_word)
+        for caption, length in zip(tokens, lengths)
+    ]
+
+
+################################################################################################
@@ -0,0 +1,146 @@
+import os, json, time, argparse, numpy as np, torch
+from utils.export import load_model, decode
+from utils.metrics import corpus_bleu, cider_d
+from utils.vocabulary import Vocabulary, tokenize, START, END
+
+"""
+This function evaluates a captioning model on a whole split: the captions of all the
+images are generated in batches (greedy decoding, or beam search if beam_width > 1),
+then the corpus BLEU-1..4 and CIDEr-D scores are computed against the reference captions
+with the vectorized metrics of utils.metrics. The report can be saved as JSON, e.g. after
+every checkpoint, to follow the quality of the model during training.
+Args:
+    model: ImageCaptioningModel (or ExportedCaptioningModel); the model to evaluate
+    features: dict or FeatureStore; the feature vector of each image
+    captions: dict; the reference captions of each image, e.g. test_captions
+    vocabulary: Vocabulary or dict; the vocabulary (or word_to_int) of the model
+    max_length: int; the maximum number of generated tokens
+    batch_size: int=256; the number of images decoded together
+    beam_width: int=1; the beam width (greedy decoding if 1)
+    report_path: str=None; where the report is saved as JSON (not saved if None)
+    n_examples: int=10; the number of generated captions written in the report
+Returns:
+    the report (dict) with the scores, the decoding time and some example captions
+"""
+
+
+def evaluate(
+    model,
+    features,
+    captions: dict,
+    vocabulary,
+    max_length: int,
+    batch_size: int = 256,
+    beam_width: int = 1,
+    report_path: str = None,
+    n_examples: int = 10,
+) -> dict:
+    if not isinstance(vocabulary, Vocabulary):
+        vocabulary = Vocabulary.from_dict(vocabulary)
+    names = [name for name in captions if name in features]
+    if len(names) < len(captions):
+        print(f"{len(captions) - len(names)} images have no feature vector, skipping them")
+
+    # generating all the captions, one batch of images at a time
+    generated, decode_seconds = [], 0.0
+    for start in range(0, len(names), batch_size):
+        batch = np.stack(
+            [np.asarray(features[name]) for name in names[start : start + batch_size]]
+        )
+        batch = torch.as_tensor(batch, dtype=torch.float32)
+        begin = time.perf_counter()
+        tokens, lengths = decode(model, batch, vocabulary, max_length, beam_width)
+        tokens, lengths = tokens.tolist(), lengths.tolist()
+        decode_seconds += time.perf_counter() - begin
+        generated.extend(
+            vocabulary.decode(caption[:length]) for caption, length in zip(tokens, lengths)
+        )
+
+    # the reserved words (start and end tokens) are not part of the compared captions
+    reserved = set(vocabulary.reserved) | {START, END}
+    references = [
+        [
+            [word for word in tokenize(caption) if word not in reserved]
+            for caption in captions[name]
+        ]
+        for name in names
+    ]
+    hypotheses = [caption.split() for caption in generated]
+
+    begin = time.perf_counter()
+    report = {"images": len(names), "beam_width": beam_width}
+    report.update(corpus_bleu(references, hypotheses))
+    report["cider_d"], _ = cider_d(references, hypotheses)
+    report["metric_seconds"] = time.perf_counter() - begin
+    report["decode_seconds"] = decode_seconds
+    report["images_per_second"] = len(names) / max(decode_seconds, 1e-9)
+    report["examples"] = {
+        name: {"generated": caption, "references": captions[name]}
+        for name, caption in zip(names[:n_examples], generated[:n_examples])
+    }
+
+    if report_path is not None:
+        os.makedirs(os.path.dirname(report_path) or ".", exist_ok=True)
+        with open(report_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+################################################################################################
+
+"""
+Command line entry point: evaluates a trained state dict (or an artifact of utils.export)
+on a split and prints the report. --features is a FeatureStore or the FeatureCache of
+the notebook (with --images, the folder of the images of the split).
+    python -m utils.evaluate --model model_2.pth --vocab data/vocabulary.json
+        --max-length 35 --features data/feature_cache --images data/split_dataset/test
+        --captions data/split_dataset/test/image_captions.json --report data/evaluation.json
+"""
+
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description="Evaluate a captioning model.")
+    parser.add_argument("--model", required=True, help="state dict or exported artifact")
+    parser.add_argument("--vocab", default=None, help="saved Vocabulary or word_to_int JSON")
+    parser.add_argument("--max-length", type=int, default=None)
+    parser.add_argument("--embedding-dim", type=int, default=200)
+    parser.add_argument("--adaptive-cutoffs", type=int, nargs="+", default=None)
+    parser.add_argument("--features", required=True, help="FeatureStore or FeatureCache")
+    parser.add_argument("--images", default=None, help="images folder (FeatureCache)")
+    parser.add_argument("--captions", required=True, help="JSON file of reference captions")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--beam-width", type=int, default=1)
+    parser.add_argument("--report", default=None, help="path of the JSON report")
+    parser.add_argument("--device", default=None)
+    args = parser.parse_args(argv)
+    if args.vocab is not None and args.max_length is None:
+        parser.error("--max-length is required with --vocab")
+
+    from utils.extract import open_features
+
+    model, vocabulary, max_length = load_model(
+        args.model,
+        args.vocab,
+        args.max_length,
+        args.embedding_dim,
+        args.adaptive_cutoffs,
+        args.device,
+    )
+    with open(args.captions, "r", encoding="utf-8") as f:
+        captions = json.load(f)
+    report = evaluate(
+        model,
+        open_features(args.features, list(captions), args.images),
+        captions,
+        vocabulary,
+        max_length,
+        args.batch_size,
+        args.beam_width,
+        args.report,
+    )
+    report.pop("examples")
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
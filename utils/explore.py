@@ -1,5 +1,6 @@
 import os, json, random, textwrap, matplotlib.pyplot as plt, numpy as np
 from PIL import Image
+from utils.dataset_stats import profile_dataset, read_captions
 
 """
 This function displays the image of a certain index in an image dictionary
@@ -62,41 +63,33 @@ def get_captions(image_captions: dict, index: int) -> list:
 
 """
 This function displays 9 random images that are stored in an image_folder and their captions.
+The list of images and the position of their captions come from the cached summary
+of utils.dataset_stats.profile_dataset, so only the 9 images and their captions are read.
 Args:
     image_folder: str; the path to the folder containing the images
     captions_file: str; the path to the file containing the wanted captions
+    summary_path: str=None; the path of the cached summary (see profile_dataset)
 """
 
 
-def explore_dataset(image_folder: str, captions_file: str) -> None:
-    captions = {}
-
-    if captions_file.endswith(
-        ".txt"
-    ):  # determining the file type and read the captions file accordingly
-        with open(captions_file, "r") as file:
-            for line in file:
-                image_name, caption = line.strip().split(",", 1)
-                if image_name not in captions:
-                    captions[image_name] = []
-                captions[image_name].append(caption)
-    elif captions_file.endswith(".json"):
-        with open(captions_file, "r") as file:
-            captions = json.load(file)
-    else:
+def explore_dataset(image_folder: str, captions_file: str, summary_path: str = None) -> None:
+    if not captions_file.endswith((".txt", ".json")):
         raise ValueError("Unsupported captions file format. Please use .txt or .json.")
+    summary = profile_dataset(image_folder, captions_file, summary_path)
 
-    # getting a list of all image files in the folder
-    image_files = [
-        f
-        for f in os.listdir(image_folder)
-        if f.lower().endswith((".png", ".jpg", ".jpeg", ".bmp", ".gif"))
-    ]
+    # getting the list of all image files in the folder from the summary
+    image_files = summary["filenames"]
 
     if len(image_files) < 9:  # checking if there are at least 9 images in the folder
         print("Not enough images in the folder to create a 3x3 subplot.")
     else:
         selected_images = random.sample(image_files, 9)  # selecting 9 random images
+        if captions_file.endswith(".txt"):  # only reading the captions of these images
+            captions = read_captions(captions_file, summary, selected_images)
+        else:
+            with open(captions_file, "r") as file:
+                captions = json.load(file)
+
         fig, axes = plt.subplots(3, 3, figsize=(15, 15))  # creating a 3x3 subplot
         axes = axes.flatten()
 
@@ -140,39 +133,44 @@ def explore_dataset(image_folder: str, captions_file: str) -> None:
 This function provides some descriptive statistics about the dataset:
 - information about the image sizes
 - a plot representing the images' widths and heights
+The sizes are read from the image headers (no decoding) and cached, see
+utils.dataset_stats.profile_dataset.
 Args:
 image_folder: str; the path to the folder containing all images
+captions_file: str=None; the path to the captions file, for the caption statistics
+summary_path: str=None; the path of the cached summary
 """
 
 
-def get_descriptive_statistics(image_folder: str):
-    widths, heights = [], []  # lists to store width and height of images
-    image_count = 0  # counting the number of images and collect width and height
-    for filename in os.listdir(image_folder):
-        if filename.lower().endswith((".png", ".jpg", ".jpeg", ".bmp", ".gif")):
-            image_path = os.path.join(image_folder, filename)
-            with Image.open(image_path) as img:
-                width, height = img.size
-                widths.append(width)
-                heights.append(height)
-                image_count += 1
-
-    # calculating maximum, minimum, and mean sizes
-    max_width = np.max(widths)
-    min_width = np.min(widths)
-    mean_width = np.mean(widths)
-
-    max_height = np.max(heights)
-    min_height = np.min(heights)
-    mean_height = np.mean(heights)
+def get_descriptive_statistics(
+    image_folder: str, captions_file: str = None, summary_path: str = None
+):
+    summary = profile_dataset(image_folder, captions_file, summary_path)
+    width, height = summary["images"]["width"], summary["images"]["height"]
+    image_count = summary["images"]["count"]
 
     print(f"Number of images: {image_count}")  # printing the results
-    print(f"Max width: {max_width}, Min width: {min_width}, Mean width: {mean_width}")
+    print(f"Max width: {width['max']}, Min width: {width['min']}, Mean width: {width['mean']}")
     print(
-        f"Max height: {max_height}, Min height: {min_height}, Mean height: {mean_height}"
+        f"Max height: {height['max']}, Min height: {height['min']}, Mean height: {height['mean']}"
     )
-
-    plt.scatter(widths, heights, alpha=0.5)  # creating a scatter plot
+    print(f"Median aspect ratio: {summary['images']['aspect_ratio'].get('p50')}")
+    if summary["corrupt"]:
+        print(f"Corrupt images: {len(summary['corrupt'])}")
+    if "captions" in summary:
+        tokens = summary["captions"]["tokens"]
+        print(f"Number of captions: {summary['captions']['count']}")
+        print(
+            f"Tokens per caption: min {tokens['min']}, median {tokens['p50']}, "
+            f"p95 {tokens['p95']}, max {tokens['max']}"
+        )
+        print(f"Missing images: {len(summary['missing'])}")
+
+    # one point per distinct size, its area growing with the number of images
+    sizes = [tuple(map(int, size.split("x"))) for size in summary["images"]["sizes"]]
+    counts = np.array(list(summary["images"]["sizes"].values()))
+    widths, heights = [w for w, _ in sizes], [h for _, h in sizes]
+    plt.scatter(widths, heights, s=10 * np.sqrt(counts), alpha=0.5)  # creating a scatter plot
     plt.xlabel("Width")
     plt.ylabel("Height")
     plt.title("Scatter Plot of Image Sizes")
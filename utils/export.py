@@ -0,0 +1,422 @@
+import os, copy, json, time, argparse, numpy as np, torch
+import torch.nn as nn
+from utils.model import ImageCaptioningModel
+from utils.decode import greedy_decode, beam_search, check_incremental_decoding
+from utils.vocabulary import Vocabulary, tokenize, START, END
+from utils.metrics import corpus_bleu, token_agreement
+from utils.features import INCEPTION_V3_ID
+
+"""
+This function builds a dynamically quantized copy of an ImageCaptioningModel for CPU
+inference: the weights of the Linear layers (fc1, fc2, fc3 or the adaptive softmax)
+and of the LSTM are stored in int8, and the activations are quantized on the fly.
+The embedding layer is kept in float32. The original model is not modified.
+Args:
+    model: ImageCaptioningModel; the trained float32 model
+"""
+
+
+def quantize_model(model: ImageCaptioningModel) -> ImageCaptioningModel:
+    quantized = copy.deepcopy(model).cpu().eval()
+    quantized = torch.ao.quantization.quantize_dynamic(
+        quantized, {nn.Linear, nn.LSTM}, dtype=torch.qint8
+    )
+    quantized.device = "cpu"
+    return quantized
+
+
+################################################################################################
+
+"""
+This module exposes the incremental decoder of an ImageCaptioningModel with plain
+tensor inputs and outputs, so that it can be traced: init_state(features) returns
+(x1, h, c) and forward(x1, h, c, tokens) returns (logits, h, c).
+"""
+
+
+class _StepDecoder(nn.Module):
+    def __init__(self, model: ImageCaptioningModel):
+        super().__init__()
+        self.model = model
+
+    def init_state(self, features):
+        return self.model.init_state(features)
+
+    def forward(self, x1, h, c, tokens):
+        logits, (_, h, c) = self.model.step((x1, h, c), tokens)
+        return logits, h, c
+
+
+################################################################################################
+
+"""
+This function traces the incremental decoder of a model (float32 or quantized) with
+TorchScript and saves it as a self-contained artifact: the vocabulary and the decoding
+settings are stored in the same file (as TorchScript extra files), so the artifact can
+be loaded with load_exported without the notebook's word_to_int or max_length.
+A CPU copy of the model is traced, the given model is not modified.
+Args:
+    model: ImageCaptioningModel; the model to export (use quantize_model for int8)
+    vocabulary: Vocabulary or dict; the vocabulary (or word_to_int) of the model
+    max_length: int; the maximum number of generated tokens
+    filepath: str; where the artifact is saved, e.g. models/model_int8.pt
+    extractor_id: str=None; the identity of the image feature extractor, for reference
+"""
+
+
+def export_model(
+    model: ImageCaptioningModel,
+    vocabulary,
+    max_length: int,
+    filepath: str,
+    extractor_id: str = None,
+) -> None:
+    check_incremental_decoding(model)  # the artifact only has the incremental decoder
+    if not isinstance(vocabulary, Vocabulary):
+        vocabulary = Vocabulary.from_dict(vocabulary)
+    model = copy.deepcopy(model).cpu().eval()
+    model.device = "cpu"
+    decoder = _StepDecoder(model).eval()
+
+    # example inputs for the trace (the shapes stay dynamic in the traced graph)
+    features = torch.zeros(2, model.fc1.in_features)
+    with torch.no_grad():
+        x1, h, c = model.init_state(features)
+        tokens = torch.zeros(2, dtype=torch.long)
+        traced = torch.jit.trace_module(
+            decoder, {"init_state": (features,), "forward": (x1, h, c, tokens)}
+        )
+
+    config = {
+        "max_length": max_length,
+        "start_id": vocabulary.word_to_int.get("startseq", 0),
+        "end_id": vocabulary.word_to_int.get("endseq"),
+        "pad_id": vocabulary.pad_id,
+        "vocabulary_size": len(vocabulary),
+        "feature_dim": model.fc1.in_features,
+        "adaptive": model.adaptive,
+        "quantized": _is_quantized(model),
+        "training_mode": model.training_mode,
+        "extractor": extractor_id,
+    }
+    os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+    torch.jit.save(
+        traced,
+        filepath,
+        _extra_files={
+            "config.json": json.dumps(config),
+            "vocabulary.json": json.dumps(vocabulary.to_dict()),
+        },
+    )
+
+
+def _is_quantized(model: nn.Module) -> bool:
+    return any("quantized" in type(module).__module__ for module in model.modules())
+
+
+################################################################################################
+
+"""
+This class wraps an artifact saved by export_model. It has the incremental decoding
+interface of ImageCaptioningModel (init_state, step, predict_step), so the decoders of
+utils.decode (greedy_decode, beam_search, sample_decode) work with it unchanged.
+Use load_exported(filepath) to build it.
+Args:
+    module: torch.jit.ScriptModule; the traced decoder
+    vocabulary: Vocabulary; the vocabulary of the model
+    config: dict; the decoding settings saved with the artifact
+"""
+
+
+class ExportedCaptioningModel:
+    def __init__(self, module, vocabulary: Vocabulary, config: dict):
+        self.module = module
+        self.vocabulary = vocabulary
+        self.config = config
+        self.device = "cpu"
+        self.max_length = config["max_length"]
+        self.start_id, self.end_id = config["start_id"], config["end_id"]
+        # checked by the decoders, as for ImageCaptioningModel
+        self.training_mode = config.get("training_mode", "unknown")
+
+    def eval(self) -> "ExportedCaptioningModel":
+        self.module.eval()
+        return self
+
+    def init_state(self, features):
+        return self.module.init_state(features)
+
+    def step(self, state, tokens):
+        logits, h, c = self.module(state[0], state[1], state[2], tokens)
+        return logits, (state[0], h, c)
+
+    def predict_step(self, state, tokens):
+        logits, state = self.step(state, tokens)
+        return logits.argmax(dim=-1), state
+
+    # Captioning a batch of image features greedily.
+    @torch.no_grad()
+    def caption(self, features) -> list:
+        tokens, lengths = greedy_decode(
+            self,
+            features,
+            self.max_length,
+            self.start_id,
+            self.end_id,
+            self.config["pad_id"],
+        )
+        tokens, lengths = tokens.tolist(), lengths.tolist()
+        return [
+            self.vocabulary.decode(caption[:length])
+            for caption, length in zip(tokens, lengths)
+        ]
+
+
+def load_exported(filepath: str) -> ExportedCaptioningModel:
+    extra_files = {"config.json": "", "vocabulary.json": ""}
+    module = torch.jit.load(filepath, map_location="cpu", _extra_files=extra_files)
+    config = json.loads(extra_files["config.json"])
+    vocabulary = Vocabulary.from_dict(json.loads(extra_files["vocabulary.json"]))
+    return ExportedCaptioningModel(module, vocabulary, config).eval()
+
+
+################################################################################################
+
+"""
+This function loads a captioning model for inference, the same way for all the command
+line tools (evaluate, export, batch_caption, serve): either an artifact of export_model,
+which holds its vocabulary and max_length, or a state dict of ImageCaptioningModel with
+its vocabulary and max_length.
+Args:
+    model_path: str; the exported artifact, or the state dict
+    vocabulary: str, Vocabulary or dict=None; the vocabulary of a state dict (a saved
+        Vocabulary or word_to_int JSON file, or the object), None for an artifact
+    max_length: int=None; the maximum number of generated tokens (required with a state
+        dict, replaces the one of an artifact if given)
+    embedding_dim: int=200; the embedding dimension of a state dict
+    adaptive_cutoffs: list=None; the adaptive softmax cutoffs of a state dict
+    device: str=None; the torch device of a state dict (cuda if available by default,
+        an artifact runs on the CPU)
+Returns:
+    (model, vocabulary, max_length), with the model in evaluation mode
+"""
+
+
+def load_model(
+    model_path: str,
+    vocabulary=None,
+    max_length: int = None,
+    embedding_dim: int = 200,
+    adaptive_cutoffs: list = None,
+    device: str = None,
+) -> tuple:
+    if vocabulary is None:  # an exported artifact holds its vocabulary
+        model = load_exported(model_path)
+        return model, model.vocabulary, max_length or model.max_length
+    if max_length is None:
+        raise ValueError("max_length is required to load a state dict.")
+
+    if isinstance(vocabulary, str):
+        vocabulary = Vocabulary.load(vocabulary)
+    elif not isinstance(vocabulary, Vocabulary):
+        vocabulary = Vocabulary.from_dict(vocabulary)
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+    model = ImageCaptioningModel(
+        (299, 299),
+        len(vocabulary),
+        embedding_dim,
+        device,
+        adaptive_cutoffs=adaptive_cutoffs,
+    )
+    model.load_state_dict(torch.load(model_path, map_location=device))
+    model.to(device).eval()
+    return model, vocabulary, max_length
+
+
+"""
+This function decodes the captions of a batch of feature vectors with a model loaded by
+load_model: greedy decoding, or beam search if beam_width > 1.
+Args:
+    model: ImageCaptioningModel or ExportedCaptioningModel; the captioning model
+    features: torch.Tensor or np.ndarray; the feature vectors, shape (batch, feature_dim)
+    vocabulary: Vocabulary; the vocabulary of the model (start, end and padding tokens)
+    max_length: int; the maximum number of generated tokens
+    beam_width: int=1; greedy decoding if 1, beam search otherwise
+Returns:
+    the generated tokens (batch, length) and the length of each caption (batch,)
+"""
+
+
+@torch.no_grad()
+def decode(model, features, vocabulary: Vocabulary, max_length: int, beam_width: int = 1):
+    start_id = vocabulary.word_to_int.get("startseq", 0)
+    end_id = vocabulary.word_to_int.get("endseq")
+    if beam_width > 1:
+        return beam_search(
+            model,
+            features,
+            max_length,
+            start_id,
+            end_id,
+            beam_width=beam_width,
+            pad_id=vocabulary.pad_id,
+        )
+    return greedy_decode(model, features, max_length, start_id, end_id, vocabulary.pad_id)
+
+
+################################################################################################
+
+"""
+This function compares two models (e.g. the float32 model and its int8 export) on a set
+of images: both decode the same features greedily, in batches, and the report gives
+the corpus BLEU-1..4 of each model against the reference captions, the agreement of
+their tokens and their decoding time.
+Args:
+    reference_model: ImageCaptioningModel or ExportedCaptioningModel; the float32 model
+    candidate_model: ImageCaptioningModel or ExportedCaptioningModel; the faster model
+    features: dict or FeatureStore; the feature vector of each image
+    captions: dict; the reference captions of each image (the images of the report)
+    vocabulary: Vocabulary or dict; the vocabulary (or word_to_int) of the models
+    max_length: int; the maximum number of generated tokens
+    batch_size: int=64; the number of images decoded together
+    report_path: str=None; where the report is saved as JSON (not saved if None)
+"""
+
+
+def parity_report(
+    reference_model,
+    candidate_model,
+    features,
+    captions: dict,
+    vocabulary,
+    max_length: int,
+    batch_size: int = 64,
+    report_path: str = None,
+) -> dict:
+    if not isinstance(vocabulary, Vocabulary):
+        vocabulary = Vocabulary.from_dict(vocabulary)
+    names = [name for name in captions if name in features]
+    # the start and end tokens are not part of the compared captions
+    special_words = set(vocabulary.reserved) | {START, END}
+    references = [
+        [
+            [word for word in tokenize(caption) if word not in special_words]
+            for caption in captions[name]
+        ]
+        for name in names
+    ]
+
+    outputs = {}
+    for key, model in (("reference", reference_model), ("candidate", candidate_model)):
+        tokens, lengths, elapsed = [], [], 0.0
+        for start in range(0, len(names), batch_size):
+            batch = np.stack(
+                [np.asarray(features[name]) for name in names[start : start + batch_size]]
+            )
+            batch = torch.as_tensor(batch, dtype=torch.float32)
+            begin = time.perf_counter()
+            batch_tokens, batch_lengths = decode(model, batch, vocabulary, max_length)
+            elapsed += time.perf_counter() - begin
+            # padding to max_length so that the batches can be concatenated
+            batch_tokens = batch_tokens.cpu().numpy()
+            tokens.append(
+                np.pad(
+                    batch_tokens,
+                    ((0, 0), (0, max_length - batch_tokens.shape[1])),
+                    constant_values=vocabulary.pad_id,
+                )
+            )
+            lengths.append(batch_lengths.cpu().numpy())
+        outputs[key] = (np.concatenate(tokens), np.concatenate(lengths), elapsed)
+
+    report = {"images": len(names)}
+    for key, (tokens, lengths, elapsed) in outputs.items():
+        hypotheses = [
+            vocabulary.decode(caption[:length]).split()
+            for caption, length in zip(tokens, lengths)
+        ]
+        report[key] = corpus_bleu(references, hypotheses)
+        report[key]["decode_seconds"] = elapsed
+        report[key]["images_per_second"] = len(names) / max(elapsed, 1e-9)
+    report.update(
+        token_agreement(
+            outputs["reference"][0],
+            outputs["reference"][1],
+            outputs["candidate"][0],
+            outputs["candidate"][1],
+        )
+    )
+    report["bleu_4_delta"] = report["candidate"]["bleu_4"] - report["reference"]["bleu_4"]
+    report["speedup"] = outputs["reference"][2] / max(outputs["candidate"][2], 1e-9)
+
+    if report_path is not None:
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+################################################################################################
+
+"""
+Command line entry point: quantizes a trained state dict, exports it and, if features
+and captions are given, writes the parity report next to the artifact. --features is
+read only, as in utils.evaluate (a FeatureStore, or a FeatureCache with --images).
+    python -m utils.export --model model_2.pth --vocab data/vocabulary.json
+        --max-length 35 --output model_2_int8.pt --features data/feature_cache
+        --images data/split_dataset/test
+        --captions data/split_dataset/test/image_captions.json
+"""
+
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description="Export a quantized captioning model.")
+    parser.add_argument("--model", required=True, help="state dict of ImageCaptioningModel")
+    parser.add_argument(
+        "--vocab", required=True, help="saved Vocabulary or JSON file of word_to_int"
+    )
+    parser.add_argument("--max-length", type=int, required=True)
+    parser.add_argument("--embedding-dim", type=int, default=200)
+    parser.add_argument("--adaptive-cutoffs", type=int, nargs="+", default=None)
+    parser.add_argument("--output", required=True, help="path of the exported artifact")
+    parser.add_argument("--no-quantize", action="store_true", help="export in float32")
+    parser.add_argument(
+        "--extractor-id",
+        default=INCEPTION_V3_ID,
+        help="identity of the feature extractor of the model (InceptionV3 by default)",
+    )
+    parser.add_argument("--features", default=None, help="FeatureStore or FeatureCache")
+    parser.add_argument("--images", default=None, help="images folder (FeatureCache)")
+    parser.add_argument("--captions", default=None, help="JSON file of reference captions")
+    args = parser.parse_args(argv)
+
+    model, vocabulary, _ = load_model(
+        args.model,
+        args.vocab,
+        args.max_length,
+        args.embedding_dim,
+        args.adaptive_cutoffs,
+        "cpu",
+    )
+    exported = model if args.no_quantize else quantize_model(model)
+    export_model(exported, vocabulary, args.max_length, args.output, args.extractor_id)
+    print(f"exported to {args.output} ({os.path.getsize(args.output) / 2**20:.1f} MB)")
+
+    if args.features and args.captions:
+        from utils.extract import open_features
+
+        with open(args.captions, "r", encoding="utf-8") as f:
+            captions = json.load(f)
+        report = parity_report(
+            model,
+            load_exported(args.output),
+            open_features(args.features, list(captions), args.images),
+            captions,
+            vocabulary,
+            args.max_length,
+            report_path=os.path.splitext(args.output)[0] + "_parity.json",
+        )
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
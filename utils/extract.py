@@ -0,0 +1,418 @@
+import os, sys, hashlib, numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from utils.features import FeatureStore, FeatureCache, INCEPTION_V3_ID
+from utils.store import LazyImageStore, ShardedImageStore
+from utils.parallel import parallel_map
+from utils.instrument import timed
+
+"""
+This function applies the InceptionV3 preprocessing to an image array
+(same as keras.applications.inception_v3.preprocess_input): the pixel values
+are scaled from [0, 255] to [-1, 1].
+"""
+
+
+def inception_preprocess(image_array: np.ndarray) -> np.ndarray:
+    image_array = image_array.astype(np.float32)
+    image_array /= 127.5
+    image_array -= 1.0
+    return image_array
+
+
+################################################################################################
+
+"""
+This function reads an image from the disk, resizes it and preprocesses it.
+Args:
+    image_path: str; the path to the image (or a file object, like io.BytesIO)
+    target_size: tuple=(299, 299); the size expected by the feature extractor
+    preprocess: callable=inception_preprocess; the preprocessing function
+"""
+
+
+def load_and_preprocess(
+    image_path: str, target_size: tuple = (299, 299), preprocess=inception_preprocess
+) -> np.ndarray:
+    import cv2
+    from PIL import Image
+
+    with timed("extract.decode"), Image.open(image_path) as image:
+        image_array = np.asarray(image.convert("RGB"))
+    with timed("extract.resize"):
+        image_array = cv2.resize(image_array, target_size)
+    return preprocess(image_array)
+
+
+################################################################################################
+
+"""
+This generator reads, resizes and preprocesses images in worker threads and yields
+them in fixed-size batches, in the order of the given paths.
+While a batch is being consumed, the next `prefetch` batches are being prepared,
+so at most (prefetch + 1) * batch_size images are in memory at the same time.
+Args:
+    image_paths: list; the paths to the images
+    batch_size: int=32; the number of images in each batch (the last one may be smaller)
+    target_size: tuple=(299, 299); the size expected by the feature extractor
+    preprocess: callable=inception_preprocess; the preprocessing function
+    workers: int=None; the number of threads (all the cores by default)
+    prefetch: int=2; the number of batches prepared in advance
+Yields:
+    (start index of the batch in image_paths, np.array of shape (batch, height, width, 3))
+"""
+
+
+def iter_image_batches(
+    image_paths: list,
+    batch_size: int = 32,
+    target_size: tuple = (299, 299),
+    preprocess=inception_preprocess,
+    workers: int = None,
+    prefetch: int = 2,
+):
+    image_paths = list(image_paths)
+    starts = iter(range(0, len(image_paths), batch_size))
+    pending = deque()  # (start index, futures of the images of the batch)
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+
+        def submit_next_batch() -> None:
+            start = next(starts, None)
+            if start is not None:
+                futures = [
+                    executor.submit(load_and_preprocess, path, target_size, preprocess)
+                    for path in image_paths[start : start + batch_size]
+                ]
+                pending.append((start, futures))
+
+        for _ in range(prefetch + 1):
+            submit_next_batch()
+
+        while pending:
+            start, futures = pending.popleft()
+            batch = np.stack([future.result() for future in futures])
+            submit_next_batch()  # keeping the workers busy during the extraction
+            yield start, batch
+
+
+################################################################################################
+
+"""
+This generator yields batches of preprocessed images read from a store of RGB arrays:
+a ShardedImageStore (see utils.preprocessing.pack_images), whose images are already
+decoded and resized, so the batches are sliced from the memory-mapped shards, a
+LazyImageStore with a transform, or a dictionary of arrays. The images that do not have
+the target size are resized.
+Args:
+    store: ShardedImageStore, LazyImageStore or dict; (image name: image array) couples
+    names: list; the names of the images, in the order of the batches
+    batch_size: int=32; the number of images in each batch (the last one may be smaller)
+    target_size: tuple=(299, 299); the size expected by the feature extractor
+    preprocess: callable=inception_preprocess; the preprocessing function
+    workers: int=1; the number of threads reading the images of a batch (a LazyImageStore
+        decodes them)
+Yields:
+    (start index of the batch in names, np.array of shape (batch, height, width, 3))
+"""
+
+
+def iter_store_batches(
+    store,
+    names: list,
+    batch_size: int = 32,
+    target_size: tuple = (299, 299),
+    preprocess=inception_preprocess,
+    workers: int = 1,
+):
+    import cv2
+
+    def read(name: str) -> np.ndarray:
+        image = store[name]
+        if image.shape[:2] != (target_size[1], target_size[0]):
+            image = cv2.resize(image, target_size)
+        return image
+
+    for start in range(0, len(names), batch_size):
+        batch = np.stack(parallel_map(read, names[start : start + batch_size], workers))
+        yield start, preprocess(batch)
+
+
+################################################################################################
+
+"""
+This class wraps the pooled InceptionV3 model from Keras as a feature extractor:
+calling it on a batch of preprocessed images returns a (batch, 2048) np.array.
+TensorFlow is only imported when the extractor is created.
+"""
+
+
+class InceptionV3Extractor:
+    identity = INCEPTION_V3_ID
+    target_size = (299, 299)
+    dim = 2048
+
+    def __init__(self):
+        from keras.applications.inception_v3 import InceptionV3
+        from keras.models import Model
+
+        base_model = InceptionV3(weights="imagenet")
+        self.model = Model(base_model.input, base_model.layers[-2].output)
+
+    def __call__(self, batch: np.ndarray) -> np.ndarray:
+        with timed("extract.model"):
+            return np.asarray(self.model.predict_on_batch(batch))
+
+
+################################################################################################
+
+"""
+This function computes the feature vectors of the images that are not yet in a
+FeatureStore, streaming them from the disk through iter_image_batches and writing
+each batch of features directly into the store.
+Args:
+    images: dict, LazyImageStore or ShardedImageStore; (image name: image path) or
+        (image name: RGB image array) couples, or a store of images (the images of a
+        ShardedImageStore are not decoded again, the transform of a LazyImageStore is
+        applied)
+    extractor: callable; maps a batch of preprocessed images to a (batch, dim) np.array,
+        and has `identity`, `dim` and `target_size` attributes (e.g. InceptionV3Extractor)
+    store: FeatureStore or str; the store, or the folder of the store to open
+    batch_size: int=32; the number of images given to the extractor at once
+    preprocess: callable=inception_preprocess; the preprocessing function
+    workers: int=None; the number of threads reading the images
+    prefetch: int=2; the number of batches prepared in advance
+    progress: bool=True; whether to print the progress
+"""
+
+
+def extract_features(
+    images,
+    extractor,
+    store,
+    batch_size: int = 32,
+    preprocess=inception_preprocess,
+    workers: int = None,
+    prefetch: int = 2,
+    progress: bool = True,
+) -> FeatureStore:
+    if not isinstance(store, FeatureStore):
+        store = FeatureStore(store, extractor.identity, extractor.dim)
+    images, arrays = _image_source(images)
+
+    names = store.missing(list(images.keys()))
+    if arrays:
+        batches = iter_store_batches(
+            images, names, batch_size, extractor.target_size, preprocess, workers
+        )
+    else:
+        paths = [images[name] for name in names]
+        batches = iter_image_batches(
+            paths, batch_size, extractor.target_size, preprocess, workers, prefetch
+        )
+    n_batches = (len(names) + batch_size - 1) // batch_size
+    for batch_number, (start, batch) in enumerate(batches):
+        if progress and batch_number % 10 == 0:
+            print(f"batch number {batch_number}/{n_batches}")
+        vectors = extractor(batch).reshape(len(batch), -1)
+        store.append(names[start : start + len(batch)], vectors, flush=False)
+        if batch_number % 100 == 99:  # saving the index regularly
+            store.flush()
+    store.flush()
+
+    return store
+
+
+################################################################################################
+
+"""
+This function returns the feature vectors of a set of images through a FeatureCache:
+the images are hashed (in parallel), the vectors of the known contents are read from the
+cache, and only the new or modified images go through the extractor. Adding 1000 images
+to a cached dataset therefore costs 1000 forward passes, whatever the size of the dataset.
+Args:
+    images: dict, LazyImageStore or ShardedImageStore; as in extract_features
+    extractor: extractor or extractor class; as in extract_features. A class (e.g.
+        InceptionV3Extractor) is only instantiated if some vectors are missing
+    cache: FeatureCache or str; the cache, or the folder of the cache to open
+    batch_size: int=32; the number of images given to the extractor at once
+    preprocess: callable=inception_preprocess; the preprocessing function
+    workers: int=None; the number of threads hashing and reading the images
+    prefetch: int=2; the number of batches prepared in advance
+    progress: bool=True; whether to print the progress
+Returns:
+    a dictionary (image name: feature vector), whose vectors are rows of one matrix
+"""
+
+
+def cached_features(
+    images,
+    extractor,
+    cache,
+    batch_size: int = 32,
+    preprocess=inception_preprocess,
+    workers: int = None,
+    prefetch: int = 2,
+    progress: bool = True,
+) -> dict:
+    if not isinstance(cache, FeatureCache):
+        cache = FeatureCache(cache)
+    images, arrays = _image_source(images)
+    names = list(images.keys())
+    settings = _cache_settings(extractor, preprocess)
+
+    # hashing the content of the images (the pixels of the arrays, the bytes of the files)
+    if arrays:
+        hash_image = lambda name: _array_sha256(images[name])
+    else:
+        hash_image = lambda name: _file_sha256(images[name])
+    keys = [
+        cache.key(content_hash, settings)
+        for content_hash in parallel_map(hash_image, names, workers)
+    ]
+
+    matrix = np.empty((len(names), extractor.dim), dtype=np.float32)
+    missing = []
+    for i, key in enumerate(keys):
+        vector = cache.get(key, extractor.dim)
+        if vector is None:
+            missing.append(i)
+        else:
+            matrix[i] = vector
+    if progress:
+        n_cached = len(names) - len(missing)
+        print(f"{n_cached} cached feature vectors, {len(missing)} to compute")
+
+    if missing:
+        if isinstance(extractor, type):  # only loading the model when it is needed
+            extractor = extractor()
+        missing_names = [names[i] for i in missing]
+        if arrays:
+            batches = iter_store_batches(
+                images,
+                missing_names,
+                batch_size,
+                extractor.target_size,
+                preprocess,
+                workers,
+            )
+        else:
+            paths = [images[name] for name in missing_names]
+            batches = iter_image_batches(
+                paths, batch_size, extractor.target_size, preprocess, workers, prefetch
+            )
+        n_batches = (len(missing) + batch_size - 1) // batch_size
+        for batch_number, (start, batch) in enumerate(batches):
+            if progress and batch_number % 10 == 0:
+                print(f"batch number {batch_number}/{n_batches}")
+            vectors = extractor(batch).reshape(len(batch), -1)
+            for i, vector in zip(missing[start : start + len(batch)], vectors):
+                matrix[i] = vector
+                cache.put(keys[i], vector)
+        cache.evict()
+
+    return {name: matrix[i] for i, name in enumerate(names)}
+
+
+def _cache_settings(extractor, preprocess) -> str:
+    # the extraction settings that are part of the keys of a FeatureCache
+    return "|".join(
+        (
+            extractor.identity,
+            f"{preprocess.__module__}.{preprocess.__qualname__}",
+            f"{extractor.target_size[0]}x{extractor.target_size[1]}",
+        )
+    )
+
+
+def _image_source(images) -> tuple:
+    # (images, whether they are arrays): the images of a LazyImageStore without a transform
+    # are read from their files, as the paths, the ones with a transform go through it
+    if isinstance(images, LazyImageStore) and images.transform is None:
+        return {name: images.path(name) for name in images}, False
+    if isinstance(images, (LazyImageStore, ShardedImageStore)):
+        return images, True
+    first = next(iter(images.values()), None)
+    return images, isinstance(first, np.ndarray)
+
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _array_sha256(array: np.ndarray) -> str:
+    # the bytes alone would give the same key to arrays of different shapes
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha256(f"{array.dtype.str}{array.shape}".encode())
+    digest.update(array)
+    return digest.hexdigest()
+
+
+################################################################################################
+
+"""
+This function opens the feature vectors of a set of images for reading, as in the
+command line tools. folderpath is either a FeatureStore, opened read-only, or a
+FeatureCache. A FeatureCache finds the vectors from the content of the image files, so
+it needs images_folder; it is only looked up (nothing is extracted, written or evicted),
+and the images without a cached InceptionV3 vector are reported and skipped.
+A missing folder, a store built with another extractor, or a cache without any of the
+vectors raises an error instead of giving empty features.
+Args:
+    folderpath: str; the folder of a FeatureStore or of a FeatureCache
+    names: list; the names of the images whose vectors are needed
+    images_folder: str=None; the folder of the images (needed for a FeatureCache)
+Returns:
+    a FeatureStore, or a dictionary (image name: feature vector) for a FeatureCache
+"""
+
+
+def open_features(folderpath: str, names: list, images_folder: str = None):
+    if os.path.exists(os.path.join(folderpath, "index.json")):
+        return FeatureStore(folderpath, INCEPTION_V3_ID, read_only=True)
+    if not _is_feature_cache(folderpath):
+        raise FileNotFoundError(f"{folderpath} is neither a FeatureStore nor a FeatureCache.")
+    if images_folder is None:
+        raise ValueError(f"{folderpath} is a FeatureCache, the images folder is needed.")
+    # the images that are not in the folder have no vector (the caller skips them)
+    paths = {name: os.path.join(images_folder, name) for name in names}
+    images = {name: path for name, path in paths.items() if os.path.exists(path)}
+    cache = FeatureCache(folderpath)
+    settings = _cache_settings(InceptionV3Extractor, inception_preprocess)
+    features = {}
+    for name, content_hash in zip(images, parallel_map(_file_sha256, images.values())):
+        key = cache.key(content_hash, settings)
+        vector = cache.get(key, InceptionV3Extractor.dim, refresh=False)
+        if vector is not None:
+            features[name] = vector
+
+    if names and not features:
+        raise ValueError(
+            f"{folderpath} has none of the feature vectors of the images of "
+            f"{images_folder}, compute them with utils.extract.cached_features first."
+        )
+    if len(features) < len(names):
+        print(
+            f"{len(names) - len(features)} images have no cached feature vector in "
+            f"{folderpath}, skipping them",
+            file=sys.stderr,
+        )
+    return features
+
+
+def _is_feature_cache(folderpath: str) -> bool:
+    # a FeatureCache only holds subfolders named after the first two hex digits of the keys
+    if not os.path.isdir(folderpath):
+        return False
+    entries = os.listdir(folderpath)
+    return bool(entries) and all(
+        len(entry) == 2 and all(c in "0123456789abcdef" for c in entry)
+        for entry in entries
+    )
+
+
+################################################################################################
@@ -0,0 +1,285 @@
+import os, json, time, shutil, hashlib, threading, numpy as np
+from collections.abc import Mapping
+
+# identity of the feature extractor used in the notebook (pooled InceptionV3 features)
+INCEPTION_V3_ID = "keras.InceptionV3/imagenet/avg_pool/299x299"
+
+"""
+This class stores feature vectors on disk as one contiguous float32 matrix
+(features.f32) plus an index (index.json) mapping each image name to its row.
+The matrix is loaded zero-copy with np.memmap, new images can be appended
+incrementally, and the store is rebuilt from scratch if it was computed with
+another feature extractor (or has another dimension) than the one requested.
+It behaves like a read-only dictionary: store[image_name] returns a np.array.
+With read_only=True (to use existing features, e.g. in the evaluation), nothing is
+ever written: a missing, stale or damaged store raises an error instead of being
+created or rebuilt.
+Args:
+    folderpath: str; the folder where the store is kept
+    extractor_id: str; a string identifying the feature extractor and its settings
+    dim: int=2048; the dimension of the feature vectors
+    read_only: bool=False; whether to open an existing store without modifying it
+"""
+
+
+class FeatureStore(Mapping):
+    def __init__(
+        self, folderpath: str, extractor_id: str, dim: int = 2048, read_only: bool = False
+    ):
+        self.folderpath = folderpath
+        self.extractor_id = extractor_id
+        self.dim = dim
+        self.read_only = read_only
+        self.data_path = os.path.join(folderpath, "features.f32")
+        self.index_path = os.path.join(folderpath, "index.json")
+        if not read_only:
+            os.makedirs(folderpath, exist_ok=True)
+
+        self.names, self._rows, self._matrix = [], {}, None
+        if not self._load_index():  # missing or stale store
+            self.clear()
+        self._open_matrix()
+
+    def _load_index(self) -> bool:
+        if not os.path.exists(self.index_path) or not os.path.exists(self.data_path):
+            if self.read_only:
+                raise FileNotFoundError(f"{self.folderpath} is not a FeatureStore.")
+            return False
+        with open(self.index_path, "r") as f:
+            index = json.load(f)
+        if index.get("extractor") != self.extractor_id or index.get("dim") != self.dim:
+            if self.read_only:
+                raise ValueError(
+                    f"{self.folderpath} was built with {index.get('extractor')} "
+                    f"(dim {index.get('dim')}), not {self.extractor_id} (dim {self.dim})."
+                )
+            print(f"{self.folderpath} was built with another extractor, rebuilding it.")
+            return False
+
+        n_bytes = len(index["names"]) * self.dim * 4
+        data_size = os.path.getsize(self.data_path)
+        if data_size < n_bytes:  # the data file is shorter than the index
+            if self.read_only:
+                raise ValueError(f"{self.data_path} is shorter than its index.")
+            return False
+        if data_size > n_bytes and not self.read_only:
+            # an append was interrupted before the index was written
+            with open(self.data_path, "r+b") as f:
+                f.truncate(n_bytes)
+
+        self.names = index["names"]
+        self._rows = {name: row for row, name in enumerate(self.names)}
+        return True
+
+    def _write_index(self) -> None:
+        index = {"extractor": self.extractor_id, "dim": self.dim, "names": self.names}
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)  # atomic, the index is never half written
+
+    def _open_matrix(self) -> None:
+        if self.names:
+            self._matrix = np.memmap(
+                self.data_path, dtype=np.float32, mode="r", shape=(len(self.names), self.dim)
+            )
+        else:  # np.memmap cannot map an empty file
+            self._matrix = np.empty((0, self.dim), dtype=np.float32)
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self._matrix[self._rows[name]]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __contains__(self, name) -> bool:
+        return name in self._rows
+
+    @property
+    def matrix(self) -> np.ndarray:
+        # the (number of images, dim) matrix of all the feature vectors
+        return self._matrix
+
+    def rows(self, names: list) -> np.ndarray:
+        # returning the row of each name in the matrix
+        return np.array([self._rows[name] for name in names], dtype=np.int64)
+
+    def missing(self, names: list) -> list:
+        # returning the names that are not in the store yet
+        return [name for name in names if name not in self._rows]
+
+    def append(self, names: list, vectors: np.ndarray, flush: bool = True) -> None:
+        # with flush=False the index is only written by the next flush(),
+        # which avoids rewriting it after every batch of a long extraction
+        self._check_writable()
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(len(names), self.dim)
+        duplicates = [name for name in names if name in self._rows]
+        if duplicates or len(set(names)) != len(names):
+            raise ValueError(f"Some images are already in the store: {duplicates[:5]}")
+
+        self._matrix = None  # releasing the memory map before writing
+        with open(self.data_path, "ab") as f:
+            f.write(vectors.tobytes())
+        for name in names:
+            self._rows[name] = len(self.names)
+            self.names.append(name)
+        if flush:
+            self.flush()
+        else:
+            self._open_matrix()
+
+    def flush(self) -> None:
+        self._check_writable()
+        self._matrix = None
+        self._write_index()
+        self._open_matrix()
+
+    def clear(self) -> None:
+        self._check_writable()
+        self._matrix = None
+        self.names, self._rows = [], {}
+        open(self.data_path, "wb").close()
+        self._write_index()
+        self._open_matrix()
+
+
+    def _check_writable(self) -> None:
+        if self.read_only:
+            raise ValueError(f"{self.folderpath} was opened read-only.")
+
+
+################################################################################################
+
+"""
+This function converts a feature_vectors.json file (as saved by the first versions
+of the notebook) into a FeatureStore, so that the features are not recomputed.
+Args:
+    json_filepath: str; the path to the JSON file
+    folderpath: str; the folder of the FeatureStore
+    extractor_id: str; the identity of the extractor used to compute the JSON file
+"""
+
+
+def convert_json_features(
+    json_filepath: str, folderpath: str, extractor_id: str = INCEPTION_V3_ID
+) -> FeatureStore:
+    with open(json_filepath, "r", encoding="utf-8") as f:
+        json_dict = json.load(f)
+    names = list(json_dict.keys())
+    vectors = np.array([json_dict[name] for name in names], dtype=np.float32)
+
+    store = FeatureStore(folderpath, extractor_id, dim=vectors.shape[1])
+    positions = {name: i for i, name in enumerate(names)}
+    names_to_add = store.missing(names)
+    if names_to_add:
+        store.append(names_to_add, vectors[[positions[n] for n in names_to_add]])
+    return store
+
+
+################################################################################################
+
+"""
+This class is a content-addressed cache of feature vectors: each vector is stored in its
+own .npy file, named after the sha256 of the image content and of the extraction settings
+(extractor, preprocessing, target size), so renamed images are still found and modified
+images are recomputed. The files are written atomically (temporary file then rename), so
+several processes can fill the same cache at the same time. When max_bytes is given, the
+least recently used files are evicted (a cache hit refreshes the modification time).
+Use utils.extract.cached_features to compute the missing vectors of a set of images.
+Args:
+    folderpath: str; the folder of the cache
+    max_bytes: int=None; the maximum size of the cache on disk (no limit if None)
+"""
+
+
+class FeatureCache:
+    # the temporary files of put older than this are left over by a crashed writer
+    tmp_grace_seconds = 3600
+
+    def __init__(self, folderpath: str, max_bytes: int = None):
+        self.folderpath = folderpath
+        self.max_bytes = max_bytes
+        os.makedirs(folderpath, exist_ok=True)
+
+    def key(self, content_hash: str, settings: str) -> str:
+        return hashlib.sha256(f"{content_hash}|{settings}".encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> str:
+        # spreading the files over 256 subfolders to keep the folders small
+        return os.path.join(self.folderpath, key[:2], key + ".npy")
+
+    def get(self, key: str, dim: int = None, refresh: bool = True):
+        # returning the vector of a key, or None on a miss (or an unreadable file);
+        # refresh=False leaves the cache untouched (no modification time update)
+        path = self.path(key)
+        try:
+            vector = np.load(path)
+        except (OSError, ValueError):
+            return None
+        if dim is not None and vector.shape != (dim,):
+            return None
+        if not refresh:
+            return vector
+        try:
+            os.utime(path)  # marking the file as recently used
+        except OSError:
+            pass
+        return vector
+
+    def put(self, key: str, vector: np.ndarray) -> None:
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # a temporary name unique to this process and thread, then an atomic rename:
+        # a reader never sees a partial file, and concurrent writers of the same key
+        # write the same content
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.asarray(vector, dtype=np.float32))
+        os.replace(tmp_path, path)
+
+    def evict(self) -> int:
+        # removing the least recently used files until the cache fits in max_bytes,
+        # returns the number of removed files
+        if self.max_bytes is None:
+            return 0
+        entries, total, now = [], 0, time.time()
+        for folder in os.scandir(self.folderpath):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:  # removed by another process
+                    continue
+                if entry.name.endswith(".tmp"):
+                    # being written by a put of another process, unless it is stale
+                    if now - stat.st_mtime > self.tmp_grace_seconds:
+                        try:
+                            os.remove(entry.path)
+                        except FileNotFoundError:
+                            pass
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        return removed
+
+    def clear(self) -> None:
+        shutil.rmtree(self.folderpath, ignore_errors=True)
+        os.makedirs(self.folderpath, exist_ok=True)
+
+
+################################################################################################
@@ -0,0 +1,135 @@
+import os, json, numpy as np
+
+"""
+This class gives access to GloVe word vectors stored as a binary float32 matrix
+(vectors.f32) plus the list of words (words.txt), memory-mapped with np.memmap.
+Use GloveStore.load(text_filepath) rather than the constructor: the text file is
+parsed once, streaming, into the binary cache, and later runs only map the cache.
+Args:
+    folderpath: str; the folder of the binary cache
+"""
+
+
+class GloveStore:
+    def __init__(self, folderpath: str):
+        self.folderpath = folderpath
+        with open(os.path.join(folderpath, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        self.dim = self.meta["dim"]
+        with open(os.path.join(folderpath, "words.txt"), "r", encoding="utf-8") as f:
+            self.words = f.read().split("\n")[: self.meta["count"]]
+        self.index = {word: row for row, word in enumerate(self.words)}
+        self.vectors = np.memmap(
+            os.path.join(folderpath, "vectors.f32"),
+            dtype=np.float32,
+            mode="r",
+            shape=(self.meta["count"], self.dim),
+        )
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def __contains__(self, word) -> bool:
+        return word in self.index
+
+    def __getitem__(self, word: str) -> np.ndarray:
+        return self.vectors[self.index[word]]
+
+    # Loading the store of a GloVe text file, building its binary cache if it is
+    # missing or older than the text file.
+    @classmethod
+    def load(cls, text_filepath: str, folderpath: str = None) -> "GloveStore":
+        if folderpath is None:
+            folderpath = os.path.splitext(text_filepath)[0] + "_cache"
+        meta_path = os.path.join(folderpath, "meta.json")
+        source = {
+            "source_size": os.path.getsize(text_filepath),
+            "source_mtime": os.path.getmtime(text_filepath),
+        }
+        if os.path.exists(meta_path):
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            if all(meta.get(key) == value for key, value in source.items()):
+                return cls(folderpath)
+        build_glove_cache(text_filepath, folderpath)
+        return cls(folderpath)
+
+    # Building the embedding matrix of a vocabulary with a single gather:
+    # the row i is the vector of the word of index i (zeros if it is not in GloVe).
+    def build_embedding_matrix(
+        self, word_to_int: dict, vocabulary_size: int = None
+    ) -> np.ndarray:
+        if vocabulary_size is None:
+            vocabulary_size = max(word_to_int.values()) + 1
+        words = list(word_to_int.keys())
+        indices = np.fromiter(word_to_int.values(), dtype=np.int64, count=len(words))
+        rows = np.fromiter(
+            (self.index.get(word, -1) for word in words), dtype=np.int64, count=len(words)
+        )
+        found = rows >= 0
+
+        embedding_matrix = np.zeros((vocabulary_size, self.dim), dtype=np.float32)
+        embedding_matrix[indices[found]] = self.vectors[rows[found]]
+        return embedding_matrix
+
+
+################################################################################################
+
+"""
+This function parses a GloVe text file (one "word v_1 ... v_dim" line per word) once,
+streaming, into the binary cache read by GloveStore.
+Args:
+    text_filepath: str; the path to the GloVe text file, e.g. data/glove/glove.6B.200d.txt
+    folderpath: str; the folder of the binary cache
+    chunk_size: int=20000; the number of lines converted to float32 at once
+"""
+
+
+def build_glove_cache(text_filepath: str, folderpath: str, chunk_size: int = 20000):
+    os.makedirs(folderpath, exist_ok=True)
+    meta_path = os.path.join(folderpath, "meta.json")
+    if os.path.exists(meta_path):  # the previous cache is not valid anymore
+        os.remove(meta_path)
+    words, dim = [], None
+    vectors_path = os.path.join(folderpath, "vectors.f32")
+
+    with open(text_filepath, "r", encoding="utf-8") as text_file, open(
+        vectors_path + ".tmp", "wb"
+    ) as vectors_file:
+
+        def write_chunk(values: list) -> None:
+            # converting all the values of the chunk at once
+            chunk = np.array(values, dtype=np.float32)
+            vectors_file.write(chunk.tobytes())
+
+        values = []
+        for line in text_file:
+            fields = line.rstrip("\n").rstrip(" ").split(" ")
+            if len(fields) < 2:  # skipping the empty lines
+                continue
+            if dim is None:
+                dim = len(fields) - 1
+            # some words contain spaces, so the vector is made of the last dim fields
+            words.append(" ".join(fields[:-dim]))
+            values.extend(fields[-dim:])
+            if len(values) >= chunk_size * dim:
+                write_chunk(values)
+                values = []
+        if values:
+            write_chunk(values)
+
+    with open(os.path.join(folderpath, "words.txt"), "w", encoding="utf-8") as f:
+        f.write("\n".join(words))
+    os.replace(vectors_path + ".tmp", vectors_path)
+    # the meta file is written last, so an interrupted build is detected
+    meta = {
+        "dim": dim,
+        "count": len(words),
+        "source_size": os.path.getsize(text_filepath),
+        "source_mtime": os.path.getmtime(text_filepath),
+    }
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+
+
+################################################################################################
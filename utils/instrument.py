@@ -0,0 +1,259 @@
+import os, json, time, atexit, functools, threading, tracemalloc
+
+"""
+Lightweight instrumentation of the hot paths: named stages are timed with timed(name)
+(a context manager) or @instrumented(name) (a decorator), and a process-wide registry
+keeps, for each stage, the number of calls, the cumulative and maximum wall times and,
+if memory tracking is on, the bytes allocated (net, measured with tracemalloc).
+The registry can be printed as a table (print_summary) or dumped as a Chrome trace
+(dump_chrome_trace, to open in chrome://tracing or https://ui.perfetto.dev).
+Everything is disabled by default, and a disabled stage only costs a flag check.
+Enable it with enable(), or by setting IMAGE_CAPTION_INSTRUMENT=1 (or =memory to also
+measure the allocations) in the environment: the summary is then printed when the
+process exits, and IMAGE_CAPTION_TRACE=trace.json also writes the Chrome trace.
+"""
+
+_enabled = False
+_memory = False
+_trace = False
+
+
+class _Stage:
+    __slots__ = ("count", "seconds", "max_seconds", "bytes")
+
+    def __init__(self):
+        self.count, self.seconds, self.max_seconds, self.bytes = 0, 0.0, 0.0, 0
+
+
+class _Registry:
+    def __init__(self):
+        self.stages = {}
+        self.events = []  # the Chrome trace events, if tracing is on
+        self.origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def record(self, name: str, start: float, seconds: float, n_bytes: int) -> None:
+        with self._lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = _Stage()
+            stage.count += 1
+            stage.seconds += seconds
+            stage.max_seconds = max(stage.max_seconds, seconds)
+            stage.bytes += n_bytes
+            if _trace:
+                self.events.append(
+                    {
+                        "name": name,
+                        "cat": name.split(".", 1)[0],
+                        "ph": "X",
+                        "ts": (start - self.origin) * 1e6,
+                        "dur": seconds * 1e6,
+                        "pid": os.getpid(),
+                        "tid": threading.get_ident(),
+                    }
+                )
+
+    def reset(self) -> None:
+        with self._lock:
+            self.stages, self.events = {}, []
+            self.origin = time.perf_counter()
+
+
+REGISTRY = _Registry()
+
+
+################################################################################################
+
+"""
+This function turns the instrumentation on.
+Args:
+    memory: bool=False; whether to measure the bytes allocated by each stage (tracemalloc
+        slows down the allocations, so the times are less accurate with it)
+    trace: bool=False; whether to keep every call for dump_chrome_trace
+"""
+
+
+def enable(memory: bool = False, trace: bool = False) -> None:
+    global _enabled, _memory, _trace
+    _memory, _trace = memory, trace
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _enabled = True
+
+
+def disable() -> None:
+    global _enabled
+    _enabled = False
+    if _memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def reset() -> None:
+    REGISTRY.reset()
+
+
+################################################################################################
+
+
+class _Timer:
+    __slots__ = ("name", "start", "start_bytes")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start_bytes = tracemalloc.get_traced_memory()[0] if _memory else 0
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        n_bytes = tracemalloc.get_traced_memory()[0] - self.start_bytes if _memory else 0
+        REGISTRY.record(self.name, self.start, seconds, n_bytes)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+"""
+This function returns a context manager timing the code of its block as the stage `name`
+(e.g. "load.decode"); when the instrumentation is disabled, it returns a shared no-op.
+"""
+
+
+def timed(name: str):
+    return _Timer(name) if _enabled else _NULL_TIMER
+
+
+"""
+This decorator times every call of a function as the stage `name`.
+"""
+
+
+def instrumented(name: str):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Timer(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+################################################################################################
+
+"""
+These functions export the registry: summary() returns one dictionary per stage, sorted
+by decreasing cumulative time, print_summary() prints it as a table and
+dump_chrome_trace(path) writes the recorded calls in the Chrome trace event format.
+"""
+
+
+def summary() -> list:
+    with REGISTRY._lock:
+        stages = list(REGISTRY.stages.items())
+    rows = [
+        {
+            "stage": name,
+            "count": stage.count,
+            "total_s": stage.seconds,
+            "mean_ms": 1000 * stage.seconds / stage.count,
+            "max_ms": 1000 * stage.max_seconds,
+            "bytes": stage.bytes,
+        }
+        for name, stage in stages
+    ]
+    return sorted(rows, key=lambda row: -row["total_s"])
+
+
+def print_summary() -> None:
+    rows = summary()
+    if not rows:
+        print("no instrumented stage was recorded (is the instrumentation enabled?)")
+        return
+    width = max(len(row["stage"]) for row in rows) + 2
+    print(f"{'stage':<{width}}{'count':>9}{'total s':>10}{'mean ms':>10}", end="")
+    print(f"{'max ms':>10}{'MB':>10}")
+    for row in rows:
+        line = f"{row['stage']:<{width}}{row['count']:>9}{row['total_s']:>10.3f}"
+        line += f"{row['mean_ms']:>10.3f}{row['max_ms']:>10.3f}"
+        line += f"{row['bytes'] / 2**20:>10.1f}"
+        print(line)
+
+
+def dump_chrome_trace(path: str) -> None:
+    with REGISTRY._lock:
+        events = list(REGISTRY.events)
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+################################################################################################
+
+"""
+This function builds a torch.profiler.profile that records a window of training steps:
+`wait` steps are skipped, `warmup` steps are profiled but discarded, then `active` steps
+are recorded and exported as a Chrome trace to trace_path. Give it to
+Trainer(profiler=...), which calls profiler.step() after every batch.
+Args:
+    trace_path: str; where the Chrome trace of the window is written
+    wait: int=5; the number of steps before the window
+    warmup: int=2; the number of warm-up steps
+    active: int=5; the number of recorded steps
+    record_shapes: bool=True; whether to record the shapes of the operator inputs
+    profile_memory: bool=False; whether to record the tensor allocations
+"""
+
+
+def torch_profiler(
+    trace_path: str,
+    wait: int = 5,
+    warmup: int = 2,
+    active: int = 5,
+    record_shapes: bool = True,
+    profile_memory: bool = False,
+):
+    import torch
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    return torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+        on_trace_ready=lambda profiler: profiler.export_chrome_trace(trace_path),
+        record_shapes=record_shapes,
+        profile_memory=profile_memory,
+    )
+
+
+################################################################################################
+
+if os.environ.get("IMAGE_CAPTION_INSTRUMENT", "") not in ("", "0"):
+    enable(
+        memory=os.environ.get("IMAGE_CAPTION_INSTRUMENT") == "memory",
+        trace=bool(os.environ.get("IMAGE_CAPTION_TRACE")),
+    )
+    atexit.register(print_summary)
+    if os.environ.get("IMAGE_CAPTION_TRACE"):
+        atexit.register(dump_chrome_trace, os.environ["IMAGE_CAPTION_TRACE"])
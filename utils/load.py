@@ -1,5 +1,7 @@
-import os, json, shutil, kagglehub, pandas as pd, numpy as np
-from PIL import Image
+import os, json, string, shutil, numpy as np
+from utils.store import LazyImageStore
+from utils.parallel import parallel_map
+from utils.instrument import instrumented, timed
 
 """
 This function downloads the Flick-8k dataset from Kaggle to a default location
@@ -10,6 +12,8 @@ Args:
 
 
 def download_flickr(destination_folder: str = "data"):
+    import kagglehub
+
     # downloading latest version
     source_folder = kagglehub.dataset_download("adityajn105/flickr8k")
     print("Path to dataset files:", source_folder)
@@ -43,6 +47,8 @@ and adds it to the data folder.
 
 
 def download_glove(destination_folder: str = "data/glove"):
+    import kagglehub
+
     source_folder = kagglehub.dataset_download(
         "rtatman/glove-global-vectors-for-word-representation"
     )
@@ -76,55 +82,153 @@ Those two dictionaries are structured as follows:
 Keys: image names
 Values: np.arrays corresponding to the image or a list of strings corresponding
 to the captions attached to the images
+By default the images are returned as a LazyImageStore, which behaves like the
+dictionary but only decodes the images on access (with a bounded cache).
 
 Args:
     images_folderpath: str; path to the image folder
     captions_filepath: str; path to the captions.txt file
+    lazy: bool=True; whether to return a LazyImageStore instead of a dict of arrays
+    cache_bytes: int=512MB; the cache budget of the LazyImageStore
+    workers: int=None; the number of threads decoding the images (eager mode only)
+    progress: bool=False; whether to print the decoding progress (eager mode only)
+    normalize: bool=False; whether to normalize the captions (see load_captions)
+    add_start_end: bool=False; whether to add the startseq and endseq tokens
 """
 
 
-def load_data(images_folderpath: str, captions_filepath: str):
-    image_arrays, image_captions = (
-        {},
-        {},
-    )  # initializing dictionaries to store image arrays and captions
-    captions_df = pd.read_csv(captions_filepath)  # reading the captions file
+@instrumented("load.load_data")
+def load_data(
+    images_folderpath: str,
+    captions_filepath: str,
+    lazy: bool = True,
+    cache_bytes: int = 512 * 2**20,
+    workers: int = None,
+    progress: bool = False,
+    normalize: bool = False,
+    add_start_end: bool = False,
+):
+    # reading the captions and removing the entries of the missing images
+    caption_table = load_captions(
+        captions_filepath, images_folderpath, normalize, add_start_end
+    )
+    image_captions = caption_table.to_dict()
 
-    for (
-        index,
-        row,
-    ) in captions_df.iterrows():  # iterating over the rows in the captions DataFrame
-        image_filename = row["image"]
-        caption = row["caption"]
-        if image_filename not in image_captions:
-            image_captions[image_filename] = []
-        image_captions[image_filename].append(caption)
-
-    # verifying that all images in the captions file exist in the images folder
-    image_files = set(os.listdir(images_folderpath))
-    for image_filename in list(image_captions.keys()):
-        if image_filename not in image_files:
-            del image_captions[image_filename]  # removing entries for missing images
-        else:
-            # loading the image and convert it to a NumPy array
-            image_path = os.path.join(images_folderpath, image_filename)
-            image = Image.open(image_path)
-            image_array = np.array(image)
-            image_arrays[image_filename] = image_array
+    image_filenames = list(image_captions.keys())
+    if lazy:  # the images will be decoded on access
+        image_arrays = LazyImageStore(images_folderpath, image_filenames, cache_bytes)
+    else:
+        # loading the images in parallel and converting them to NumPy arrays
+        image_paths = [os.path.join(images_folderpath, f) for f in image_filenames]
+        arrays = parallel_map(
+            _read_image_array, image_paths, workers, progress=progress, desc="loading"
+        )
+        image_arrays = dict(zip(image_filenames, arrays))
 
     return image_arrays, image_captions
 
 
+################################################################################################
+
+"""
+This class stores the captions of a dataset in a compact columnar structure:
+- image_names: np.array of the image names (in order of first appearance in the file)
+- captions: np.array of all the captions, grouped by image
+- offsets: np.array of int64, the captions of image i are captions[offsets[i]:offsets[i + 1]]
+- image_ids: np.array of int32, the index of the image of each caption
+"""
+
+
+class CaptionTable:
+    def __init__(self, image_names, captions, offsets):
+        self.image_names = np.asarray(image_names, dtype=object)
+        self.captions = np.asarray(captions, dtype=object)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.image_ids = np.repeat(
+            np.arange(len(self.image_names), dtype=np.int32), np.diff(self.offsets)
+        )
+
+    def __len__(self) -> int:
+        return len(self.captions)
+
+    def get(self, image_index: int) -> list:
+        return list(self.captions[self.offsets[image_index] : self.offsets[image_index + 1]])
+
+    def to_dict(self) -> dict:
+        # the (image name: list of captions) dictionary used by the rest of the code
+        return {name: self.get(i) for i, name in enumerate(self.image_names)}
+
+
+################################################################################################
+
+"""
+This function reads a captions.txt file (columns: image, caption) in one vectorized pass.
+The images that are not in images_folderpath are dropped with a single join, and the
+captions are optionally normalized in bulk: lowercased, punctuation removed, spaces
+collapsed, and the startseq / endseq tokens added.
+Args:
+    captions_filepath: str; path to the captions.txt file
+    images_folderpath: str=None; path to the image folder (no filtering if None)
+    normalize: bool=False; whether to normalize the captions
+    add_start_end: bool=False; whether to add the startseq and endseq tokens
+"""
+
+
+@instrumented("load.captions")
+def load_captions(
+    captions_filepath: str,
+    images_folderpath: str = None,
+    normalize: bool = False,
+    add_start_end: bool = False,
+) -> CaptionTable:
+    import pandas as pd
+
+    captions_df = pd.read_csv(captions_filepath)  # reading the captions file
+    images, captions = captions_df["image"], captions_df["caption"].fillna("").astype(str)
+
+    if images_folderpath is not None:  # keeping the images that exist
+        existing = images.isin(set(os.listdir(images_folderpath)))
+        images, captions = images[existing], captions[existing]
+
+    if normalize:
+        translator = str.maketrans("", "", string.punctuation)
+        captions = captions.str.lower().str.translate(translator)
+        captions = captions.str.split().str.join(" ")
+    if add_start_end:
+        captions = "startseq " + captions + " endseq"
+
+    # grouping the captions by image, in order of first appearance of the images
+    codes, image_names = pd.factorize(images, sort=False)
+    order = np.argsort(codes, kind="stable")
+    counts = np.bincount(codes, minlength=len(image_names))
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    return CaptionTable(
+        np.asarray(image_names), captions.to_numpy(dtype=object)[order], offsets
+    )
+
+
 ################################################################################################
 
 """
 This function load the split dataset, that is structured in three subfolders (train, val, test).
 Args:
     dataset_folderpath: str
+    lazy: bool=True; whether to return LazyImageStores instead of dicts of arrays
+    cache_bytes: int=512MB; the cache budget of each LazyImageStore
+    workers: int=None; the number of threads decoding the images (eager mode only)
+    progress: bool=False; whether to print the decoding progress (eager mode only)
 """
 
 
-def load_split_dataset(dataset_folderpath: str):
+@instrumented("load.split_dataset")
+def load_split_dataset(
+    dataset_folderpath: str,
+    lazy: bool = True,
+    cache_bytes: int = 512 * 2**20,
+    workers: int = None,
+    progress: bool = False,
+):
     # function that loads a subset (train, val, or test) of the dataset.
     def load_subset(subset_name: str):
 
@@ -134,12 +238,21 @@ def load_split_dataset(dataset_folderpath: str):
             # loading captions from the JSON file
             with open(os.path.join(subfolder, "image_captions.json"), "r") as f:
                 subset_captions = json.load(f)
-            # loading images and convert them to NumPy arrays
-            for filename in subset_captions.keys():
-                image_path = os.path.join(subfolder, filename)
-                image = Image.open(image_path)
-                image_array = np.array(image)
-                subset_images[filename] = image_array
+            if lazy:  # the images will be decoded on access
+                subset_images = LazyImageStore(
+                    subfolder, list(subset_captions.keys()), cache_bytes
+                )
+                return subset_images, subset_captions
+            # loading images in parallel and convert them to NumPy arrays
+            filenames = list(subset_captions.keys())
+            arrays = parallel_map(
+                _read_image_array,
+                [os.path.join(subfolder, filename) for filename in filenames],
+                workers,
+                progress=progress,
+                desc=f"loading {subset_name}",
+            )
+            subset_images = dict(zip(filenames, arrays))
 
         return subset_images, subset_captions
 
@@ -152,3 +265,18 @@ def load_split_dataset(dataset_folderpath: str):
 
 
 ################################################################################################
+
+"""
+This function reads an image file and returns it as a np.array.
+It is used by the workers of the loading functions.
+"""
+
+
+def _read_image_array(image_path: str) -> np.ndarray:
+    from PIL import Image
+
+    with timed("load.decode"), Image.open(image_path) as image:
+        return np.array(image)
+
+
+################################################################################################
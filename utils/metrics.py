@@ -0,0 +1,263 @@
+import numpy as np
+
+"""
+This function converts captions (lists of words) into one flat int64 array of word ids
+plus the offsets of the captions in it (caption i is ids[offsets[i]:offsets[i + 1]]).
+Args:
+    captions: list; the captions, as lists of words
+    word_ids: dict; the id of each word, the new words are added to it
+"""
+
+
+def encode_captions(captions: list, word_ids: dict):
+    lengths = np.fromiter((len(caption) for caption in captions), dtype=np.int64)
+    offsets = np.zeros(len(captions) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    ids = np.fromiter(
+        (word_ids.setdefault(word, len(word_ids)) for caption in captions for word in caption),
+        dtype=np.int64,
+        count=int(offsets[-1]),
+    )
+    return ids, offsets
+
+
+################################################################################################
+
+"""
+This function lists all the n-grams of a set of captions at once, without any loop over
+the captions: each n-gram is encoded as one integer (the word ids in base `base`).
+When base ** n does not fit in an int64 (a large vocabulary or a high order), the codes
+are the rows of n word ids seen as raw bytes instead (a void array), which np.unique
+sorts and compares in the same way.
+Args:
+    ids: np.ndarray; the flat word ids of the captions (see encode_captions)
+    offsets: np.ndarray; the offsets of the captions in ids
+    n: int; the order of the n-grams
+    base: int; a number larger than all the word ids
+Returns:
+    the index of the caption of each n-gram and the code of each n-gram
+"""
+
+
+def ngram_codes(ids: np.ndarray, offsets: np.ndarray, n: int, base: int):
+    lengths = np.diff(offsets)
+    caption_of_token = np.repeat(np.arange(len(lengths)), lengths)
+    # an n-gram starts at every position with n - 1 more tokens in the same caption
+    starts = np.flatnonzero(np.arange(len(ids)) + n <= np.repeat(offsets[1:], lengths))
+    if base**n > np.iinfo(np.int64).max:
+        rows = np.ascontiguousarray(ids[starts[:, None] + np.arange(n)], dtype=np.int64)
+        codes = rows.view(np.dtype((np.void, 8 * n))).ravel()
+        return caption_of_token[starts], codes
+    codes = np.zeros(len(starts), dtype=np.int64)
+    for k in range(n):
+        codes = codes * base + ids[starts + k]
+    return caption_of_token[starts], codes
+
+
+def _ngram_counts(captions: np.ndarray, codes: np.ndarray, n_codes: int):
+    # counting the occurrences of each (caption, n-gram) couple, keys sorted
+    keys, counts = np.unique(captions * n_codes + codes, return_counts=True)
+    return keys, counts
+
+
+################################################################################################
+
+"""
+This function computes the corpus-level BLEU-1 to BLEU-max_n scores (Papineni et al.):
+the clipped n-gram counts and the lengths are summed over the whole corpus before the
+precisions are computed, and the brevity penalty uses the closest reference length.
+The n-grams are counted with numpy over integer arrays (no loop over the captions).
+Args:
+    references: list; for each hypothesis, the list of its reference captions (lists of words)
+    hypotheses: list; the generated captions (lists of words)
+    max_n: int=4; the maximum n-gram order
+Returns:
+    a dictionary {"bleu_1": ..., "bleu_max_n": ...} of cumulative BLEU scores
+"""
+
+
+def corpus_bleu(references: list, hypotheses: list, max_n: int = 4) -> dict:
+    corpus = _Corpus(references, hypotheses)
+    matches = np.zeros(max_n, dtype=np.int64)
+    totals = np.zeros(max_n, dtype=np.int64)
+
+    for n in range(1, max_n + 1):
+        hyp_keys, hyp_counts, ref_keys, ref_counts, n_codes = corpus.ngrams(n)
+        # clipping each n-gram count by its maximum count in a single reference:
+        # the (reference, n-gram) keys become (image, n-gram) keys, then the maximum
+        # count of each key is taken
+        image_keys = corpus.ref_images[ref_keys // n_codes] * n_codes + ref_keys % n_codes
+        order = np.argsort(image_keys, kind="stable")
+        image_keys, ref_counts = image_keys[order], ref_counts[order]
+        unique_keys, starts = np.unique(image_keys, return_index=True)
+        max_counts = np.maximum.reduceat(ref_counts, starts) if len(starts) else ref_counts
+        clipped = np.minimum(hyp_counts, _lookup(unique_keys, max_counts, hyp_keys))
+        matches[n - 1] = clipped.sum()
+        totals[n - 1] = hyp_counts.sum()
+
+    hypothesis_length = int(corpus.hyp_lengths.sum())
+    if hypothesis_length == 0:
+        return {f"bleu_{n}": 0.0 for n in range(1, max_n + 1)}
+    # the reference length closest to the hypothesis length (the shortest on ties)
+    distances = np.abs(corpus.ref_lengths - corpus.hyp_lengths[corpus.ref_images])
+    order = np.lexsort((corpus.ref_lengths, distances, corpus.ref_images))
+    _, first = np.unique(corpus.ref_images[order], return_index=True)
+    reference_length = int(corpus.ref_lengths[order[first]].sum())
+
+    brevity_penalty = min(1.0, np.exp(1 - reference_length / hypothesis_length))
+    with np.errstate(divide="ignore"):
+        log_precisions = np.log(matches / np.maximum(totals, 1))
+    # the cumulative score of order n is the geometric mean of the first n precisions
+    cumulated = np.cumsum(log_precisions) / np.arange(1, max_n + 1)
+    return {
+        f"bleu_{n}": float(brevity_penalty * np.exp(cumulated[n - 1]))
+        for n in range(1, max_n + 1)
+    }
+
+
+################################################################################################
+
+"""
+This function computes the CIDEr-D score of a corpus (Vedantam et al.): each caption is
+a TF-IDF vector of its n-grams (n = 1..4, document frequencies over the references of
+the corpus), a hypothesis is compared to each of its references with a clipped cosine
+similarity and a Gaussian penalty on the length difference (sigma = 6), and the score is
+scaled by 10. The computation is vectorized over all the n-grams of the corpus.
+Args:
+    references: list; for each hypothesis, the list of its reference captions (lists of words)
+    hypotheses: list; the generated captions (lists of words)
+    max_n: int=4; the maximum n-gram order
+    sigma: float=6.0; the standard deviation of the length penalty
+Returns:
+    the corpus CIDEr-D score and the score of each hypothesis (np.ndarray)
+"""
+
+
+def cider_d(references: list, hypotheses: list, max_n: int = 4, sigma: float = 6.0):
+    corpus = _Corpus(references, hypotheses)
+    n_images, n_refs = len(hypotheses), len(corpus.ref_images)
+    if n_images == 0:
+        return 0.0, np.zeros(0)
+    refs_per_image = np.maximum(np.bincount(corpus.ref_images, minlength=n_images), 1)
+    length_penalty = np.exp(
+        -((corpus.hyp_lengths[corpus.ref_images] - corpus.ref_lengths) ** 2)
+        / (2 * sigma**2)
+    )
+
+    scores = np.zeros(n_images)
+    for n in range(1, max_n + 1):
+        hyp_keys, hyp_counts, ref_keys, ref_counts, n_codes = corpus.ngrams(n)
+        hyp_captions, hyp_codes = hyp_keys // n_codes, hyp_keys % n_codes
+        ref_captions, ref_codes = ref_keys // n_codes, ref_keys % n_codes
+        ref_image_of_key = corpus.ref_images[ref_captions]
+
+        # document frequency: the number of images whose references contain the n-gram
+        image_codes = np.unique(ref_image_of_key * n_codes + ref_codes) % n_codes
+        document_frequency = np.bincount(image_codes, minlength=n_codes)
+        idf = np.log(n_images) - np.log(np.maximum(document_frequency, 1))
+
+        hyp_weights = hyp_counts * idf[hyp_codes]
+        ref_weights = ref_counts * idf[ref_codes]
+        hyp_norms = np.sqrt(np.bincount(hyp_captions, hyp_weights**2, minlength=n_images))
+        ref_norms = np.sqrt(np.bincount(ref_captions, ref_weights**2, minlength=n_refs))
+
+        # the weight of each reference n-gram in the hypothesis of the same image
+        matched = _lookup(hyp_keys, hyp_weights, ref_image_of_key * n_codes + ref_codes)
+        numerators = np.bincount(
+            ref_captions, np.minimum(matched, ref_weights) * ref_weights, minlength=n_refs
+        )
+        denominators = hyp_norms[corpus.ref_images] * ref_norms
+        similarities = np.divide(
+            numerators,
+            denominators,
+            out=np.zeros(n_refs),
+            where=denominators > 0,
+        )
+        similarities *= length_penalty
+        scores += np.bincount(corpus.ref_images, similarities, minlength=n_images)
+
+    scores = 10.0 * scores / max_n / refs_per_image
+    return float(scores.mean()), scores
+
+
+################################################################################################
+
+"""
+This class holds a corpus of hypotheses and references as integer arrays, and computes
+the n-gram counts used by corpus_bleu and cider_d. The n-gram codes of the hypotheses
+and of the references are made compact together, so that a (caption, n-gram) couple
+fits in one int64 key: caption * n_codes + code.
+"""
+
+
+class _Corpus:
+    def __init__(self, references: list, hypotheses: list):
+        word_ids = {}
+        self.hyp_ids, self.hyp_offsets = encode_captions(hypotheses, word_ids)
+        flat_references = [caption for captions in references for caption in captions]
+        self.ref_ids, self.ref_offsets = encode_captions(flat_references, word_ids)
+        self.ref_images = np.repeat(
+            np.arange(len(references)),
+            np.fromiter((len(captions) for captions in references), dtype=np.int64),
+        )
+        self.hyp_lengths = np.diff(self.hyp_offsets)
+        self.ref_lengths = np.diff(self.ref_offsets)
+        self.base = max(1, len(word_ids))
+
+    def ngrams(self, n: int):
+        hyp_captions, hyp_codes = ngram_codes(self.hyp_ids, self.hyp_offsets, n, self.base)
+        ref_captions, ref_codes = ngram_codes(self.ref_ids, self.ref_offsets, n, self.base)
+        codes, inverse = np.unique(
+            np.concatenate((hyp_codes, ref_codes)), return_inverse=True
+        )
+        n_codes = max(1, len(codes))
+        hyp_keys, hyp_counts = _ngram_counts(
+            hyp_captions, inverse[: len(hyp_codes)], n_codes
+        )
+        ref_keys, ref_counts = _ngram_counts(
+            ref_captions, inverse[len(hyp_codes) :], n_codes
+        )
+        return hyp_keys, hyp_counts, ref_keys, ref_counts, n_codes
+
+
+def _lookup(keys: np.ndarray, values: np.ndarray, queries: np.ndarray) -> np.ndarray:
+    # the value of each query in (sorted keys, values), 0 for the missing queries
+    if len(keys) == 0:
+        return np.zeros(len(queries), dtype=values.dtype)
+    positions = np.minimum(np.searchsorted(keys, queries), len(keys) - 1)
+    return np.where(keys[positions] == queries, values[positions], 0)
+
+
+################################################################################################
+
+"""
+This function measures how often two decoders generate the same tokens.
+Args:
+    tokens_a, tokens_b: torch.Tensor or np.ndarray; the generated tokens (batch, length)
+    lengths_a, lengths_b: the length of each caption (batch,)
+Returns:
+    a dictionary with the fraction of equal tokens (over the longest of the two captions)
+    and the fraction of identical captions
+"""
+
+
+def token_agreement(tokens_a, lengths_a, tokens_b, lengths_b) -> dict:
+    tokens_a, tokens_b = np.asarray(tokens_a), np.asarray(tokens_b)
+    lengths_a, lengths_b = np.asarray(lengths_a), np.asarray(lengths_b)
+    # padding both outputs to the same width, with -1 after the end of each caption
+    width = max(tokens_a.shape[1], tokens_b.shape[1])
+    positions = np.arange(width)
+    padded = []
+    for tokens, lengths in ((tokens_a, lengths_a), (tokens_b, lengths_b)):
+        tokens = np.pad(tokens, ((0, 0), (0, width - tokens.shape[1])), constant_values=-1)
+        padded.append(np.where(positions < lengths[:, None], tokens, -1))
+
+    compared = positions < np.maximum(lengths_a, lengths_b)[:, None]
+    equal = (padded[0] == padded[1]) & compared
+    return {
+        "token_agreement": float(equal.sum() / max(1, compared.sum())),
+        "exact_match": float(np.mean(equal.sum(axis=1) == compared.sum(axis=1))),
+    }
+
+
+################################################################################################
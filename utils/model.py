@@ -2,14 +2,33 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-import matplotlib.pyplot as plt
-import numpy as np
+from utils.instrument import instrumented
+
+# the training mode of a model, saved in its state dict (see ImageCaptioningModel):
+# "unknown" is the mode of a state dict saved before the mode was recorded
+TRAINING_MODES = ("untrained", "teacher_forcing", "prefixes", "unknown")
 
 # Assuming the ImageCaptioningModel is defined as in the previous response
+# adaptive_cutoffs (optional) replaces the output layer by a frequency-bucketed adaptive
+# softmax: the words below the first cutoff form the head, the rarer ones are split into
+# smaller clusters, so the word indices must be sorted by decreasing frequency (Vocabulary).
 class ImageCaptioningModel(nn.Module):
-    def __init__(self, target_size, vocabulary_size, embedding_dim, device):
+    def __init__(
+        self,
+        target_size,
+        vocabulary_size,
+        embedding_dim,
+        device,
+        adaptive_cutoffs=None,
+        adaptive_div_value=4.0,
+    ):
         super(ImageCaptioningModel, self).__init__()
         self.device = device
+        self.adaptive = adaptive_cutoffs is not None
+        # set by Trainer.fit: the incremental decoders (init_state / step) start from a
+        # zero LSTM state like forward_sequence, not from the left padding of forward.
+        # A persistent buffer, so that the mode is saved with the weights.
+        self.register_buffer("_training_mode", torch.tensor(0, dtype=torch.int8))
         self.to(self.device)
 
         # # Convolutional layers for feature extraction
@@ -35,9 +54,37 @@ class ImageCaptioningModel(nn.Module):
 
         # Decoder layers
         self.fc2 = nn.Linear(256 + 256, 256)
-        self.fc3 = nn.Linear(256, vocabulary_size)
+        if self.adaptive:
+            self.fc3 = nn.AdaptiveLogSoftmaxWithLoss(
+                256, vocabulary_size, list(adaptive_cutoffs), div_value=adaptive_div_value
+            )
+        else:
+            self.fc3 = nn.Linear(256, vocabulary_size)
+
+    # One of TRAINING_MODES.
+    @property
+    def training_mode(self) -> str:
+        return TRAINING_MODES[int(self._training_mode)]
+
+    @training_mode.setter
+    def training_mode(self, mode: str) -> None:
+        self._training_mode.fill_(TRAINING_MODES.index(mode))
+
+    # The state dicts saved before the training mode was recorded load with the
+    # "unknown" mode (the decoders warn about it) instead of failing.
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        key = prefix + "_training_mode"
+        if key not in state_dict:
+            state_dict[key] = torch.tensor(TRAINING_MODES.index("unknown"), dtype=torch.int8)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
+    # on GPU, the instrumented times are launch times (the kernels run asynchronously)
+    @instrumented("model.forward")
     def forward(self, input_1, input_2):
+        return self.output(self.hidden(input_1, input_2))
+
+    # Hidden state of the decoder (before the output layer) for a batch of prefixes.
+    def hidden(self, input_1, input_2):
         # # Convolutional layers
         # x1 = F.relu(self.conv1(input_1))
         # x1 = self.pool1(x1)
@@ -62,7 +109,97 @@ class ImageCaptioningModel(nn.Module):
         # Decoder layers
         x = torch.cat((x1, x2), dim=1)
         x = F.relu(self.fc2(x))
-        x = self.fc3(x)
 
         return x
-    
+
+    # Teacher-forced forward pass over whole captions: the LSTM runs once per caption
+    # and the logits of every timestep are returned, shape (batch, length, vocabulary_size).
+    # The logits at position t predict the token at position t + 1 of the caption.
+    @instrumented("model.forward_sequence")
+    def forward_sequence(self, input_1, input_2):
+        return self.output(self.hidden_sequence(input_1, input_2))
+
+    def hidden_sequence(self, input_1, input_2):
+        x1 = F.relu(self.fc1(input_1))
+
+        x2 = self.embedding(input_2)
+        x2 = self.dropout2(x2)
+        x2, _ = self.lstm(x2)  # (batch, length, 256)
+
+        # the same image projection is used at every timestep
+        x1 = x1.unsqueeze(1).expand(-1, x2.size(1), -1)
+        x = torch.cat((x1, x2), dim=2)
+        x = F.relu(self.fc2(x))
+
+        return x
+
+    # Output layer. With the adaptive softmax, the log-probabilities are returned: they
+    # can be used as logits (argmax, softmax, log_softmax and top-k are unchanged).
+    def output(self, x):
+        if self.adaptive:
+            return self.fc3.log_prob(x.reshape(-1, x.size(-1))).view(*x.shape[:-1], -1)
+        return self.fc3(x)
+
+    # Training loss of a batch of prefixes (lengths=None, targets of shape (batch,)) or
+    # of teacher-forced captions (targets and lengths as in sequence_loss). The adaptive
+    # softmax only evaluates the head and the clusters of the targets, never the full
+    # vocabulary.
+    @instrumented("model.loss")
+    def loss(self, input_1, input_2, targets, lengths=None):
+        if lengths is None:
+            x = self.hidden(input_1, input_2)
+        else:
+            x = self.hidden_sequence(input_1, input_2)
+            mask = torch.arange(targets.size(1), device=targets.device) < lengths.to(
+                targets.device
+            ).unsqueeze(1)
+            x, targets = x[mask], targets[mask]
+        if self.adaptive:
+            # the adaptive softmax mixes the dtypes of its outputs under autocast
+            with torch.autocast(x.device.type, enabled=False):
+                return self.fc3(x.float(), targets).loss
+        return F.cross_entropy(self.fc3(x).float(), targets)
+
+    # Incremental decoding: init_state computes the image projection once and the
+    # initial (h, c) of the LSTM, then each call to step feeds one token per caption
+    # and carries the state forward, so each generated token costs O(1) work.
+    # step gives the same logits as forward_sequence on the tokens fed so far.
+    def init_state(self, input_1):
+        x1 = F.relu(self.fc1(input_1))
+        h = x1.new_zeros(self.lstm.num_layers, x1.size(0), self.lstm.hidden_size)
+        c = x1.new_zeros(self.lstm.num_layers, x1.size(0), self.lstm.hidden_size)
+        return x1, h, c
+
+    @instrumented("model.step")
+    def step(self, state, tokens):
+        x, state = self.step_hidden(state, tokens)
+        return self.output(x), state
+
+    # Greedy step: with the adaptive softmax, the clusters are only evaluated for the
+    # rows whose most likely head entry is a cluster.
+    def predict_step(self, state, tokens):
+        x, state = self.step_hidden(state, tokens)
+        if self.adaptive:
+            return self.fc3.predict(x), state
+        return self.fc3(x).argmax(dim=-1), state
+
+    def step_hidden(self, state, tokens):
+        x1, h, c = state
+        x2 = self.embedding(tokens.unsqueeze(1))  # (batch, 1, embedding_dim)
+        x2 = self.dropout2(x2)
+        x2, (h, c) = self.lstm(x2, (h, c))
+
+        x = torch.cat((x1, x2[:, 0, :]), dim=1)
+        x = F.relu(self.fc2(x))
+
+        return x, (x1, h, c)
+
+
+# Cross-entropy of the logits of forward_sequence, ignoring the padded timesteps
+# (positions t >= lengths[i] of the caption i).
+def sequence_loss(logits, targets, lengths):
+    mask = torch.arange(targets.size(1), device=targets.device) < lengths.to(
+        targets.device
+    ).unsqueeze(1)
+    return F.cross_entropy(logits[mask], targets[mask])
+
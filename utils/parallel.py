@@ -0,0 +1,79 @@
+import os, sys
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+"""
+This function applies a function to every item of a list using a pool of workers,
+and returns the results in the same order as the items.
+Threads are used by default since PIL and OpenCV release the GIL while decoding,
+resizing and encoding images. Processes can be used for pure Python work
+(the function must then be defined at the top level of a module).
+Args:
+    function: callable; the function to apply to each item
+    items: iterable; the items to process
+    workers: int=None; the number of workers (all the cores by default)
+    backend: str="thread"; "thread" or "process"
+    progress: bool or callable=False; whether to print the progress, or a function
+        called as progress(done, total) after each item
+    desc: str="processing"; the label printed with the progress
+    chunksize: int=1; the number of items sent at once to a process worker
+"""
+
+
+def parallel_map(
+    function,
+    items,
+    workers: int = None,
+    backend: str = "thread",
+    progress=False,
+    desc: str = "processing",
+    chunksize: int = 1,
+) -> list:
+    items = list(items)
+    total = len(items)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, total))
+
+    if callable(progress):
+        report = progress
+    elif progress:
+        step = max(1, total // 100)  # printing at most a hundred updates
+
+        def report(done: int, total: int) -> None:
+            if done % step == 0 or done == total:
+                print(f"\r{desc}: {done}/{total}", end="" if done < total else "\n")
+                sys.stdout.flush()
+
+    else:
+        report = None
+
+    if workers == 1:  # no need for a pool
+        iterator = map(function, items)
+        return _collect(iterator, total, report)
+
+    if backend == "thread":
+        executor_class = ThreadPoolExecutor
+    elif backend == "process":
+        executor_class = ProcessPoolExecutor
+    else:
+        raise ValueError("Unsupported backend. Please use 'thread' or 'process'.")
+
+    with executor_class(max_workers=workers) as executor:
+        # executor.map yields the results in the order of the items
+        if backend == "process":
+            iterator = executor.map(function, items, chunksize=chunksize)
+        else:
+            iterator = executor.map(function, items)
+        return _collect(iterator, total, report)
+
+
+def _collect(iterator, total: int, report) -> list:
+    results = []
+    for result in iterator:
+        results.append(result)
+        if report is not None:
+            report(len(results), total)
+    return results
+
+
+################################################################################################
@@ -1,80 +1,230 @@
-import os, string, cv2, numpy as np
-from PIL import Image, ImageOps
+import os, json, string, numpy as np
+from utils.store import LazyImageStore
+from utils.parallel import parallel_map
+from utils.instrument import instrumented, timed
 
 """
 This function adds padding if necessary to all images in the dataset,
 so that the resulting dataset has an homogeneous size.
+The images are processed in parallel by a pool of threads.
 Args:
     input_folder: str; the path to the input folder (original dataset)
     output_folder: str; the path to the folder where you want the new dataset stored
     target_size: tuple; the target size of all images
     padding_color: tuple=(0, 0, 0); the color of the padding (black by default)
+    workers: int=None; the number of threads (all the cores by default)
+    progress: bool=False; whether to print the progress
 """
 
 
+@instrumented("preprocessing.pad_images")
 def pad_images(
     input_folder: str,
     output_folder: str,
     target_size: tuple,
     padding_color: tuple = (0, 0, 0),
+    workers: int = None,
+    progress: bool = False,
 ) -> None:
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
-    for filename in os.listdir(input_folder):
-        if filename.endswith((".png", ".jpg", ".jpeg")):
-            img = Image.open(os.path.join(input_folder, filename))
-
-            # calculating the padding needed for width and height
-            delta_width = target_size[0] - img.size[0]
-            delta_height = target_size[1] - img.size[1]
-            padding = (
-                delta_width // 2,
-                delta_height // 2,
-                delta_width - (delta_width // 2),
-                delta_height - (delta_height // 2),
-            )
-
-            # adding padding
+    jobs = [
+        (
+            os.path.join(input_folder, filename),
+            os.path.join(output_folder, filename),
+            target_size,
+            padding_color,
+        )
+        for filename in os.listdir(input_folder)
+        if filename.endswith((".png", ".jpg", ".jpeg"))
+    ]
+    parallel_map(_pad_image, jobs, workers, progress=progress, desc="padding")
+
+
+def _pad_image(job: tuple) -> None:
+    from PIL import Image, ImageOps
+
+    input_path, output_path, target_size, padding_color = job
+    with Image.open(input_path) as img:
+        with timed("preprocessing.decode"):
+            img.load()
+        # calculating the padding needed for width and height
+        delta_width = target_size[0] - img.size[0]
+        delta_height = target_size[1] - img.size[1]
+        padding = (
+            delta_width // 2,
+            delta_height // 2,
+            delta_width - (delta_width // 2),
+            delta_height - (delta_height // 2),
+        )
+
+        # adding padding
+        with timed("preprocessing.pad"):
             img_padded = ImageOps.expand(img, padding, fill=padding_color)
-            img_padded.save(os.path.join(output_folder, filename))
+        with timed("preprocessing.encode"):
+            img_padded.save(output_path)
+
+
+################################################################################################
+
+"""
+This function resizes an image to fit in a target size while keeping its aspect
+ratio, and pads the remaining borders (letterboxing).
+Args:
+    img: PIL.Image; the image
+    target_size: tuple; the (width, height) of the result
+    padding_color: tuple=(0, 0, 0); the color of the padding (black by default)
+"""
+
+
+def letterbox_image(
+    img: "Image.Image", target_size: tuple, padding_color: tuple = (0, 0, 0)
+) -> "Image.Image":
+    from PIL import Image
+
+    img = img.convert("RGB")
+    scale = min(target_size[0] / img.size[0], target_size[1] / img.size[1])
+    new_size = (
+        max(1, round(img.size[0] * scale)),
+        max(1, round(img.size[1] * scale)),
+    )
+    resized = img.resize(new_size, Image.BILINEAR)
+
+    letterboxed = Image.new("RGB", target_size, padding_color)
+    letterboxed.paste(
+        resized,
+        ((target_size[0] - new_size[0]) // 2, (target_size[1] - new_size[1]) // 2),
+    )
+    return letterboxed
+
+
+################################################################################################
+
+"""
+This function letterboxes all the images of a folder to the input size of the model
+in one pass, and writes them as fixed-shape uint8 tensors into sharded binary files
+(shard_00000.u8, ...) with an index (index.json), instead of re-encoded JPEGs.
+The shards can then be memory-mapped with utils.store.ShardedImageStore, with no
+JPEG decoding at all. Each worker writes its image directly into the shard.
+Args:
+    input_folder: str; the path to the input folder (original dataset)
+    output_folder: str; the path to the folder where the shards are written
+    target_size: tuple=(299, 299); the (width, height) of the stored images
+    shard_size: int=1024; the number of images per shard
+    padding_color: tuple=(0, 0, 0); the color of the padding (black by default)
+    workers: int=None; the number of threads (all the cores by default)
+    progress: bool=False; whether to print the progress
+"""
+
+
+@instrumented("preprocessing.pack_images")
+def pack_images(
+    input_folder: str,
+    output_folder: str,
+    target_size: tuple = (299, 299),
+    shard_size: int = 1024,
+    padding_color: tuple = (0, 0, 0),
+    workers: int = None,
+    progress: bool = False,
+) -> None:
+    os.makedirs(output_folder, exist_ok=True)
+    filenames = sorted(
+        f for f in os.listdir(input_folder) if f.endswith((".png", ".jpg", ".jpeg"))
+    )
+    shape = (target_size[1], target_size[0], 3)  # arrays are (height, width, channels)
+
+    shards = []
+    for shard_index, start in enumerate(range(0, len(filenames), shard_size)):
+        shard_filenames = filenames[start : start + shard_size]
+        shard_file = f"shard_{shard_index:05d}.u8"
+        shard = np.memmap(
+            os.path.join(output_folder, shard_file),
+            dtype=np.uint8,
+            mode="w+",
+            shape=(len(shard_filenames),) + shape,
+        )
+        jobs = [
+            (os.path.join(input_folder, filename), shard, slot, target_size, padding_color)
+            for slot, filename in enumerate(shard_filenames)
+        ]
+        parallel_map(
+            _letterbox_into_shard,
+            jobs,
+            workers,
+            progress=progress,
+            desc=f"packing {shard_file}",
+        )
+        shard.flush()
+        del shard
+        shards.append({"file": shard_file, "count": len(shard_filenames)})
+
+    index = {
+        "shape": list(shape),
+        "shard_size": shard_size,
+        "shards": shards,
+        "names": filenames,
+    }
+    with open(os.path.join(output_folder, "index.json"), "w") as f:
+        json.dump(index, f)
+
+
+def _letterbox_into_shard(job: tuple) -> None:
+    from PIL import Image
+
+    image_path, shard, slot, target_size, padding_color = job
+    with Image.open(image_path) as img:
+        with timed("preprocessing.decode"):
+            img.load()
+        with timed("preprocessing.letterbox"):
+            shard[slot] = np.asarray(letterbox_image(img, target_size, padding_color))
 
 
 ################################################################################################
 
 """
 This function resizes an image dictionary to a target size.
+If the dictionary is a LazyImageStore, the resizing is done lazily on access.
 """
 
 
 def resize_image_dictionary(
     img_dict: dict[str, np.ndarray], target_size: tuple[int]
 ) -> dict[str, np.ndarray]:
+    if isinstance(img_dict, LazyImageStore):
+        return img_dict.map(lambda img_arr: _resize(img_arr, target_size))
     return {
-        img_name: cv2.resize(img_arr, target_size)
+        img_name: _resize(img_arr, target_size)
         for img_name, img_arr in img_dict.items()
     }
 
 
+def _resize(img_arr: np.ndarray, target_size: tuple) -> np.ndarray:
+    import cv2
+
+    with timed("preprocessing.resize"):
+        return cv2.resize(img_arr, target_size)
+
+
 ################################################################################################
 
 """
 This function is used to get the vocabulary (all the unique words in the captions).
+See utils.vocabulary.Vocabulary for the indexed vocabulary used by the model.
 Args:
     captions: dict; the dictionary containing all the captions in the dataset
 """
 
 
+@instrumented("preprocessing.get_vocabulary")
 def get_vocabulary(captions: dict) -> set:
-    text = " ".join(
-        [" ".join(captions[img_name]) for img_name in list(captions.keys())]
-    )
-    # removing all puncutation characters from the text
+    # removing all puncutation characters from the captions, one caption at a time
     translator = str.maketrans("", "", string.punctuation)
-    text = text.translate(translator)
-    all_words = text.split(" ")
-    vocabulary = set(all_words)
-    vocabulary.remove("")
+    vocabulary = set()
+    for image_captions in captions.values():
+        for caption in image_captions:
+            vocabulary.update(caption.translate(translator).split(" "))
+    vocabulary.discard("")
 
     return vocabulary
 
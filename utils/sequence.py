@@ -0,0 +1,76 @@
+import numpy as np
+
+"""
+This function pads (and truncates) a list of token sequences to the same length, like
+keras.preprocessing.sequence.pad_sequences, with numpy only (importing TensorFlow for
+it adds seconds to the start of the process). The padding is vectorized: the sequences
+are concatenated once and scattered into the output array.
+Args:
+    sequences: list; the sequences of token ids (lists or 1-D arrays)
+    maxlen: int=None; the length of the output (the longest sequence if None)
+    dtype: str="int32"; the type of the output
+    padding: str="pre"; "pre" or "post", where the padding values are added
+    truncating: str="pre"; "pre" or "post", where the longer sequences are cut
+    value: int=0; the padding value
+Returns:
+    an np.ndarray of shape (len(sequences), maxlen)
+"""
+
+
+def pad_sequences(
+    sequences: list,
+    maxlen: int = None,
+    dtype: str = "int32",
+    padding: str = "pre",
+    truncating: str = "pre",
+    value=0,
+) -> np.ndarray:
+    if padding not in ("pre", "post"):
+        raise ValueError(f'padding must be "pre" or "post", not {padding!r}')
+    if truncating not in ("pre", "post"):
+        raise ValueError(f'truncating must be "pre" or "post", not {truncating!r}')
+    lengths = np.fromiter((len(sequence) for sequence in sequences), dtype=np.int64)
+    if maxlen is None:
+        maxlen = int(lengths.max()) if len(lengths) else 0
+    padded = np.full((len(lengths), maxlen), value, dtype=dtype)
+    if len(lengths) == 0 or lengths.sum() == 0 or maxlen == 0:
+        return padded
+
+    flat = np.concatenate([np.asarray(sequence).ravel() for sequence in sequences])
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    kept = np.minimum(lengths, maxlen)
+    # the first kept token of each sequence, and its column in the output
+    first = offsets + (lengths - kept if truncating == "pre" else 0)
+    column = maxlen - kept if padding == "pre" else np.zeros_like(kept)
+
+    rows = np.repeat(np.arange(len(lengths)), kept)
+    within = np.arange(kept.sum()) - np.repeat(np.cumsum(kept) - kept, kept)
+    padded[rows, np.repeat(column, kept) + within] = flat[np.repeat(first, kept) + within]
+    return padded
+
+
+################################################################################################
+
+"""
+This function one-hot encodes class indices, like keras.utils.to_categorical.
+Args:
+    y: array-like; the class indices (any shape)
+    num_classes: int=None; the number of classes (the largest index + 1 if None)
+    dtype: str="float32"; the type of the output
+Returns:
+    an np.ndarray of shape y.shape + (num_classes,) (a trailing axis of size 1 in y is
+    dropped first, as keras does)
+"""
+
+
+def to_categorical(y, num_classes: int = None, dtype: str = "float32") -> np.ndarray:
+    y = np.asarray(y, dtype=np.int64)
+    shape = y.shape
+    if len(shape) > 1 and shape[-1] == 1:
+        shape = shape[:-1]
+    y = y.ravel()
+    if num_classes is None:
+        num_classes = int(y.max()) + 1 if len(y) else 0
+    categorical = np.zeros((len(y), num_classes), dtype=dtype)
+    categorical[np.arange(len(y)), y] = 1
+    return categorical.reshape(shape + (num_classes,))
@@ -0,0 +1,351 @@
+import sys, io, json, time, base64, argparse, threading, queue, numpy as np
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from utils.extract import InceptionV3Extractor, load_and_preprocess
+from utils.export import load_model, decode
+
+"""
+This class keeps the latencies of the last requests and the throughput counters
+of the server. It is thread-safe.
+Args:
+    window: int=10000; the number of latencies kept to compute the percentiles
+"""
+
+
+class LatencyStats:
+    def __init__(self, window: int = 10000):
+        self.latencies = deque(maxlen=window)
+        self.requests, self.batches, self.errors = 0, 0, 0
+        self.start_time = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def record_batch(self, latencies: list, errors: int = 0) -> None:
+        with self._lock:
+            self.latencies.extend(latencies)
+            self.requests += len(latencies)
+            self.batches += 1
+            self.errors += errors
+
+    def summary(self) -> dict:
+        with self._lock:
+            latencies = np.array(self.latencies, dtype=np.float64) * 1000
+            requests, batches, errors = self.requests, self.batches, self.errors
+        elapsed = time.perf_counter() - self.start_time
+        return {
+            "requests": requests,
+            "errors": errors,
+            "batches": batches,
+            "mean_batch_size": requests / batches if batches else 0.0,
+            "throughput_per_s": requests / elapsed if elapsed > 0 else 0.0,
+            "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+        }
+
+
+################################################################################################
+
+"""
+This class groups the items submitted concurrently into micro-batches that are
+processed by a single background thread. A batch is processed as soon as it has
+max_batch_size items, or max_wait_ms after its first item arrived.
+Args:
+    process_batch: callable; takes a list of items and returns the list of their results
+    max_batch_size: int=16; the maximum number of items in a batch
+    max_wait_ms: float=10; the maximum time the first item of a batch waits for others
+    stats: LatencyStats=None; where the latencies are recorded
+"""
+
+
+class MicroBatcher:
+    def __init__(
+        self,
+        process_batch,
+        max_batch_size: int = 16,
+        max_wait_ms: float = 10,
+        stats: LatencyStats = None,
+    ):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.stats = stats if stats is not None else LatencyStats()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, item) -> Future:
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = first[2] + self.max_wait
+            # collecting more items until the batch is full or the deadline is reached
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if entry is None:
+                    self._queue.put(None)  # stopping after this batch
+                    break
+                batch.append(entry)
+            self._process(batch)
+
+    def _process(self, batch: list) -> None:
+        items = [item for item, _, _ in batch]
+        try:
+            results = self.process_batch(items)
+        except Exception as error:  # the whole batch fails
+            results = [error] * len(batch)
+
+        end_time, latencies, errors = time.perf_counter(), [], 0
+        for (_, future, submit_time), result in zip(batch, results):
+            latencies.append(end_time - submit_time)
+            if isinstance(result, Exception):
+                errors += 1
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+        self.stats.record_batch(latencies, errors)
+
+
+################################################################################################
+
+"""
+This class loads the feature extractor and the captioning model once (with
+utils.export.load_model, so either a state dict or an exported artifact), and captions
+batches of requests. A request is a dict with either a "path" to an image file or
+the base64-encoded bytes of an image in "image".
+Args:
+    model_path: str; the state dict of ImageCaptioningModel, or an exported artifact
+    word_to_int: str, Vocabulary or dict=None; the vocabulary of a state dict (a file,
+        the object or the mapping from the words to their indices), None for an artifact
+    max_length: int=None; the maximum number of generated tokens (required with a state
+        dict, the one of the artifact by default)
+    embedding_dim: int=200; the embedding dimension of a state dict
+    beam_width: int=1; greedy decoding if 1, beam search otherwise
+    device: str=None; the torch device (cuda if available by default)
+    extractor: callable=None; the feature extractor (InceptionV3Extractor by default)
+    adaptive_cutoffs: list=None; the adaptive softmax cutoffs of a state dict
+"""
+
+
+class CaptionService:
+    def __init__(
+        self,
+        model_path: str,
+        word_to_int=None,
+        max_length: int = None,
+        embedding_dim: int = 200,
+        beam_width: int = 1,
+        device: str = None,
+        extractor=None,
+        adaptive_cutoffs: list = None,
+    ):
+        self.model, self.vocabulary, self.max_length = load_model(
+            model_path, word_to_int, max_length, embedding_dim, adaptive_cutoffs, device
+        )
+        self.beam_width = beam_width
+
+        self.extractor = extractor if extractor is not None else InceptionV3Extractor()
+        # an artifact records the extractor its model was trained with
+        expected = getattr(self.model, "config", {}).get("extractor")
+        if expected is not None and expected != self.extractor.identity:
+            raise ValueError(
+                f"{model_path} expects the features of {expected}, "
+                f"not of {self.extractor.identity}."
+            )
+
+    def _read(self, request: dict) -> np.ndarray:
+        if "path" in request:
+            source = request["path"]
+        elif "image" in request:
+            source = io.BytesIO(base64.b64decode(request["image"]))
+        else:
+            raise ValueError('A request needs a "path" or an "image" field.')
+        return load_and_preprocess(source, self.extractor.target_size)
+
+    def caption_batch(self, requests: list) -> list:
+        # the requests that cannot be read fail alone, the others are captioned together
+        images, results = [], [None] * len(requests)
+        for i, request in enumerate(requests):
+            try:
+                images.append((i, self._read(request)))
+            except Exception as error:
+                results[i] = error
+        if not images:
+            return results
+
+        features = self.extractor(np.stack([image for _, image in images]))
+        tokens, lengths = decode(
+            self.model, features, self.vocabulary, self.max_length, self.beam_width
+        )
+        tokens, lengths = tokens.tolist(), lengths.tolist()  # one host transfer
+        captions = [
+            self.vocabulary.decode(caption[:length])
+            for caption, length in zip(tokens, lengths)
+        ]
+        for (i, _), caption in zip(images, captions):
+            results[i] = caption
+        return results
+
+
+################################################################################################
+
+"""
+This function serves captions over stdin/stdout: each input line is a JSON request
+(see CaptionService, with an optional "id"), and each output line is a JSON object
+with the same "id" and the "caption" (or an "error"). The line {"stats": true}
+returns the latency and throughput counters. Lines are answered as soon as their
+batch is done, so the answers may come out of order.
+"""
+
+
+def serve_jsonl(batcher: MicroBatcher, input_stream=sys.stdin, output_stream=sys.stdout):
+    output_lock = threading.Lock()
+
+    def write(answer: dict) -> None:
+        with output_lock:
+            output_stream.write(json.dumps(answer) + "\n")
+            output_stream.flush()
+
+    def answer_when_done(request_id, future: Future) -> None:
+        error = future.exception()
+        if error is not None:
+            write({"id": request_id, "error": str(error)})
+        else:
+            write({"id": request_id, "caption": future.result()})
+
+    for line in input_stream:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError as error:
+            write({"error": f"invalid JSON: {error}"})
+            continue
+        if not isinstance(request, dict):  # e.g. a list or a number
+            write({"error": "a request must be a JSON object"})
+            continue
+        if request.get("stats"):
+            write({"id": request.get("id"), "stats": batcher.stats.summary()})
+            continue
+        future = batcher.submit(request)
+        future.add_done_callback(
+            lambda future, request_id=request.get("id"): answer_when_done(request_id, future)
+        )
+    batcher.close()  # answering the last requests before returning
+
+
+################################################################################################
+
+"""
+This function serves captions over HTTP:
+- POST /caption with a JSON request (see CaptionService) returns {"caption": ...}
+- GET /stats returns the latency and throughput counters
+"""
+
+
+def serve_http(batcher: MicroBatcher, host: str = "127.0.0.1", port: int = 8000):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status: int, answer: dict) -> None:
+            body = json.dumps(answer).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._send(200, batcher.stats.summary())
+            else:
+                self._send(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/caption":
+                self._send(404, {"error": "not found"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length))
+                caption = batcher.submit(request).result()
+            except Exception as error:
+                self._send(400, {"error": str(error)})
+                return
+            self._send(200, {"caption": caption})
+
+        def log_message(self, format, *args):  # keeping the console quiet
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f"serving captions on http://{host}:{port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+
+################################################################################################
+
+"""
+Command line entry point, for instance:
+    python -m utils.serve --model model_2.pth --vocab data/vocabulary.json --max-length 35
+    python -m utils.serve --model model_2_int8.pt --port 8000
+The model is either a state dict of ImageCaptioningModel with --vocab and --max-length,
+or an artifact of utils.export (which holds its vocabulary and max_length).
+"""
+
+
+def main(argv: list = None) -> None:
+    parser = argparse.ArgumentParser(description="Serve image captions.")
+    parser.add_argument("--model", required=True, help="state dict or exported artifact")
+    parser.add_argument("--vocab", default=None, help="saved Vocabulary or word_to_int JSON")
+    parser.add_argument("--max-length", type=int, default=None)
+    parser.add_argument("--embedding-dim", type=int, default=200)
+    parser.add_argument("--adaptive-cutoffs", type=int, nargs="+", default=None)
+    parser.add_argument("--beam-width", type=int, default=1)
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--max-wait-ms", type=float, default=10)
+    parser.add_argument("--device", default=None)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=None, help="serve over HTTP if given")
+    args = parser.parse_args(argv)
+    if args.vocab is not None and args.max_length is None:
+        parser.error("--max-length is required with --vocab")
+
+    service = CaptionService(
+        args.model,
+        args.vocab,
+        args.max_length,
+        args.embedding_dim,
+        args.beam_width,
+        args.device,
+        adaptive_cutoffs=args.adaptive_cutoffs,
+    )
+    batcher = MicroBatcher(service.caption_batch, args.max_batch_size, args.max_wait_ms)
+
+    if args.port is None:
+        serve_jsonl(batcher)
+    else:
+        serve_http(batcher, args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
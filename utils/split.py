@@ -1,6 +1,6 @@
-import os, json
-from PIL import Image
-from sklearn.model_selection import train_test_split
+import os, json, shutil
+from utils.store import LazyImageStore
+from utils.instrument import instrumented, timed
 
 """
 This function splits the dataset into three parts which proportions depend on the arguments.
@@ -74,32 +74,72 @@ test_size: float=0.1; size of the test subset
 
 ################################################################################################
 
+"""
+This function splits the dataset into a train and a test subset.
+When the images come from a LazyImageStore, no image is decoded: the subsets are
+LazyImageStores too, and the saved subsets are hard links to the original files.
+Args:
+image_arrays: dict; a dict containing (image_name: image np.array) couples
+image_captions: dict; a dict containing (image_name: captions list) couples
+save_folderpath=None; a folderpath to save the split dataset (optional)
+train_size: float=0.9; size of the train subset (in comparison with the original dataset)
+test_size: float=0.1; size of the test subset
+mode: str="auto"; how the images are saved: "encode" (re-encoding the arrays), "hardlink",
+    "symlink" or "copy" (of the original files, which needs a LazyImageStore),
+    "auto" links the files when possible and encodes the arrays otherwise
+random_state: int=42; the seed of the split
+"""
+
+
+@instrumented("split.split_and_save_data")
 def split_and_save_data(
     image_arrays: dict,
     image_captions: dict,
     save_folderpath=None,
     train_size: float = 0.9,
     test_size: float = 0.1,
+    mode: str = "auto",
+    random_state: int = 42,
 ):
     image_filenames = list(image_arrays.keys())  # splitting the dataset into train and test sets
-    train_filenames, test_filenames = train_test_split(
-        image_filenames, test_size=test_size, random_state=42
+    manifest = split_manifest(
+        image_filenames, test_size=test_size, random_state=random_state
     )
+    train_filenames = manifest["subsets"]["train"]["filenames"]
+    test_filenames = manifest["subsets"]["test"]["filenames"]
+
+    # the original files can only be linked if the arrays are the decoded files
+    on_disk = isinstance(image_arrays, LazyImageStore) and image_arrays.transform is None
+    if mode == "auto":
+        mode = "hardlink" if on_disk else "encode"
+    elif mode != "encode" and not on_disk:
+        raise ValueError(f"mode={mode} needs the images of a LazyImageStore.")
 
-    train_data = {filename: image_arrays[filename] for filename in train_filenames}
-    test_data = {filename: image_arrays[filename] for filename in test_filenames}
+    if isinstance(image_arrays, LazyImageStore):  # no image is decoded here
+        train_data = image_arrays.subset(train_filenames)
+        test_data = image_arrays.subset(test_filenames)
+    else:
+        train_data = {filename: image_arrays[filename] for filename in train_filenames}
+        test_data = {filename: image_arrays[filename] for filename in test_filenames}
 
     train_captions = {filename: image_captions[filename] for filename in train_filenames}
     test_captions = {filename: image_captions[filename] for filename in test_filenames}
 
-    if save_folderpath:  # Save the dataset if save_folderpath is specified
+    if save_folderpath and mode != "encode":  # only linking the files
+        materialize_split(
+            manifest, image_arrays.folderpath, save_folderpath, image_captions, mode
+        )
+    elif save_folderpath:  # Save the dataset if save_folderpath is specified
+        from PIL import Image
+
         os.makedirs(save_folderpath, exist_ok=True)
         # saving train data
         train_folder = os.path.join(save_folderpath, "train")
         os.makedirs(train_folder, exist_ok=True)
         for filename, image_array in train_data.items():
-            image = Image.fromarray(image_array)
-            image.save(os.path.join(train_folder, filename))
+            with timed("split.encode"):
+                image = Image.fromarray(image_array)
+                image.save(os.path.join(train_folder, filename))
         with open(os.path.join(train_folder, "image_captions.json"), "w") as f:
             json.dump(train_captions, f)
 
@@ -107,9 +147,179 @@ def split_and_save_data(
         test_folder = os.path.join(save_folderpath, "test")
         os.makedirs(test_folder, exist_ok=True)
         for filename, image_array in test_data.items():
-            image = Image.fromarray(image_array)
-            image.save(os.path.join(test_folder, filename))
+            with timed("split.encode"):
+                image = Image.fromarray(image_array)
+                image.save(os.path.join(test_folder, filename))
         with open(os.path.join(test_folder, "image_captions.json"), "w") as f:
             json.dump(test_captions, f)
+        _write_manifest(manifest, save_folderpath)
 
     return train_data, test_data, train_captions, test_captions
+
+
+################################################################################################
+
+"""
+This function splits a list of filenames into a train and a test subset, and returns
+a manifest (a dict) recording only the filenames and their indices in each subset.
+The split is reproducible through random_state.
+Args:
+filenames: list; the image filenames
+test_size: float=0.1; size of the test subset
+random_state: int=42; the seed of the split
+stratify: list=None; a label per filename, to keep the label proportions in both subsets
+groups: list=None; a group per filename (e.g. a photographer), a group is never split
+"""
+
+
+def split_manifest(
+    filenames: list,
+    test_size: float = 0.1,
+    random_state: int = 42,
+    stratify: list = None,
+    groups: list = None,
+) -> dict:
+    from sklearn.model_selection import train_test_split, GroupShuffleSplit
+
+    filenames = list(filenames)
+    indices = list(range(len(filenames)))
+    if groups is not None:
+        splitter = GroupShuffleSplit(
+            n_splits=1, test_size=test_size, random_state=random_state
+        )
+        train_indices, test_indices = next(splitter.split(indices, groups=groups))
+    else:
+        # splitting the filenames themselves, to keep the split of the first versions
+        train_filenames, test_filenames = train_test_split(
+            filenames, test_size=test_size, random_state=random_state, stratify=stratify
+        )
+        positions = {filename: i for i, filename in enumerate(filenames)}
+        train_indices = [positions[filename] for filename in train_filenames]
+        test_indices = [positions[filename] for filename in test_filenames]
+
+    return _manifest(
+        filenames, {"train": train_indices, "test": test_indices}, random_state
+    )
+
+
+################################################################################################
+
+"""
+This function generates the manifests of a k-fold cross-validation: in the manifest
+of fold k, the "test" subset is the k-th fold and the "train" subset the other folds.
+Args:
+filenames: list; the image filenames
+n_splits: int=5; the number of folds
+random_state: int=42; the seed of the shuffling
+stratify: list=None; a label per filename (StratifiedKFold)
+groups: list=None; a group per filename (GroupKFold, a group is never split)
+"""
+
+
+def kfold_manifests(
+    filenames: list,
+    n_splits: int = 5,
+    random_state: int = 42,
+    stratify: list = None,
+    groups: list = None,
+) -> list:
+    from sklearn.model_selection import KFold, StratifiedKFold, GroupKFold
+
+    filenames = list(filenames)
+    if groups is not None:
+        folds = GroupKFold(n_splits=n_splits).split(filenames, groups=groups)
+    elif stratify is not None:
+        splitter = StratifiedKFold(n_splits, shuffle=True, random_state=random_state)
+        folds = splitter.split(filenames, stratify)
+    else:
+        folds = KFold(n_splits, shuffle=True, random_state=random_state).split(filenames)
+
+    manifests = []
+    for fold, (train_indices, test_indices) in enumerate(folds):
+        manifest = _manifest(
+            filenames, {"train": train_indices, "test": test_indices}, random_state
+        )
+        manifest["fold"] = fold
+        manifests.append(manifest)
+    return manifests
+
+
+################################################################################################
+
+"""
+This function materializes a split manifest on disk: each subset becomes a folder
+whose images are hard links (or symbolic links, or copies) to the original files,
+with its image_captions.json, so that load_split_dataset can read it.
+No pixel is read or written, only file metadata.
+Args:
+manifest: dict; a manifest from split_manifest or kfold_manifests
+source_folderpath: str; the folder containing the original images
+save_folderpath: str; the folder of the split dataset
+image_captions: dict=None; a dict containing (image_name: captions list) couples
+link: str="hardlink"; "hardlink", "symlink" or "copy" (hard links fall back to
+    copies across file systems)
+"""
+
+
+@instrumented("split.materialize")
+def materialize_split(
+    manifest: dict,
+    source_folderpath: str,
+    save_folderpath: str,
+    image_captions: dict = None,
+    link: str = "hardlink",
+) -> None:
+    if link not in ("hardlink", "symlink", "copy"):
+        raise ValueError("Unsupported link. Please use 'hardlink', 'symlink' or 'copy'.")
+
+    for subset_name, subset in manifest["subsets"].items():
+        subset_folder = os.path.join(save_folderpath, subset_name)
+        os.makedirs(subset_folder, exist_ok=True)
+        for filename in subset["filenames"]:
+            source = os.path.abspath(os.path.join(source_folderpath, filename))
+            destination = os.path.join(subset_folder, filename)
+            if os.path.lexists(destination):  # replacing the file of a previous split
+                os.remove(destination)
+            _link_file(source, destination, link)
+
+        if image_captions is not None:
+            subset_captions = {
+                filename: image_captions[filename] for filename in subset["filenames"]
+            }
+            with open(os.path.join(subset_folder, "image_captions.json"), "w") as f:
+                json.dump(subset_captions, f)
+
+    _write_manifest(manifest, save_folderpath)
+
+
+def _link_file(source: str, destination: str, link: str) -> None:
+    if link == "symlink":
+        os.symlink(source, destination)
+        return
+    if link == "hardlink":
+        try:
+            os.link(source, destination)
+            return
+        except OSError:  # e.g. another file system, falling back to a copy
+            pass
+    shutil.copyfile(source, destination)
+
+
+def _manifest(filenames: list, subset_indices: dict, random_state: int) -> dict:
+    subsets = {}
+    for subset_name, indices in subset_indices.items():
+        indices = [int(i) for i in indices]
+        subsets[subset_name] = {
+            "indices": indices,
+            "filenames": [filenames[i] for i in indices],
+        }
+    return {"random_state": random_state, "subsets": subsets}
+
+
+def _write_manifest(manifest: dict, save_folderpath: str) -> None:
+    os.makedirs(save_folderpath, exist_ok=True)
+    with open(os.path.join(save_folderpath, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+
+
+################################################################################################
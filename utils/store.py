@@ -0,0 +1,156 @@
+import os, json, threading, numpy as np
+from collections import OrderedDict
+from collections.abc import Mapping
+from utils.instrument import timed
+
+"""
+This class is a read-only, dict-like view over a folder of images.
+Images are only decoded when they are accessed, and the decoded arrays are kept
+in an LRU cache whose total size is capped by a byte budget, so the memory used
+by the store does not grow with the size of the dataset.
+Args:
+    folderpath: str; the path to the folder containing the images
+    filenames: list; the image filenames (keys) exposed by the store, in order
+    cache_bytes: int=512MB; the maximum number of bytes kept in the cache
+    transform: callable=None; a function applied to each decoded np.array
+"""
+
+
+class LazyImageStore(Mapping):
+    def __init__(
+        self,
+        folderpath: str,
+        filenames: list,
+        cache_bytes: int = 512 * 2**20,
+        transform=None,
+    ):
+        self.folderpath = folderpath
+        self.filenames = list(filenames)
+        self.cache_bytes = cache_bytes
+        self.transform = transform
+        # keeping a set of the filenames for constant time membership tests
+        self._filename_set = set(self.filenames)
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+
+    def __getitem__(self, filename: str) -> np.ndarray:
+        if filename not in self._filename_set:
+            raise KeyError(filename)
+
+        with self._lock:
+            if filename in self._cache:
+                self._cache.move_to_end(filename)  # marking as most recently used
+                return self._cache[filename]
+
+        image_array = self._decode(filename)  # decoding outside the lock
+
+        with self._lock:
+            if filename not in self._cache and image_array.nbytes <= self.cache_bytes:
+                self._cache[filename] = image_array
+                self._cached_bytes += image_array.nbytes
+                # evicting the least recently used arrays until we fit the budget
+                while self._cached_bytes > self.cache_bytes:
+                    _, evicted = self._cache.popitem(last=False)
+                    self._cached_bytes -= evicted.nbytes
+        return image_array
+
+    def __iter__(self):
+        return iter(self.filenames)
+
+    def __len__(self) -> int:
+        return len(self.filenames)
+
+    def __contains__(self, filename) -> bool:
+        return filename in self._filename_set
+
+    def _decode(self, filename: str) -> np.ndarray:
+        from PIL import Image
+
+        with timed("load.decode"), Image.open(self.path(filename)) as image:
+            image_array = np.array(image)
+        if self.transform is not None:
+            with timed("store.transform"):
+                image_array = self.transform(image_array)
+        # the arrays are shared through the cache, so they must not be modified
+        image_array.setflags(write=False)
+        return image_array
+
+    def path(self, filename: str) -> str:
+        return os.path.join(self.folderpath, filename)
+
+    def subset(self, filenames: list) -> "LazyImageStore":
+        # returning a store restricted to some filenames (no image is decoded)
+        missing = [f for f in filenames if f not in self._filename_set]
+        if missing:
+            raise KeyError(missing[0])
+        return LazyImageStore(
+            self.folderpath, filenames, self.cache_bytes, self.transform
+        )
+
+    def map(self, transform) -> "LazyImageStore":
+        # returning a store that applies an extra transform after decoding
+        if self.transform is None:
+            composed = transform
+        else:
+            previous = self.transform
+            composed = lambda image_array: transform(previous(image_array))
+        return LazyImageStore(
+            self.folderpath, self.filenames, self.cache_bytes, composed
+        )
+
+    def clear_cache(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self._cached_bytes = 0
+
+    @property
+    def cached_bytes(self) -> int:
+        return self._cached_bytes
+
+
+################################################################################################
+
+"""
+This class is a read-only, dict-like view over the uint8 image shards written by
+utils.preprocessing.pack_images. The shards are memory-mapped, so accessing an
+image returns a (height, width, 3) view into the shard without any decoding or copy.
+Args:
+    folderpath: str; the folder containing the shards and index.json
+"""
+
+
+class ShardedImageStore(Mapping):
+    def __init__(self, folderpath: str):
+        self.folderpath = folderpath
+        with open(os.path.join(folderpath, "index.json"), "r") as f:
+            index = json.load(f)
+        self.shape = tuple(index["shape"])
+        self.shard_size = index["shard_size"]
+        self.filenames = index["names"]
+        self._positions = {name: i for i, name in enumerate(self.filenames)}
+        self._shards = [
+            np.memmap(
+                os.path.join(folderpath, shard["file"]),
+                dtype=np.uint8,
+                mode="r",
+                shape=(shard["count"],) + self.shape,
+            )
+            for shard in index["shards"]
+        ]
+
+    def __getitem__(self, filename: str) -> np.ndarray:
+        position = self._positions[filename]
+        return self._shards[position // self.shard_size][position % self.shard_size]
+
+    def __iter__(self):
+        return iter(self.filenames)
+
+    def __len__(self) -> int:
+        return len(self.filenames)
+
+    def __contains__(self, filename) -> bool:
+        return filename in self._positions
+
+
+################################################################################################
@@ -0,0 +1,220 @@
+import os, random, numpy as np, torch
+from torch.utils.data import DataLoader, Sampler
+from utils.dataset import CaptionSequenceDataset, collate_captions
+from utils.instrument import timed
+
+"""
+This sampler shuffles the dataset with a seed that depends on the epoch, so that the
+order of an epoch can be replayed when a run is resumed, and can start in the middle
+of the epoch (skipping the samples that were already seen, without loading them).
+"""
+
+
+class _EpochSampler(Sampler):
+    def __init__(self, dataset_size: int, seed: int):
+        self.dataset_size = dataset_size
+        self.seed = seed
+        self.epoch, self.start = 0, 0
+
+    def set_epoch(self, epoch: int, start: int = 0) -> None:
+        self.epoch, self.start = epoch, start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(self.dataset_size, generator=generator)
+        return iter(order[self.start :].tolist())
+
+    def __len__(self) -> int:
+        return self.dataset_size - self.start
+
+
+################################################################################################
+
+"""
+This class trains an ImageCaptioningModel:
+- a DataLoader with worker processes, prefetching and pinned memory (on GPU)
+- optional bfloat16 autocast (on CPU as well as on GPU) and gradient accumulation
+- periodic atomic checkpoints (model, optimizer, epoch, step, RNG states) from which
+  an interrupted run resumes exactly where it stopped
+The training mode follows the dataset: teacher forcing with forward_sequence for a
+CaptionSequenceDataset, one prefix per sample with forward otherwise. Only the models
+trained with teacher forcing can be decoded by utils.decode, so fit records the mode
+in the model (model.training_mode, saved in its state dict and in the checkpoints).
+Args:
+    model: ImageCaptioningModel; the model to train
+    dataset: CaptionPrefixDataset or CaptionSequenceDataset; the training samples
+    optimizer: torch.optim.Optimizer=None; Adam over the trainable parameters by default
+    batch_size: int=128; the number of samples per batch
+    num_workers: int=None; the number of DataLoader workers (half the cores by default)
+    bf16: bool=False; whether to use bfloat16 autocast
+    accumulation_steps: int=1; the number of batches whose gradients are accumulated
+    checkpoint_path: str=None; where the checkpoint is written (no checkpoint if None)
+    checkpoint_every: int=None; also write a checkpoint every this many batches
+    seed: int=42; the seed of the shuffling and of the random generators
+    log_every: int=10; the number of batches between two progress prints
+    profiler: torch.profiler.profile=None; stepped after every batch (see
+        utils.instrument.torch_profiler)
+"""
+
+
+class Trainer:
+    def __init__(
+        self,
+        model,
+        dataset,
+        optimizer=None,
+        batch_size: int = 128,
+        num_workers: int = None,
+        bf16: bool = False,
+        accumulation_steps: int = 1,
+        checkpoint_path: str = None,
+        checkpoint_every: int = None,
+        seed: int = 42,
+        log_every: int = 10,
+        profiler=None,
+    ):
+        self.model = model
+        self.device = torch.device(model.device)
+        self.sequence_mode = isinstance(dataset, CaptionSequenceDataset)
+        if optimizer is None:  # the frozen embedding layer is not optimized
+            optimizer = torch.optim.Adam(p for p in model.parameters() if p.requires_grad)
+        self.optimizer = optimizer
+        self.bf16 = bf16
+        self.accumulation_steps = accumulation_steps
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.seed = seed
+        self.log_every = log_every
+        self.profiler = profiler
+        self.epoch, self.step, self.history = 0, 0, []
+
+        if num_workers is None:
+            num_workers = max(0, (os.cpu_count() or 1) // 2)
+        self.batch_size = batch_size
+        self.sampler = _EpochSampler(len(dataset), seed)
+        self.loader = DataLoader(
+            dataset,
+            batch_size=batch_size,
+            sampler=self.sampler,
+            num_workers=num_workers,
+            pin_memory=self.device.type == "cuda",
+            persistent_workers=num_workers > 0,
+            prefetch_factor=4 if num_workers > 0 else None,
+            collate_fn=collate_captions if self.sequence_mode else None,
+        )
+
+    def _loss(self, batch) -> torch.Tensor:
+        # moving the batch to the device (no copy if it is already there)
+        if self.sequence_mode:
+            x1, x2, y, lengths = batch
+        else:
+            x1, x2, y = batch
+        x1 = x1.to(self.device, torch.float32, non_blocking=True)
+        x2 = x2.to(self.device, torch.long, non_blocking=True)
+        y = y.to(self.device, torch.long, non_blocking=True)
+
+        # the model computes its loss itself, so that an adaptive softmax head never
+        # evaluates the full vocabulary
+        with torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=self.bf16):
+            if self.sequence_mode:
+                return self.model.loss(x1, x2, y, lengths)
+            return self.model.loss(x1, x2, y)
+
+    def fit(self, num_epochs: int) -> list:
+        if self.checkpoint_path is not None and os.path.exists(self.checkpoint_path):
+            self.load_checkpoint(self.checkpoint_path)
+            print(f"resuming from epoch {self.epoch + 1}, batch {self.step + 1}")
+        else:
+            self._seed()
+
+        self.model.train()  # set the model to training mode
+        self.model.training_mode = "teacher_forcing" if self.sequence_mode else "prefixes"
+        if self.profiler is not None:
+            self.profiler.start()
+        while self.epoch < num_epochs:
+            self.sampler.set_epoch(self.epoch, self.step * self.batch_size)
+            n_batches = self.step + len(self.loader)
+            total_loss, n_losses = 0.0, 0
+            self.optimizer.zero_grad()
+
+            batches = iter(self.loader)
+            while True:
+                with timed("trainer.data"):  # the time spent waiting for the loader
+                    batch = next(batches, None)
+                if batch is None:
+                    break
+                with timed("trainer.step"):
+                    loss = self._loss(batch)
+                    (loss / self.accumulation_steps).backward()
+                    self.step += 1
+                    if self.step % self.accumulation_steps == 0 or self.step == n_batches:
+                        self.optimizer.step()
+                        self.optimizer.zero_grad()
+                if self.profiler is not None:
+                    self.profiler.step()
+
+                total_loss += loss.detach()  # no host synchronization here
+                n_losses += 1
+                if self.step % self.log_every == 0:
+                    print(
+                        f"\rEpoch [{self.epoch+1}/{num_epochs}], Batch [{self.step}/{n_batches}], Loss: {loss.item():.4f}",
+                        end="",
+                    )
+                if (
+                    self.checkpoint_every
+                    and self.step % self.checkpoint_every == 0
+                    and self.step % self.accumulation_steps == 0
+                ):
+                    self.save_checkpoint()
+
+            self.history.append(float(total_loss) / max(1, n_losses))
+            self.epoch, self.step = self.epoch + 1, 0
+            self.save_checkpoint()
+
+        if self.profiler is not None:
+            self.profiler.stop()
+        print("\nTraining completed.")
+        return self.history
+
+    def _seed(self) -> None:
+        random.seed(self.seed)
+        np.random.seed(self.seed)
+        torch.manual_seed(self.seed)
+
+    def save_checkpoint(self, path: str = None) -> None:
+        path = path or self.checkpoint_path
+        if path is None:
+            return
+        checkpoint = {
+            "model": self.model.state_dict(),
+            "optimizer": self.optimizer.state_dict(),
+            "epoch": self.epoch,
+            "step": self.step,
+            "history": self.history,
+            "rng": {
+                "python": random.getstate(),
+                "numpy": np.random.get_state(),
+                "torch": torch.get_rng_state(),
+                "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+            },
+        }
+        # writing to a temporary file first, so that a crash never leaves a broken checkpoint
+        tmp_path = path + ".tmp"
+        torch.save(checkpoint, tmp_path)
+        os.replace(tmp_path, path)
+
+    def load_checkpoint(self, path: str) -> None:
+        checkpoint = torch.load(path, map_location=self.device, weights_only=False)
+        self.model.load_state_dict(checkpoint["model"])
+        self.optimizer.load_state_dict(checkpoint["optimizer"])
+        self.epoch, self.step = checkpoint["epoch"], checkpoint["step"]
+        self.history = checkpoint["history"]
+        random.setstate(checkpoint["rng"]["python"])
+        np.random.set_state(checkpoint["rng"]["numpy"])
+        torch.set_rng_state(checkpoint["rng"]["torch"].cpu())
+        if checkpoint["rng"]["cuda"] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(checkpoint["rng"]["cuda"])
+
+
+################################################################################################
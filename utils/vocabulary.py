@@ -0,0 +1,160 @@
+import json, string, numpy as np
+from collections import Counter
+
+PAD, UNK, START, END = "<pad>", "<unk>", "startseq", "endseq"
+_PUNCTUATION = str.maketrans("", "", string.punctuation)
+
+"""
+This function splits a caption into words: the caption is lowercased and all
+punctuation characters are removed (like in get_vocabulary).
+"""
+
+
+def tokenize(caption: str) -> list:
+    return caption.lower().translate(_PUNCTUATION).split()
+
+
+################################################################################################
+
+"""
+This class maps the words of the captions to integer indices and back.
+The reserved words come first (by default <pad> = 0, <unk> = 1, startseq = 2,
+endseq = 3), then the other words sorted by decreasing frequency, so that the
+most frequent words have the smallest indices.
+Use Vocabulary.build(captions, min_count) to build it from a captions dictionary.
+Args:
+    words: list; all the words, the index of a word is its position in the list
+    counts: dict=None; the number of occurrences of each word
+    reserved: tuple=(PAD, UNK, START, END); the reserved words (at the start of words)
+"""
+
+
+class Vocabulary:
+    def __init__(
+        self, words: list, counts: dict = None, reserved: tuple = (PAD, UNK, START, END)
+    ):
+        self.int_to_word = list(words)
+        self.word_to_int = {word: i for i, word in enumerate(self.int_to_word)}
+        self.counts = dict(counts) if counts is not None else {}
+        self.reserved = tuple(reserved)
+        if len(self.word_to_int) != len(self.int_to_word):
+            raise ValueError("The words of a Vocabulary must be unique.")
+
+    @classmethod
+    def build(
+        cls,
+        captions: dict,
+        min_count: int = 1,
+        reserved: tuple = (PAD, UNK, START, END),
+    ) -> "Vocabulary":
+        # counting the words caption by caption, without building one huge string
+        counts = Counter()
+        for image_captions in captions.values():
+            for caption in image_captions:
+                counts.update(tokenize(caption))
+
+        kept = [
+            word
+            for word, count in counts.items()
+            if count >= min_count and word not in reserved
+        ]
+        kept.sort(key=lambda word: (-counts[word], word))  # deterministic order
+        return cls(list(reserved) + kept, counts, reserved)
+
+    def __len__(self) -> int:
+        return len(self.int_to_word)
+
+    def __contains__(self, word) -> bool:
+        return word in self.word_to_int
+
+    @property
+    def pad_id(self) -> int:
+        return self.word_to_int.get(PAD, 0)
+
+    @property
+    def unk_id(self):
+        return self.word_to_int.get(UNK)
+
+    @property
+    def start_id(self):
+        return self.word_to_int.get(START)
+
+    @property
+    def end_id(self):
+        return self.word_to_int.get(END)
+
+    # Encoding one caption. The unknown words are mapped to <unk>, or dropped if
+    # the vocabulary has no <unk>. The start and end tokens are only added once.
+    def encode(self, caption: str, add_start_end: bool = True) -> list:
+        words = tokenize(caption)
+        if add_start_end and START in self.word_to_int:
+            if not words or words[0] != START:
+                words.insert(0, START)
+            if words[-1] != END:
+                words.append(END)
+        unk_id = self.unk_id
+        if unk_id is None:
+            return [self.word_to_int[word] for word in words if word in self.word_to_int]
+        return [self.word_to_int.get(word, unk_id) for word in words]
+
+    # Encoding all the captions of a dataset at once.
+    # Returns the token ids as one flat int32 array, the offsets of the captions in it
+    # (caption i is tokens[offsets[i]:offsets[i + 1]]), and the index of the image of
+    # each caption in list(captions.keys()).
+    def encode_batch(self, captions: dict, add_start_end: bool = True):
+        tokens, offsets, caption_images = [], [0], []
+        for image_index, image_captions in enumerate(captions.values()):
+            for caption in image_captions:
+                tokens.extend(self.encode(caption, add_start_end))
+                offsets.append(len(tokens))
+                caption_images.append(image_index)
+        return (
+            np.array(tokens, dtype=np.int32),
+            np.array(offsets, dtype=np.int64),
+            np.array(caption_images, dtype=np.int64),
+        )
+
+    def decode(self, token_ids) -> str:
+        words = []
+        for token_id in token_ids:
+            word = self.int_to_word[int(token_id)]
+            if word == END:
+                break
+            if word not in self.reserved:
+                words.append(word)
+        return " ".join(words)
+
+    def to_dict(self) -> dict:
+        return {
+            "words": self.int_to_word,
+            "counts": self.counts,
+            "reserved": list(self.reserved),
+        }
+
+    def save(self, filepath: str) -> None:
+        with open(filepath, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, filepath: str) -> "Vocabulary":
+        with open(filepath, "r", encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Vocabulary":
+        # a plain word_to_int dictionary keeps its ids: they must be 0..n-1, or 1..n with
+        # 0 left for the padding (as a Keras Tokenizer does)
+        if "words" not in data:
+            ids = sorted(data.values())
+            offset = 1 if ids and ids[0] == 1 else 0
+            if ids != list(range(offset, offset + len(ids))):
+                raise ValueError(
+                    "The ids of a word_to_int dictionary must be 0..n-1 (or 1..n, with 0 "
+                    "for the padding), without gaps or duplicates."
+                )
+            words = [PAD] * offset + sorted(data, key=data.get)
+            return cls(words, reserved=(PAD,) * offset)
+        return cls(data["words"], data.get("counts"), data.get("reserved", ()))
+
+
+################################################################################################